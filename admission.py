@@ -0,0 +1,42 @@
+from typing import List, Optional, Tuple
+
+# a received line and the monotonic time it arrived
+Frame = Tuple[bytes, float]
+
+
+# What a %00 keypad update does to the state: its partition, flags, zone
+# or user, beep, and whether it reports a fault.  The alpha text is left
+# out; set_partition_status doesn't count a message change as a state
+# change either.  None for any other frame, or one the handler would
+# reject.
+def keypad_key(line: bytes) -> Optional[Tuple[bytes, bytes, bytes, bytes, bool]]:
+    if not line.startswith(b'%00,') or b'%' in line[1:]:
+        return None
+    fields = line[4:-1].split(b',', 4)
+    if len(fields) != 5:
+        return None
+    partition, flags, zone, beep, alpha = fields
+    return partition, flags, zone, beep, alpha.startswith(b'FAULT')
+
+
+# During alarms and entry and exit delays the Envisalink repeats the
+# keypad update several times a second, often many to a read.  A keypad
+# update followed directly by one with the same key is redundant: the
+# later one leaves the state just as it would.  Each run is collapsed to
+# its last frame, keeping the arrival time of the first for tracing.
+# Anything else in between ends a run, so no frame that changes the
+# state, or the order of changes, is dropped.  Returns the admitted
+# frames and how many were collapsed.
+def collapse_frames(frames: List[Frame]) -> Tuple[List[Frame], int]:
+    admitted: List[Frame] = []
+    collapsed = 0
+    previous = None
+    for line, rxtime in frames:
+        key = keypad_key(line)
+        if key is not None and key == previous:
+            admitted[-1] = (line, admitted[-1][1])
+            collapsed += 1
+        else:
+            admitted.append((line, rxtime))
+        previous = key
+    return admitted, collapsed
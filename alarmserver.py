@@ -9,144 +9,644 @@
 # This code is under the terms of the GPL v3 license.
 
 import getopt
+import json
 import logging
+import os
 import re
+import signal
+import socket
 import sys
+import time
 from datetime import datetime
 from datetime import timedelta
-from typing import Dict, Any
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Dict, Any, List, Mapping, Optional, Sequence, Tuple
 
-from twisted.internet import reactor
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' -c <configfile>\n'
+          '  -p, --panels=A,B         serve only these panels (used by supervisor.py)\n'
+          '  -s, --admin-socket=PATH  serve the admin pages on a unix socket')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hc:p:s:", ["help", "config=", "panels=",
+                                                    "admin-socket="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    global conffile, panels, adminsocket
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-c", "--config"):
+            conffile = arg
+        elif opt in ("-p", "--panels"):
+            panels = [name for name in arg.split(',') if name]
+        elif opt in ("-s", "--admin-socket"):
+            adminsocket = arg
+
+
+# The command line is read before the reactor and the rest are imported,
+# so --help and bad options return at once.
+if __name__ == "__main__":
+    conffile = 'alarmserver.cfg'
+    panels: Optional[List[str]] = None
+    adminsocket: Optional[str] = None
+    main(sys.argv[1:])
+
+# installs the reactor for the chosen runtime, so it comes before
+# anything that imports twisted.internet.reactor
+import runtime
+
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet.task import LoopingCall
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.python import log
 from twisted.web.resource import Resource
 
-from baseConfig import BaseConfig
+from admission import Frame, collapse_frames
+from baseConfig import BaseConfig, Sections
+from cid import (CATEGORY_AC_POWER, CATEGORY_ALARM, CATEGORY_ARM_AWAY,
+                 CATEGORY_ARM_STAY, CATEGORY_BYPASS, CATEGORY_CANCEL,
+                 CATEGORY_FIRE, CATEGORY_LOW_BATTERY, CATEGORY_TROUBLE,
+                 QUALIFIER_RESTORE, CIDEvent, decode_cid_event)
+from debounce import (DEFAULT_ZONE_TYPE, SOURCE_CID, SOURCE_KEYPAD,
+                      SOURCE_ZONECHANGE, SOURCE_ZONEDUMP, ZONE_TYPES,
+                      DebounceSettings, ZoneDebouncer, read_debounce_settings)
+from lagmonitor import LagMonitor, LagResource
+from logqueue import configure_logging, dump_flight_recorder
+from metrics import REGISTRY, MetricsResource
+from profiler import MODES as PROFILE_MODES, Profiler, ProfileResource
 from envisalinkdefs import *
-from smartthings import SmartThings
-
+from smartthings import SENDER_POOL, SENDERS, SmartThings, create_smartthings
+from statestore import EntityMap, FrozenDict, state_snapshot
+from timers import MONOTONIC, Watchdog
+from tracing import TRACER, TracesResource
+
+# capture, history, state file, proxy and MQTT are imported when their
+# options are set, so they cost nothing otherwise
+if TYPE_CHECKING:
+    from capture import CaptureWriter
+    from history import EventHistory
+    from mqttpublisher import MQTTPublisher
+    from snapshot import StateSnapshot
+    from tpiproxy import TPIProxyClient, TPIProxyFactory
+
+# zones and partitions by number, as EntityMaps; state_snapshot() makes
+# an immutable copy for other threads
 AlarmState = Dict[str, Dict[int, Dict[str, Any]]]
 ALARMSTATE: AlarmState = {}
 MAXPARTITIONS: int = 16
 MAXZONES: int = 128
 MAXALARMUSERS: int = 47
 SHUTTINGDOWN: bool = False
+HEXDATA = re.compile('[0-9A-Fa-f]*')
+
+# the histogram count doubles as the number of lines received per code
+HANDLER_SECONDS = REGISTRY.histogram(
+    'alarmserver_handler_seconds', 'Time spent handling each received line', ['code'])
+INVALID_FRAMES = REGISTRY.counter(
+    'alarmserver_invalid_frames_total', 'Received lines with an unknown code or bad data')
+FRAMES_COLLAPSED = REGISTRY.counter(
+    'alarmserver_frames_collapsed_total',
+    'Keypad updates skipped because the next line read made them redundant')
+FRAMES_DEFERRED = REGISTRY.counter(
+    'alarmserver_frames_deferred_total',
+    'Times a received line was left for a later reactor iteration by the tick budget')
+WATCHDOG_TIMEOUTS = REGISTRY.counter(
+    'alarmserver_envisalink_timeouts_total', 'Connections reset by a watchdog', ['watchdog'])
+CONNECTIONS = REGISTRY.counter(
+    'alarmserver_envisalink_connections_total', 'TCP connections made to the Envisalink')
+CONNECTIONS_LOST = REGISTRY.counter(
+    'alarmserver_envisalink_connections_lost_total', 'Established connections that were lost')
+CONNECTIONS_FAILED = REGISTRY.counter(
+    'alarmserver_envisalink_connections_failed_total', 'Connection attempts that failed')
+RECOVERIES = REGISTRY.counter(
+    'alarmserver_envisalink_recoveries_total', 'Sessions re-established after an outage')
+BLIND_SECONDS = REGISTRY.histogram(
+    'alarmserver_envisalink_blind_seconds', 'Time without panel data during each outage',
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600))
 
 
 class AlarmServerConfig(BaseConfig):
-    def __init__(self, configfile: str):
+    # options that can only change by reconnecting to the Envisalink
+    RECONNECT_OPTIONS = ('ENVISALINKHOST', 'ENVISALINKPORT', 'ENVISALINKHOSTS', 'ENVISALINKPASS')
+    # options only read at startup; changing them needs a restart
+    RESTART_OPTIONS = ('ENVISAPROXYPORT', 'ENVISAPROXYINTERFACE', 'LOGFILE', 'LOGLEVEL',
+                       'LOGFORMAT', 'FLIGHTRECORDER', 'ADMINPORT', 'ADMININTERFACE', 'LAGINTERVAL',
+                       'LAGTHRESHOLD', 'LAGOFFENDERS', 'PANELS', 'WORKERS', 'CAPTUREFILE',
+                       'CAPTUREINDEXINTERVAL', 'HISTORYFILE', 'HISTORYRETENTION', 'STATEFILE',
+                       'STATEINTERVAL', 'MQTTHOST', 'MQTTPORT', 'MQTTUSERNAME', 'MQTTPASSWORD',
+                       'MQTTTOPIC', 'MQTTCLIENTID', 'MQTTQOS', 'MQTTKEEPALIVE', 'SENDER',
+                       'SENDERTHREADS')
+
+    def __init__(self, configfile: Optional[str], panel: Optional[str] = None,
+                 sections: Optional[Sections] = None):
         # call ancestor for common setup
-        super(self.__class__, self).__init__(configfile)
+        super(self.__class__, self).__init__(configfile, panel, sections)
 
         self.ENVISALINKHOST = self.get_str('envisalink', 'host', 'envisalink')
         self.ENVISALINKPORT = self.get_int('envisalink', 'port', 4025)
+        # optional list of endpoints to fail over between, e.g.
+        # hosts = evl-primary:4025, evl-standby:4025
+        self.ENVISALINKHOSTS: Sequence[Tuple[str, int]] = self.parse_endpoints(
+            self.get_str('envisalink', 'hosts', '', True))
+        if not self.ENVISALINKHOSTS:
+            self.ENVISALINKHOSTS = [(self.ENVISALINKHOST, self.ENVISALINKPORT)]
+        self.ENVISACONNECTTIMEOUT = self.get_int('envisalink', 'connecttimeout', 30, True)
+        self.ENVISAMAXRECONNECTDELAY = self.get_int('envisalink', 'maxreconnectdelay', 60, True)
+        self.ENVISAHEARTBEATINTERVAL = self.get_float('envisalink', 'heartbeatinterval', 0, True)
+        self.ENVISAHEARTBEATTIMEOUT = self.get_float('envisalink', 'heartbeattimeout', 2, True)
+        self.ENVISATCPKEEPALIVE = self.get_int('envisalink', 'tcpkeepalive', 0, True)
         self.ENVISALINKPASS = self.get_str('envisalink', 'pass', 'user')
         self.ENVISAPOLLINTERVAL = self.get_int('envisalink', 'pollinterval', 0)
         self.ENVISAZONEDUMPINTERVAL = self.get_int('envisalink', 'zonedumpinterval', 60)
+        # adaptive zone dump / poll cadence: fast while zones are open or
+        # the system is armed, slow once everything has been quiet a while
+        self.ENVISAZONEDUMPMININTERVAL = self.get_int(
+            'envisalink', 'zonedumpmininterval', self.ENVISAZONEDUMPINTERVAL, True)
+        self.ENVISAZONEDUMPMAXINTERVAL = self.get_int(
+            'envisalink', 'zonedumpmaxinterval', self.ENVISAZONEDUMPINTERVAL, True)
+        self.ENVISAIDLETIME = self.get_int('envisalink', 'idletime', 600, True)
+        self.ENVISAPOLLIDLEINTERVAL = self.get_int(
+            'envisalink', 'pollidleinterval', self.ENVISAPOLLINTERVAL, True)
         self.ENVISAKEYPADUPDATEINTERVAL = self.get_int('envisalink', 'keypadupdateinterval', 60)
         self.ENVISACOMMANDTIMEOUT = self.get_int('envisalink', 'commandtimeout', 30)
         self.ENVISAKPEVENTTIMEOUT = self.get_int('envisalink', 'kpeventtimeout', 45)
+        # collapse repeated keypad updates that arrive in one read, and
+        # handle at most this many seconds of lines per reactor iteration
+        self.ENVISACOLLAPSEFRAMES = self.get_bool('envisalink', 'collapseframes', True, True)
+        self.ENVISATICKBUDGET = self.get_float('envisalink', 'tickbudget', 0.02, True)
         self.ALARMCODE = self.get_int('envisalink', 'alarmcode', 1111)
+        # local TPI listener sharing this session with other clients;
+        # zero disables it
+        self.ENVISAPROXYPORT = self.get_int('envisalink', 'proxyport', 0, True)
+        self.ENVISAPROXYINTERFACE = self.get_str('envisalink', 'proxyinterface', '127.0.0.1', True)
+        self.ENVISAPROXYPASS = self.get_str('envisalink', 'proxypass', self.ENVISALINKPASS, True)
+        self.ENVISAPROXYBACKLOG = self.get_int('envisalink', 'proxybacklog', 1000, True)
+        # read here rather than by SmartThings so every option is checked
+        # before connecting
+        self.CALLBACKURL_BASE = self.get_str('smartthings', 'callbackurl_base', 'not_provided')
+        self.CALLBACKURL_APP_ID = self.get_str('smartthings', 'callbackurl_app_id', 'not_provided')
+        self.CALLBACKURL_ACCESS_TOKEN = self.get_str('smartthings', 'callbackurl_access_token',
+                                                     'not_provided')
+        self.API_TIMEOUT = self.get_int('smartthings', 'api_timeout', 10)
+        self.QUEUE_SIZE = self.get_int('smartthings', 'queue_size', 100)
+        self.REPEAT_UPDATE_INTERVAL = self.get_int('smartthings', 'repeat_update_interval', 55)
+        # token bucket per api path: posts per second (zero for no limit)
+        # and how many may go back to back
+        self.RATE_LIMIT = self.get_float('smartthings', 'ratelimit', 5.0, True)
+        self.RATE_LIMIT_BURST = self.get_int('smartthings', 'ratelimitburst', 10, True)
+        # backoff after errors, doubling from min to max seconds
+        self.BACKOFF_MIN = self.get_float('smartthings', 'backoffmin', 1.0, True)
+        self.BACKOFF_MAX = self.get_float('smartthings', 'backoffmax', 300.0, True)
+        # thread (requests on a thread) or async (Twisted's http client)
+        self.SENDER = self.get_str('smartthings', 'sender', 'thread', True)
+        # api threads shared by the panels' thread senders
+        self.SENDERTHREADS = self.get_int('smartthings', 'senderthreads', 1, True)
         self.LOGFILE = self.get_str('alarmserver', 'logfile', '')
         self.LOGLEVEL = self.get_str('alarmserver', 'loglevel', 'DEBUG')
-
-        self.PARTITIONNAMES: Dict[int, str] = {}
-        for i in range(1, MAXPARTITIONS + 1):
-            self.PARTITIONNAMES[i] = self.get_str('alarmserver', 'partition' + str(i), '', True)
-
-        self.ZONENAMES: Dict[int, str] = {}
-        for i in range(1, MAXZONES + 1):
-            self.ZONENAMES[i] = self.get_str('alarmserver', 'zone' + str(i), '', True)
-
-        self.ALARMUSERNAMES: Dict[int, str] = {}
-        for i in range(1, MAXALARMUSERS + 1):
-            self.ALARMUSERNAMES[i] = self.get_str('alarmserver', 'user' + str(i), '', True)
-
-    def initialize_alarmstate(self):
-        ALARMSTATE['zone'] = {}
-        for zone_num in list(self.ZONENAMES.keys()):
-            zone_name = self.ZONENAMES[zone_num]
-            if not zone_name:
+        # text, or keyvalue for structured logs
+        self.LOGFORMAT = self.get_str('alarmserver', 'logformat', 'text', True)
+        # records below loglevel kept in memory and logged on an error
+        self.FLIGHTRECORDER = self.get_int('alarmserver', 'flightrecorder', 1000, True)
+        # local http port for /metrics; zero disables it
+        self.ADMINPORT = self.get_int('alarmserver', 'adminport', 0, True)
+        self.ADMININTERFACE = self.get_str('alarmserver', 'admininterface', '127.0.0.1', True)
+        # trace one in N updates end to end (priority updates are always
+        # traced), keeping the last few for /traces
+        self.TRACESAMPLE = self.get_int('alarmserver', 'tracesample', 100, True)
+        self.TRACEBUFFER = self.get_int('alarmserver', 'tracebuffer', 100, True)
+        # reactor lag monitor; zero interval disables it
+        self.LAGINTERVAL = self.get_float('alarmserver', 'laginterval', 0.5, True)
+        self.LAGTHRESHOLD = self.get_float('alarmserver', 'lagthreshold', 0.25, True)
+        self.LAGOFFENDERS = self.get_int('alarmserver', 'lagoffenders', 20, True)
+        # on-demand profiling via SIGUSR1 or /profile on the admin port
+        self.PROFILEDIR = self.get_str('alarmserver', 'profiledir', '.', True)
+        self.PROFILESECONDS = self.get_float('alarmserver', 'profileseconds', 30, True)
+        self.PROFILEMODE = self.get_str('alarmserver', 'profilemode', 'cprofile', True)
+        # names of the panels to connect to, each configured in
+        # [envisalink:name], [alarmserver:name] and [smartthings:name]
+        self.PANELS: Tuple[str, ...] = tuple(
+            name.strip() for name in self.get_str('alarmserver', 'panels', '', True).split(',')
+            if name.strip())
+        # worker processes supervisor.py shards the panels across; zero
+        # uses one per cpu
+        self.WORKERS = self.get_int('alarmserver', 'workers', 0, True)
+        self.CAPTUREFILE = self.panel_filename(
+            self.get_str('alarmserver', 'capturefile', '', True))
+        self.CAPTUREINDEXINTERVAL = self.get_int('alarmserver', 'captureindexinterval', 60, True)
+        # SQLite database of zone and partition transitions
+        self.HISTORYFILE = self.panel_filename(
+            self.get_str('alarmserver', 'historyfile', '', True))
+        self.HISTORYRETENTION = self.get_float('alarmserver', 'historyretention', 30, True)
+        # alarm state checkpoint restored at startup
+        self.STATEFILE = self.panel_filename(
+            self.get_str('alarmserver', 'statefile', '', True))
+        self.STATEINTERVAL = self.get_float('alarmserver', 'stateinterval', 5, True)
+        # MQTT broker to publish each zone and partition to; no host
+        # disables it.  Each panel publishes under its own topic.
+        self.MQTTHOST = self.get_str('mqtt', 'host', '', True)
+        self.MQTTPORT = self.get_int('mqtt', 'port', 1883, True)
+        self.MQTTUSERNAME = self.get_str('mqtt', 'username', '', True)
+        self.MQTTPASSWORD = self.get_str('mqtt', 'password', '', True)
+        self.MQTTTOPIC = self.get_str('mqtt', 'topic', 'alarmserver', True)
+        if self.PANEL is not None:
+            self.MQTTTOPIC += '/' + self.PANEL
+        self.MQTTCLIENTID = self.get_str('mqtt', 'clientid', self.MQTTTOPIC.replace('/', '-'), True)
+        self.MQTTQOS = self.get_int('mqtt', 'qos', 1, True)
+        self.MQTTKEEPALIVE = self.get_int('mqtt', 'keepalive', 60, True)
+        self.MQTTBATCHINTERVAL = self.get_float('mqtt', 'batchinterval', 0.05, True)
+
+        partition_names = self.get_numbered('alarmserver', 'partition', MAXPARTITIONS)
+        self.PARTITIONNAMES: Mapping[int, str] = {
+            i: partition_names.get(i, '') for i in range(1, MAXPARTITIONS + 1)}
+
+        zone_names = self.get_numbered('alarmserver', 'zone', MAXZONES)
+        self.ZONENAMES: Mapping[int, str] = {i: zone_names.get(i, '') for i in range(1, MAXZONES + 1)}
+
+        # debounce settings for each named zone, chosen by its zonetypeN;
+        # validate() rejects unknown types
+        self.ZONETYPES: Mapping[int, str] = {
+            i: self.get_str('alarmserver', 'zonetype' + str(i), DEFAULT_ZONE_TYPE, True)
+            for i in range(1, MAXZONES + 1) if self.ZONENAMES[i]}
+        debounce_settings = read_debounce_settings(self)
+        self.ZONEDEBOUNCE: Mapping[int, DebounceSettings] = {
+            i: debounce_settings[zone_type] for i, zone_type in self.ZONETYPES.items()
+            if zone_type in ZONE_TYPES}
+
+        user_names = self.get_numbered('alarmserver', 'user', MAXALARMUSERS)
+        self.ALARMUSERNAMES: Mapping[int, str] = {
+            i: user_names.get(i, '') for i in range(1, MAXALARMUSERS + 1)}
+        self.validate()
+        self.freeze()
+
+    # Reject values that parse but can't work, naming the option.
+    def validate(self):
+        checks = [
+            ('envisalink', 'proxyport', 0 <= self.ENVISAPROXYPORT <= 65535),
+            ('envisalink', 'tickbudget', self.ENVISATICKBUDGET >= 0),
+            ('envisalink', 'pollinterval', self.ENVISAPOLLINTERVAL >= 0),
+            # zero uses pollinterval when idle too
+            ('envisalink', 'pollidleinterval', self.ENVISAPOLLIDLEINTERVAL == 0 or
+             self.ENVISAPOLLIDLEINTERVAL >= self.ENVISAPOLLINTERVAL),
+            ('envisalink', 'zonedumpinterval', self.ENVISAZONEDUMPINTERVAL > 0),
+            ('envisalink', 'zonedumpmininterval',
+             0 < self.ENVISAZONEDUMPMININTERVAL <= self.ENVISAZONEDUMPINTERVAL),
+            ('envisalink', 'zonedumpmaxinterval',
+             self.ENVISAZONEDUMPMAXINTERVAL >= self.ENVISAZONEDUMPINTERVAL),
+            ('alarmserver', 'adminport', 0 <= self.ADMINPORT <= 65535),
+            ('alarmserver', 'logformat', self.LOGFORMAT in ('text', 'keyvalue')),
+            ('alarmserver', 'profilemode', self.PROFILEMODE in PROFILE_MODES),
+            ('alarmserver', 'profileseconds', 0 < self.PROFILESECONDS < float('inf')),
+            ('smartthings', 'sender', self.SENDER in SENDERS),
+            ('smartthings', 'senderthreads', self.SENDERTHREADS >= 1),
+            ('smartthings', 'ratelimit', self.RATE_LIMIT >= 0),
+            ('smartthings', 'ratelimitburst', self.RATE_LIMIT_BURST >= 1),
+            ('smartthings', 'backoffmin', self.BACKOFF_MIN > 0),
+            ('smartthings', 'backoffmax', self.BACKOFF_MAX >= self.BACKOFF_MIN),
+            ('mqtt', 'port', 0 < self.MQTTPORT <= 65535),
+            ('mqtt', 'qos', self.MQTTQOS in (0, 1)),
+        ]
+        checks += [('envisalink', 'hosts', 0 < port <= 65535)
+                   for host, port in self.ENVISALINKHOSTS]
+        checks += [('alarmserver', 'zonetype' + str(i), zone_type in ZONE_TYPES)
+                   for i, zone_type in self.ZONETYPES.items()]
+        for section, variable, valid in checks:
+            if not valid:
+                raise ValueError('Config option %s in [%s] has an invalid value: \'%s\'' %
+                                 (variable, section, self.get_str(section, variable, '', True)))
+
+    # parse a comma-separated list of host[:port] endpoints
+    def parse_endpoints(self, endpoints: str) -> List[Tuple[str, int]]:
+        result = []
+        for endpoint in endpoints.split(','):
+            endpoint = endpoint.strip()
+            if not endpoint:
                 continue
-            ALARMSTATE['zone'][zone_num] = {
-                'name': zone_name,
-                'message': 'uninitialized',
-                'status': 'uninitialized',
-                'closedSeconds': -1,
-                'lastChanged': 'never'
-            }
-
-        ALARMSTATE['partition'] = {}
-        for partition_num in list(self.PARTITIONNAMES.keys()):
-            partition_name = self.PARTITIONNAMES[partition_num]
-            if not partition_name:
-                continue
-            ALARMSTATE['partition'][partition_num] = {
-                'name': partition_name,
-                'message': 'uninitialized',
-                'status': 'uninitialized',
-                'beep': 'uninitialized',
-                'alarm': False,
-                'alarm_in_memory': False,
-                'armed_away': False,
-                'ac_present': False,
-                'bypass': False,
-                'chime': False,
-                'armed_max': False,
-                'alarm_fire': False,
-                'system_trouble': False,
-                'ready': False,
-                'fire': False,
-                'low_battery': False,
-                'armed_stay': False
-            }
+            host, _, port = endpoint.partition(':')
+            result.append((host, int(port) if port else self.ENVISALINKPORT))
+        return result
+
+    # The config for one of the PANELS.
+    def panel_config(self, panel: str) -> 'AlarmServerConfig':
+        return AlarmServerConfig(None, panel, self._sections)
+
+    # Give each panel its own capture, history and state files, e.g.
+    # history.db becomes history-site1.db.
+    def panel_filename(self, filename: str) -> str:
+        if not filename or self.PANEL is None:
+            return filename
+        root, extension = os.path.splitext(filename)
+        return '%s-%s%s' % (root, self.PANEL, extension)
+
+    # Fill in state, the global ALARMSTATE by default, for the configured
+    # zones and partitions.
+    def initialize_alarmstate(self, state: Optional[AlarmState] = None) -> AlarmState:
+        if state is None:
+            state = ALARMSTATE
+        state['zone'] = EntityMap()
+        state['partition'] = EntityMap()
+        self.update_alarmstate(state)
+        return state
+
+    # Bring state in line with the configured zones and partitions,
+    # adding and removing entries and renaming the rest in place.
+    # Returns the (kind, number) of each entry added, removed and renamed.
+    def update_alarmstate(self, state: AlarmState) -> Tuple[List[Tuple[str, int]], ...]:
+        added, removed, renamed = [], [], []
+        for kind, names, new_entry in (('zone', self.ZONENAMES, new_zone_state),
+                                       ('partition', self.PARTITIONNAMES, new_partition_state)):
+            entries = state[kind]
+            for number in [number for number in entries if not names.get(number)]:
+                del entries[number]
+                removed.append((kind, number))
+            for number, name in names.items():
+                if not name:
+                    continue
+                entry = entries.get(number)
+                if entry is None:
+                    entries[number] = new_entry(name)
+                    added.append((kind, number))
+                elif entry['name'] != name:
+                    entry['name'] = name
+                    renamed.append((kind, number))
+            if added:
+                # keep entries in number order
+                ordered = sorted(entries.items())
+                entries.clear()
+                entries.update(ordered)
+        return added, removed, renamed
+
+
+def new_zone_state(name: str) -> Dict[str, Any]:
+    return {
+        'name': name,
+        'message': 'uninitialized',
+        'status': 'uninitialized',
+        'closedSeconds': -1,
+        'lastChanged': 'never',
+        'stale': False
+    }
+
+
+def new_partition_state(name: str) -> Dict[str, Any]:
+    return {
+        'name': name,
+        'message': 'uninitialized',
+        'status': 'uninitialized',
+        'beep': 'uninitialized',
+        'alarm': False,
+        'alarm_in_memory': False,
+        'armed_away': False,
+        'ac_present': False,
+        'bypass': False,
+        'chime': False,
+        'armed_max': False,
+        'alarm_fire': False,
+        'system_trouble': False,
+        'ready': False,
+        'fire': False,
+        'low_battery': False,
+        'armed_stay': False,
+        'lastArmedBy': '',
+        'lastDisarmedBy': '',
+        'stale': False
+    }
 
 
 class EnvisalinkClientFactory(ReconnectingClientFactory):
-    def __init__(self, in_config: AlarmServerConfig):
+    # number of recent outages to remember
+    MAXOUTAGES = 50
+
+    def __init__(self, in_config: AlarmServerConfig, state: Optional[AlarmState] = None):
         self._config: AlarmServerConfig = in_config
-        self._smartthings: SmartThings = SmartThings(in_config)
+        # each panel has its own state; a single panel uses ALARMSTATE
+        self._state: AlarmState = ALARMSTATE if state is None else state
+        self.name: str = in_config.PANEL or 'default'
+        self._smartthings: SmartThings = create_smartthings(in_config)
         self._envisalinkClient = None
-        self._currentLoopingCall = None
+        self.maxDelay = in_config.ENVISAMAXRECONNECTDELAY
+
+        self._endpoints: Sequence[Tuple[str, int]] = in_config.ENVISALINKHOSTS
+        self._endpointindex: int = 0
+        self._connector = None
+
+        # Outage tracking: the site is blind from the last frame received
+        # on a dead connection until the next successful login.
+        self._blindsince = None
+        self.outages = deque(maxlen=self.MAXOUTAGES)
+        self.reconnects: int = 0
+
+        # raw capture of every received frame, kept across reconnects
+        self._capture: Optional['CaptureWriter'] = None
+        if in_config.CAPTUREFILE:
+            from capture import CaptureWriter
+            self._capture = CaptureWriter(in_config.CAPTUREFILE,
+                                          in_config.CAPTUREINDEXINTERVAL)
+        # zone and partition transitions, kept across reconnects
+        self._history: Optional['EventHistory'] = None
+        if in_config.HISTORYFILE:
+            from history import EventHistory
+            self._history = EventHistory(in_config.HISTORYFILE, in_config.HISTORYRETENTION)
+        # start from the last known state rather than uninitialized
+        self._snapshot: Optional['StateSnapshot'] = None
+        if in_config.STATEFILE:
+            from snapshot import StateSnapshot
+            self._snapshot = StateSnapshot(in_config.STATEFILE, in_config.STATEINTERVAL)
+            self._snapshot.load(self._state)
+        self.proxy: Optional['TPIProxyFactory'] = None
+        if in_config.ENVISAPROXYPORT:
+            from tpiproxy import start_proxy
+            self.proxy = start_proxy(
+                in_config.ENVISAPROXYPORT, in_config.ENVISAPROXYINTERFACE,
+                in_config.ENVISAPROXYPASS, in_config.ENVISAPROXYBACKLOG)
+        self._mqtt: Optional['MQTTPublisher'] = None
+        if in_config.MQTTHOST:
+            from mqttpublisher import MQTTPublisher
+            self._mqtt = MQTTPublisher(in_config.MQTTHOST, in_config.MQTTPORT,
+                                       in_config.MQTTTOPIC, in_config.MQTTCLIENTID,
+                                       in_config.MQTTUSERNAME, in_config.MQTTPASSWORD,
+                                       in_config.MQTTQOS, in_config.MQTTKEEPALIVE,
+                                       in_config.MQTTBATCHINTERVAL)
+            self._mqtt.start()
+            # publish the restored or initial state once connected
+            self._mqtt.publish_state(state_snapshot(self._state))
+
+    # Start connecting to the first configured endpoint.
+    def connect(self):
+        host, port = self._endpoints[self._endpointindex]
+        self._connector = reactor.connectTCP(host, port, self,
+                                             timeout=self._config.ENVISACONNECTTIMEOUT)
+        return self._connector
 
     def buildProtocol(self, addr):
         logging.debug("%s connection established to %s:%s", addr.type, addr.host, addr.port)
         logging.debug("resetting connection delay")
         self.resetDelay()
-        self._envisalinkClient = EnvisalinkClient(self._config, self._smartthings)
-
-        # check on the state of the envisalink connection repeatedly
-        self._currentLoopingCall = LoopingCall(self._envisalinkClient.check_alive)
-        self._currentLoopingCall.start(1)
+        CONNECTIONS.inc()
+        self._envisalinkClient = EnvisalinkClient(self._config, self._smartthings,
+                                                  capture=self._capture,
+                                                  history=self._history,
+                                                  state=self._state,
+                                                  proxy=self.proxy)
+        self._envisalinkClient.factory = self
         return self._envisalinkClient
 
+    def seconds_since_keypad_update(self):
+        if self._envisalinkClient is None:
+            return None
+        return self._envisalinkClient.seconds_since_keypad_update()
+
     def startedConnecting(self, connector):
-        logging.debug("Started to connect to Envisalink...")
+        logging.debug("Started to connect to Envisalink at %s:%d...",
+                      connector.host, connector.port)
 
     def clientConnectionLost(self, connector, reason):
         if not SHUTTINGDOWN:
             logging.debug('Lost connection to Envisalink.  Reason: %s', str(reason))
-            if hasattr(self, "_currentLoopingCall"):
-                try:
-                    self._currentLoopingCall.stop()
-                except:
-                    logging.error("Error trying to stop looping call, ignoring...")
+            CONNECTIONS_LOST.inc()
+            self.connection_down(self._envisalinkClient)
+            self.failover(connector)
             ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         logging.debug('Connection failed to Envisalink. Reason: %s', str(reason))
-        if hasattr(self, "_currentLoopingCall"):
-            try:
-                self._currentLoopingCall.stop()
-            except:
-                logging.error("Error trying to stop looping call, ignoring...")
+        CONNECTIONS_FAILED.inc()
+        self.connection_down(None)
+        self.failover(connector)
         ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
+    # Point the connector at the next endpoint.  Moving through the list
+    # happens at the initial reconnect delay; the reconnect backoff only
+    # grows once every endpoint has been tried.
+    def failover(self, connector):
+        if len(self._endpoints) < 2:
+            return
+        self._endpointindex = (self._endpointindex + 1) % len(self._endpoints)
+        connector.host, connector.port = self._endpoints[self._endpointindex]
+        if self._endpointindex != 0:
+            self.resetDelay()
+        logging.info("Failing over to Envisalink at %s:%d",
+                     connector.host, connector.port)
+
+    def connection_down(self, client):
+        if self._blindsince is not None:
+            return
+        if client is not None and client.lastrx is not None:
+            self._blindsince = client.lastrx
+        else:
+            self._blindsince = time.monotonic()
+
+    # Called by the client once a session is established.
+    def login_succeeded(self, client):
+        if self._blindsince is None:
+            return
+        now = time.monotonic()
+        blind_seconds = now - self._blindsince
+        self._blindsince = None
+        self.reconnects += 1
+        RECOVERIES.inc()
+        BLIND_SECONDS.observe(blind_seconds)
+        host, port = self._endpoints[self._endpointindex]
+        self.outages.append({
+            'endpoint': '%s:%d' % (host, port),
+            'recovered': self.get_time_text(),
+            'blindSeconds': round(blind_seconds, 3)
+        })
+        logging.warning("Recovered Envisalink session on %s:%d after %.3f "
+                        "seconds without panel data", host, port, blind_seconds)
+
+    def close_capture(self):
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+
+    def close_history(self):
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+
+    # Called by the client whenever it sends a state update, with the
+    # snapshot it sent.
+    def state_changed(self, snapshot: Optional[FrozenDict] = None):
+        if snapshot is None:
+            snapshot = state_snapshot(self._state)
+        if self._snapshot is not None:
+            self._snapshot.changed(snapshot)
+        if self._mqtt is not None:
+            self._mqtt.publish_state(snapshot)
+
+    def close_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    # Apply a reloaded config for this panel in place: zones and
+    # partitions are added, removed or renamed in the state, and the
+    # client's timers and the SmartThings settings are updated.  Only a
+    # change of host or password drops the session.  Returns a summary.
+    def reconfigure(self, config: AlarmServerConfig) -> Dict[str, Any]:
+        changed = self._config.changes(config)
+        self._config = config
+        self.maxDelay = config.ENVISAMAXRECONNECTDELAY
+        self._smartthings.reconfigure(config)
+        if self._mqtt is not None:
+            self._mqtt.batch_interval = config.MQTTBATCHINTERVAL
+        if self.proxy is not None:
+            self.proxy.password = config.ENVISAPROXYPASS
+            self.proxy.max_backlog = config.ENVISAPROXYBACKLOG
+        added, removed, renamed = config.update_alarmstate(self._state)
+
+        client = self._envisalinkClient
+        if client is not None:
+            client.reconfigure(config, changed)
+        reconnect = any(name in config.RECONNECT_OPTIONS for name in changed)
+        if reconnect:
+            self._endpoints = config.ENVISALINKHOSTS
+            # dropping the session fails over to the next endpoint, which
+            # wraps around to the first
+            self._endpointindex = len(self._endpoints) - 1
+            if self._connector is not None:
+                self._connector.host, self._connector.port = self._endpoints[0]
+            self.resetDelay()
+            if client is not None and client.connected:
+                logging.warning("Envisalink host or password changed, reconnecting...")
+                client.logout()
+        elif added or removed or renamed:
+            if client is not None and client.is_logged_in():
+                client.state_reloaded(any(kind == 'zone' for kind, _ in added))
+            else:
+                self.state_changed()
+        return {
+            'panel': self.name,
+            'changed': changed,
+            'added': ['%s%d' % entry for entry in added],
+            'removed': ['%s%d' % entry for entry in removed],
+            'renamed': ['%s%d' % entry for entry in renamed],
+            'reconnect': reconnect,
+        }
+
+    # Publish offline to MQTT; fires once disconnected.
+    def close_mqtt(self) -> defer.Deferred:
+        if self._mqtt is None:
+            return defer.succeed(None)
+        mqtt, self._mqtt = self._mqtt, None
+        return mqtt.stop()
+
+    def get_time_text(self):
+        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
 
 class EnvisalinkClient(LineOnlyReceiver):
-    def __init__(self, in_config: AlarmServerConfig, smartthings: SmartThings):
+    def __init__(self, in_config: AlarmServerConfig, smartthings: SmartThings,
+                 clock=MONOTONIC, capture: Optional['CaptureWriter'] = None,
+                 history: Optional['EventHistory'] = None,
+                 state: Optional[AlarmState] = None,
+                 proxy: Optional['TPIProxyFactory'] = None):
         # Are we logged in?
         self._loggedin = False
 
@@ -156,66 +656,226 @@ class EnvisalinkClient(LineOnlyReceiver):
         self._config = in_config
         self._smartthings = smartthings
 
+        self.factory = None
+        # monotonic time the last line was received
+        self.lastrx = None
+        self._lastkeypadupdate = None
+        # when and what the frame being handled was, for tracing the
+        # updates it causes
+        self._rxtime = time.monotonic()
+        self._rxcode = ''
+        # lines of the read being admitted, and admitted lines waiting
+        # for a later reactor iteration when the tick budget ran out
+        self._batch: Optional[List[Frame]] = None
+        self._backlog: deque = deque()
+        self._backlogcall = None
+        self._readpaused = False
+
         self._commandinprogress = False
-        now = datetime.now()
-        self._lastkeypadupdate = now
-        self._lastpoll = datetime.min
-        self._lastpollresponse = datetime.min
-        self._lastzonedump = datetime.min
-        self._lastpartitionupdate = datetime.min
-        self._lastcommand = now
-        self._lastcommandresponse = now
+        # periodic commands that came due while another command was in
+        # progress, in order and each at most once (a dict used as an
+        # ordered set); sent one per response.
+        self._pendingcommands: Dict[str, None] = {}
+        # commands from TPI proxy clients waiting their turn, and the
+        # client whose command is in progress
+        self._proxy = proxy
+        self._forwardqueue: deque = deque(maxlen=100)
+        self._commandowner: Optional['TPIProxyClient'] = None
+        # timestamps and timers run on this clock, which is virtual when
+        # replaying a capture
+        self._clock = clock
+        self._capture = capture
+        self._history = history
+        self._state: AlarmState = ALARMSTATE if state is None else state
+        self._lastpollresponse = 0.0
+        self._lastpartitionupdate = None
+        # last time a zone was open or a partition was armed
+        self._lastactivity = self._clock.seconds()
+        self._active = True
+        # set when state changed and should be sent to SmartThings
+        self._statedirty = False
+
+        self._debouncer = ZoneDebouncer(self._config.ZONEDEBOUNCE,
+                                        self.get_zone_status,
+                                        self.zone_debounced, clock)
+
+        # Each watchdog is a single timer that is pushed back whenever
+        # the event it guards arrives, so nothing runs between events.
+        self._commandwatchdog = Watchdog('command', self.command_timed_out, clock)
+        self._keypadwatchdog = Watchdog('keypad', self.keypad_timed_out, clock)
+        self._pollwatchdog = Watchdog('poll', self.poll_due, clock)
+        self._zonedumpwatchdog = Watchdog('zonedump', self.zone_dump_due, clock)
+        # Application heartbeat: poll when the link has been quiet for a
+        # heartbeat interval, and drop it if nothing arrives in time.
+        self._heartbeatwatchdog = Watchdog('heartbeat', self.heartbeat_due, clock)
+        self._linkwatchdog = Watchdog('link', self.link_timed_out, clock)
 
     def logout(self):
         logging.debug("Ending Envisalink client connection...")
         self._loggedin = False
+        self.stop_watchdogs()
         if hasattr(self, 'transport'):
             self.transport.loseConnection()
 
+    # Switch to a reloaded config, rescheduling the periodic commands and
+    # watchdogs whose settings changed.
+    def reconfigure(self, config: AlarmServerConfig, changed: List[str]):
+        self._config = config
+        self._debouncer.update_settings(config.ZONEDEBOUNCE)
+        if not self._loggedin:
+            return
+        if any(name in changed for name in ('ENVISAZONEDUMPINTERVAL', 'ENVISAZONEDUMPMININTERVAL',
+                                            'ENVISAZONEDUMPMAXINTERVAL', 'ENVISAIDLETIME')):
+            self.reschedule(self._zonedumpwatchdog, self.zone_dump_interval())
+        if any(name in changed for name in ('ENVISAPOLLINTERVAL', 'ENVISAPOLLIDLEINTERVAL',
+                                            'ENVISAIDLETIME')):
+            if self.poll_interval() > 0:
+                self.reschedule(self._pollwatchdog, self.poll_interval())
+            else:
+                self._pollwatchdog.cancel()
+        if 'ENVISAKPEVENTTIMEOUT' in changed:
+            self._keypadwatchdog.reset(config.ENVISAKPEVENTTIMEOUT)
+        if 'ENVISAHEARTBEATINTERVAL' in changed or 'ENVISAHEARTBEATTIMEOUT' in changed:
+            if config.ENVISAHEARTBEATINTERVAL > 0:
+                self.reset_heartbeat()
+            else:
+                self._heartbeatwatchdog.cancel()
+                self._linkwatchdog.cancel()
+        if 'ENVISATCPKEEPALIVE' in changed and config.ENVISATCPKEEPALIVE > 0:
+            self.set_tcp_keepalive(config.ENVISATCPKEEPALIVE)
+
+    # Run a watchdog within interval: sooner if it was due sooner.
+    @staticmethod
+    def reschedule(watchdog: Watchdog, interval: float):
+        remaining = watchdog.remaining()
+        watchdog.reset(interval if remaining is None else min(remaining, interval))
+
+    # Send the state after a reload changed its zones or partitions, and
+    # dump zones now if any were added so they don't wait uninitialized.
+    def state_reloaded(self, zones_added: bool):
+        self._statedirty = True
+        self.flush_state(origin=('reload', time.monotonic()))
+        if zones_added:
+            self._zonedumpwatchdog.reset(0)
+
     def send_data(self, data):
-        logging.debug('TX > ' + data)
+        logging.debug('TX > %s', data)
         self.sendLine(data.encode('ascii'))
 
-    def check_alive(self):
-        if self._loggedin:
-            now = datetime.now()
-
-            # if too much time has passed since command was sent without a
-            # response, something is wrong
-            delta = now - self._lastcommand
-            if (self._lastcommandresponse < self._lastcommand and
-                    delta > timedelta(seconds=self._config.ENVISACOMMANDTIMEOUT)):
-                message = "Timed out waiting for command response, resetting connection..."
-                logging.error(message)
-                self._smartthings.send_error(message)
-                self.logout()
-                return
-
-            # is it time to poll again?
-            if self._config.ENVISAPOLLINTERVAL != 0:
-                delta = now - self._lastpoll
-                if (delta > timedelta(seconds=self._config.ENVISAPOLLINTERVAL) and
-                        not self._commandinprogress):
-                    self._lastpoll = now
-                    self.send_command('00', '')
-
-            # is it time to dump zone states again?
-            delta = now - self._lastzonedump
-            if (delta > timedelta(seconds=self._config.ENVISAZONEDUMPINTERVAL) and
-                    not self._commandinprogress):
-                self._lastzonedump = now
-                self.dump_zone_timers()
-
-            # if 10 seconds have passed and we haven't received a keypad update,
-            # something is wrong
-            delta = now - self._lastkeypadupdate
-            if delta > timedelta(seconds=self._config.ENVISAKPEVENTTIMEOUT):
-                # reset connection
-                message = "No recent keypad updates from envisalink, resetting connection..."
-                logging.error(message)
-                self._smartthings.send_error(message)
-                self.logout()
-                return
+    def start_watchdogs(self):
+        self._keypadwatchdog.reset(self._config.ENVISAKPEVENTTIMEOUT)
+        # dump zones and poll right away, then at the configured
+        # interval; the dump goes first as it reconciles restored state
+        self._zonedumpwatchdog.reset(0)
+        if self._config.ENVISAPOLLINTERVAL != 0:
+            self._pollwatchdog.reset(0)
+        self.reset_heartbeat()
+
+    def stop_watchdogs(self):
+        for watchdog in (self._commandwatchdog, self._keypadwatchdog,
+                         self._pollwatchdog, self._zonedumpwatchdog,
+                         self._heartbeatwatchdog, self._linkwatchdog):
+            watchdog.cancel()
+        self._debouncer.cancel_all()
+
+    # Push back the heartbeat, called whenever the link shows signs of life.
+    def reset_heartbeat(self):
+        interval = self._config.ENVISAHEARTBEATINTERVAL
+        if interval > 0 and self._loggedin:
+            self._heartbeatwatchdog.reset(interval)
+            self._linkwatchdog.reset(interval + self._config.ENVISAHEARTBEATTIMEOUT)
+
+    def heartbeat_due(self):
+        self.send_periodic_command('00')
+
+    def link_timed_out(self):
+        WATCHDOG_TIMEOUTS.labels('link').inc()
+        message = "Envisalink link is silent, resetting connection..."
+        logging.error(message)
+        self._smartthings.send_error(message)
+        self.logout()
+        # don't wait for the TCP close handshake on a dead link
+        if hasattr(self, 'transport'):
+            self.transport.abortConnection()
+
+    # if too much time has passed since command was sent without a
+    # response, something is wrong
+    def command_timed_out(self):
+        WATCHDOG_TIMEOUTS.labels('command').inc()
+        message = "Timed out waiting for command response, resetting connection..."
+        logging.error(message)
+        self._smartthings.send_error(message)
+        self.logout()
+
+    # if too much time has passed without a keypad update, something
+    # is wrong
+    def keypad_timed_out(self):
+        WATCHDOG_TIMEOUTS.labels('keypad').inc()
+        message = "No recent keypad updates from envisalink, resetting connection..."
+        logging.error(message)
+        self._smartthings.send_error(message)
+        self.logout()
+
+    def poll_due(self):
+        self._pollwatchdog.reset(self.poll_interval())
+        self.send_periodic_command('00')
+
+    def zone_dump_due(self):
+        self._zonedumpwatchdog.reset(self.zone_dump_interval())
+        self.send_periodic_command('02')
+
+    # True if zone state is worth refreshing quickly: a zone is open, or a
+    # partition is armed, in alarm, or in exit/entry delay.
+    def is_system_active(self):
+        for zone in self._state['zone'].values():
+            if zone['status'] == 'open':
+                return True
+        for partition in self._state['partition'].values():
+            if (partition['armed_away'] or partition['armed_stay'] or
+                    partition['armed_max'] or partition['alarm'] or
+                    partition['status'] == 'EXIT_ENTRY_DELAY'):
+                return True
+        return False
+
+    def is_system_idle(self):
+        return (not self._active and
+                self._clock.seconds() - self._lastactivity >= self._config.ENVISAIDLETIME)
+
+    def zone_dump_interval(self):
+        if self._active:
+            return self._config.ENVISAZONEDUMPMININTERVAL
+        if self.is_system_idle():
+            return self._config.ENVISAZONEDUMPMAXINTERVAL
+        return self._config.ENVISAZONEDUMPINTERVAL
+
+    def poll_interval(self):
+        if self.is_system_idle() and self._config.ENVISAPOLLIDLEINTERVAL > 0:
+            return self._config.ENVISAPOLLIDLEINTERVAL
+        return self._config.ENVISAPOLLINTERVAL
+
+    # Re-evaluate system activity after a state update, and pull in the
+    # next zone dump if it is scheduled further out than the active cadence.
+    def update_activity(self):
+        self._active = self.is_system_active()
+        if not self._active:
+            return
+        self._lastactivity = self._clock.seconds()
+        interval = self.zone_dump_interval()
+        remaining = self._zonedumpwatchdog.remaining()
+        if remaining is not None and remaining > interval:
+            logging.debug("System active, next zone dump in %d seconds", interval)
+            self._zonedumpwatchdog.reset(interval)
+
+    # send a command on behalf of a periodic timer, deferring it until the
+    # current command completes rather than dropping it.
+    def send_periodic_command(self, code):
+        if not self._loggedin:
+            return
+        if self._commandinprogress:
+            logging.debug("Command in progress, deferring command %s", code)
+            self._pendingcommands[code] = None
+            return
+        self.send_command(code, '')
 
     # application commands to the envisalink
 
@@ -229,10 +889,36 @@ class EnvisalinkClient(LineOnlyReceiver):
                           code)
             return
         self._commandinprogress = True
-        self._lastcommand = datetime.now()
+        self._commandowner = None
+        self._commandwatchdog.reset(self._config.ENVISACOMMANDTIMEOUT)
         to_send = '^' + code + ',' + data + '$'
         self.send_data(to_send)
 
+    def is_logged_in(self):
+        return self._loggedin
+
+    # Queue a command line from a TPI proxy client; its response is
+    # routed back to that client.
+    def forward_command(self, owner: 'TPIProxyClient', line: str):
+        if len(self._forwardqueue) == self._forwardqueue.maxlen:
+            logging.warning("Too many proxied commands queued, dropping %s", line)
+            return
+        self._forwardqueue.append((owner, line))
+        self.send_forwarded_command()
+
+    def send_forwarded_command(self):
+        if self._commandinprogress or not self._loggedin:
+            return
+        while self._forwardqueue:
+            owner, line = self._forwardqueue.popleft()
+            # skip commands from clients that have gone away
+            if owner in self._proxy.clients:
+                self._commandinprogress = True
+                self._commandowner = owner
+                self._commandwatchdog.reset(self._config.ENVISACOMMANDTIMEOUT)
+                self.send_data(line)
+                return
+
     def change_partition(self, partition_num):
         if partition_num < 1 or partition_num > 8:
             logging.error("Invalid Partition Number %d specified when trying "
@@ -254,25 +940,110 @@ class EnvisalinkClient(LineOnlyReceiver):
     # network communication callbacks
 
     def connectionMade(self):
-        logging.info("Connected to %s:%d" %
-                     (self._config.ENVISALINKHOST,
-                      self._config.ENVISALINKPORT))
+        peer = self.transport.getPeer()
+        logging.info("Connected to %s:%d", peer.host, peer.port)
+        if self._config.ENVISATCPKEEPALIVE > 0:
+            self.set_tcp_keepalive(self._config.ENVISATCPKEEPALIVE)
+
+    # Enable kernel keepalives so a dead peer is noticed even if the
+    # application heartbeat is disabled.  The idle time, probe interval
+    # and probe count knobs are only available on some platforms.
+    def set_tcp_keepalive(self, idle_seconds):
+        self.transport.setTcpKeepAlive(1)
+        sock = self.transport.getHandle()
+        for option, value in (('TCP_KEEPIDLE', idle_seconds),
+                              ('TCP_KEEPINTVL', max(1, idle_seconds // 3)),
+                              ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
 
     def connectionLost(self, reason):
+        self.stop_watchdogs()
+        self._backlog.clear()
+        if self._backlogcall is not None and self._backlogcall.active():
+            self._backlogcall.cancel()
+        self._backlogcall = None
+        if self._proxy is not None and self._proxy.upstream is self:
+            self._proxy.upstream = None
         if not SHUTTINGDOWN:
-            logging.info("Disconnected from %s:%d, reason was %s" %
-                         (self._config.ENVISALINKHOST,
-                          self._config.ENVISALINKPORT,
-                          reason.getErrorMessage()))
+            peer = self.transport.getPeer()
+            logging.info("Disconnected from %s:%d, reason was %s",
+                         peer.host, peer.port, reason.getErrorMessage())
             if self._loggedin:
                 self.logout()
 
+    # Lines from one read are admitted together: runs of redundant keypad
+    # updates are collapsed, then the rest are handled until the tick
+    # budget is spent.  Whatever is left waits for the next reactor
+    # iteration, with reading paused, so timers and writes still run
+    # during a storm of frames.
+    def dataReceived(self, data):
+        self._batch = []
+        try:
+            LineOnlyReceiver.dataReceived(self, data)
+        finally:
+            batch, self._batch = self._batch, None
+        if self._config.ENVISACOLLAPSEFRAMES and len(batch) > 1:
+            batch, collapsed = collapse_frames(batch)
+            if collapsed:
+                FRAMES_COLLAPSED.inc(collapsed)
+        self._backlog.extend(batch)
+        if self._backlogcall is None:
+            self.handle_backlog()
+
+    def handle_backlog(self):
+        self._backlogcall = None
+        budget = self._config.ENVISATICKBUDGET
+        deadline = time.perf_counter() + budget
+        while self._backlog:
+            if self.transport.disconnecting:
+                self._backlog.clear()
+                break
+            if budget > 0 and time.perf_counter() >= deadline:
+                FRAMES_DEFERRED.inc(len(self._backlog))
+                if not self._readpaused:
+                    self._readpaused = True
+                    self.transport.pauseProducing()
+                self._backlogcall = self._clock.callLater(0, self.handle_backlog)
+                return
+            line, rxtime = self._backlog.popleft()
+            try:
+                self.handle_line(line, rxtime)
+            except Exception:
+                # skip it like any invalid frame; raising would leave
+                # reading paused and the rest of the backlog unhandled
+                INVALID_FRAMES.inc()
+                logging.exception("Couldn't handle %r, skipping it", line)
+        if self._readpaused:
+            self._readpaused = False
+            self.transport.resumeProducing()
+
+    # Every line is captured, and TPI frames passed to proxy clients, as it
+    # arrives; it is handled once admitted.
     def lineReceived(self, input_bytes):
+        rxtime = time.monotonic()
+        self.lastrx = self._clock.seconds()
+        if self._capture is not None:
+            self._capture.record(input_bytes, self.lastrx)
+        self.reset_heartbeat()
+        if self._proxy is not None and input_bytes[:1] == b'%':
+            self.proxy_frame(input_bytes, '%')
+        if self._batch is not None:
+            self._batch.append((input_bytes, rxtime))
+        elif self._backlog:
+            self._backlog.append((input_bytes, rxtime))
+        else:
+            self.handle_line(input_bytes, rxtime)
+
+    def handle_line(self, input_bytes, rxtime):
+        self._rxtime = rxtime
         input_line = input_bytes.decode('ascii')
         if input_line != '':
             logging.debug('----------------------------------------')
-            logging.debug('RX < ' + input_line)
+            logging.debug('RX < %s', input_line)
             if input_line[0] in ("%", "^"):
+                if self._proxy is not None and input_line[0] == '^':
+                    self.proxy_frame(input_bytes, input_line[0])
                 # keep first sentinel char to tell difference between tpi and
                 # Envisalink command responses.  Drop the trailing $ sentinel.
                 input_list = input_line[0:-1].split(',')
@@ -286,7 +1057,8 @@ class EnvisalinkClient(LineOnlyReceiver):
             try:
                 handler = "handle_%s" % evl_ResponseTypes[code]['handler']
             except KeyError:
-                logging.warning('No handler defined for ' + code + ', skipping...')
+                logging.warning('No handler defined for %s, skipping...', code)
+                self.data_invalid()
                 return
 
             try:
@@ -294,9 +1066,41 @@ class EnvisalinkClient(LineOnlyReceiver):
             except AttributeError:
                 raise RuntimeError("Handler function doesn't exist")
 
+            handler_histogram = self.get_handler_histogram(code)
+            self._rxcode = code
+            start = time.perf_counter()
             handler_func(data)
+            handler_histogram.observe(time.perf_counter() - start)
             logging.debug('----------------------------------------')
 
+    # Pass a frame on to the TPI proxy clients: command responses to the
+    # client whose command it was, everything else to all of them.
+    def proxy_frame(self, input_bytes, sentinel):
+        if sentinel == '%':
+            if self._proxy.clients:
+                self._proxy.broadcast(input_bytes + self.delimiter)
+        elif self._commandowner is not None:
+            owner, self._commandowner = self._commandowner, None
+            self._proxy.route_response(owner, input_bytes + self.delimiter)
+
+    # per-code histogram children, looked up once per code
+    _handlerhistograms: Dict[str, Any] = {}
+
+    def get_handler_histogram(self, code):
+        histogram = self._handlerhistograms.get(code)
+        if histogram is None:
+            histogram = self._handlerhistograms[code] = HANDLER_SECONDS.labels(code)
+        return histogram
+
+    # Count a line with bad data, logging message if given.
+    def data_invalid(self, message=None):
+        INVALID_FRAMES.inc()
+        if message:
+            # logging an error dumps the flight recorder
+            logging.error(message)
+        else:
+            dump_flight_recorder('invalid frame')
+
     # Envisalink Response Handlers
 
     def handle_login(self, data):
@@ -305,6 +1109,11 @@ class EnvisalinkClient(LineOnlyReceiver):
     def handle_login_success(self, data):
         self._loggedin = True
         logging.info('Password accepted, session created')
+        self.start_watchdogs()
+        if self._proxy is not None:
+            self._proxy.upstream = self
+        if self.factory is not None:
+            self.factory.login_succeeded(self)
 
     def handle_login_failure(self, data):
         logging.error('Password is incorrect. Server is closing socket connection.')
@@ -314,25 +1123,32 @@ class EnvisalinkClient(LineOnlyReceiver):
                       'should never happen.  Server is closing socket connection')
 
     def handle_poll_response(self, code):
-        self._lastpollresponse = datetime.now()
+        self._lastpollresponse = self._clock.seconds()
         self.handle_command_response(code)
 
     def handle_command_response(self, code):
         self._commandinprogress = False
-        self._lastcommandresponse = datetime.now()
-        response_str = evl_TPI_Response_Codes[code]
-        logging.debug("Envisalink response: " + response_str)
+        self._commandwatchdog.cancel()
+        response_str = evl_TPI_Response_Codes.get(code, 'Unknown response ' + code)
+        logging.debug("Envisalink response: %s", response_str)
         if code != '00':
-            logging.error("error sending command to envisalink.  Response was: "
-                          + response_str)
+            logging.error("error sending command to envisalink.  Response was: %s",
+                          response_str)
+        if self._pendingcommands:
+            pending = next(iter(self._pendingcommands))
+            del self._pendingcommands[pending]
+            self.send_periodic_command(pending)
+        if self._forwardqueue:
+            self.send_forwarded_command()
 
     def handle_keypad_update(self, data):
-        self._lastkeypadupdate = datetime.now()
+        self._keypadwatchdog.reset(self._config.ENVISAKPEVENTTIMEOUT)
+        self._lastkeypadupdate = self._clock.seconds()
         data_list = data.split(',')
         # make sure data is in format we expect, current TPI seems to
         # send bad data every so ofen
         if len(data_list) != 5 or "%" in data:
-            logging.error("Data format invalid from Envisalink, ignoring...")
+            self.data_invalid("Data format invalid from Envisalink, ignoring...")
             return
 
         partition_num = int(data_list[0])
@@ -342,11 +1158,11 @@ class EnvisalinkClient(LineOnlyReceiver):
         beep = evl_Virtual_Keypad_How_To_Beep.get(data_list[3], 'unknown')
         alpha = data_list[4]
 
-        if partition_num not in ALARMSTATE['partition']:
+        if partition_num not in self._state['partition']:
             logging.debug("Skipping partition %d", partition_num)
             return
 
-            # TODO: update status text based on bitfield
+        # TODO: update status text based on bitfield
         # if (newStatus['alarm']):
         #     statusText == 'IN_ALARM'
         # elif (newStatus[
@@ -364,6 +1180,10 @@ class EnvisalinkClient(LineOnlyReceiver):
         #         'armed_stay': statusText == 'ARMED_STAY',
         #         'status': statusText
 
+        # Update zone status if the keypad is reporting a fault.
+        if alpha.startswith("FAULT") and not flags.ready:
+            self._debouncer.report(int(user_or_zone), 'open', SOURCE_KEYPAD)
+
         new_status = {
             'alarm': bool(flags.alarm),
             'alarm_in_memory': bool(flags.alarm_in_memory),
@@ -382,9 +1202,9 @@ class EnvisalinkClient(LineOnlyReceiver):
             'message': alpha
         }
 
-        now = datetime.now()
-        delta = now - self._lastpartitionupdate
-        if delta < timedelta(seconds=self._config.ENVISAKEYPADUPDATEINTERVAL):
+        now = self._clock.seconds()
+        if (self._lastpartitionupdate is not None and
+                now - self._lastpartitionupdate < self._config.ENVISAKEYPADUPDATEINTERVAL):
             logging.debug('Skipping keypad update within update interval')
         else:
             # We shouldn't have to skip keypad update during command in
@@ -393,37 +1213,80 @@ class EnvisalinkClient(LineOnlyReceiver):
                 logging.warning('Keypad update while command in progress')
             self._lastpartitionupdate = now
             logging.debug("keypad_update: zone %s status %s", user_or_zone, new_status)
-            # Update zone status if the keypad is reporting a fault.
-            if alpha.startswith("FAULT") and not flags.ready:
-                zone_number = int(user_or_zone)
-                self.update_zone_status(zone_number, "open")
             self.set_partition_status(partition_num, new_status)
+            self._statedirty = True
 
-            # Send update to SmartThings
-            self._smartthings.send_update(ALARMSTATE)
+        # Send update to SmartThings
+        self.flush_state()
 
-    def update_zone_status(self, zone_num: int, zone_status: str):
-        zone_name = self._config.ZONENAMES[zone_num]
+    # Send the state to SmartThings if it has changed since the last flush.
+    # Priority updates supersede anything still waiting to be sent.
+    # origin is the (code, monotonic time) of what caused the change, by
+    # default the frame being handled.
+    def flush_state(self, priority: bool = False, origin: Optional[Tuple[str, float]] = None):
+        if not self._statedirty:
+            return
+        self._statedirty = False
+        self.update_activity()
+        code, rx = origin if origin is not None else (self._rxcode, self._rxtime)
+        trace = TRACER.start(code, rx, priority, self._config.PANEL or 'default')
+        trace.mark('handled')
+        # only the zones and partitions changed since the last flush are
+        # copied; the snapshot is serialized off the reactor thread
+        snapshot = state_snapshot(self._state)
+        self._smartthings.send_update(snapshot, priority, trace)
+        if self.factory is not None:
+            self.factory.state_changed(snapshot)
+
+    def seconds_since_keypad_update(self):
+        if self._lastkeypadupdate is None:
+            return None
+        return self._clock.seconds() - self._lastkeypadupdate
+
+    def get_zone_status(self, zone_num: int):
+        zone = self._state['zone'].get(zone_num)
+        return zone['status'] if zone is not None else None
+
+    # Debouncer callback: a zone has settled in a new status.  Changes
+    # committed from a hold timer are sent right away, the rest go out
+    # with the handler's flush.
+    def zone_debounced(self, zone_num: int, zone_status: str,
+                       seconds_in_status: float, deferred: bool):
+        if self.update_zone_status(zone_num, zone_status, seconds_in_status):
+            self._statedirty = True
+        if deferred:
+            self.flush_state(origin=('debounce', time.monotonic()))
+
+    def update_zone_status(self, zone_num: int, zone_status: str,
+                           seconds_ago: float = 0):
+        zone_name = self._config.ZONENAMES.get(zone_num)
         # only bother to update if zone name is defined in config
         if not zone_name:
             return False
 
-        logmessage = ("%s (zone %i) is %s" % (zone_name, zone_num, zone_status))
-        logging.debug(logmessage)
-        status_changed = (ALARMSTATE['zone'][zone_num]['status'] != zone_status)
+        logging.debug("%s (zone %i) is %s", zone_name, zone_num, zone_status)
+        status_changed = (self._state['zone'][zone_num]['status'] != zone_status)
         if status_changed:
-            logging.info("zone state change: " + logmessage)
-            time_str = self.get_time_text()
-            ALARMSTATE['zone'][zone_num].update({
+            logging.info("zone state change: %s (zone %i) is %s",
+                         zone_name, zone_num, zone_status)
+            if self._history is not None:
+                self._history.record('zone', zone_num, zone_status)
+            time_str = self.get_time_text(seconds_ago)
+            self._state['zone'][zone_num].update({
                 'message': ("%s at %s" % (zone_status, time_str)),
-                'status': zone_status, 'closedSeconds': 0,
-                'lastChanged': time_str
+                'status': zone_status,
+                'closedSeconds': int(seconds_ago) if zone_status == 'closed' else 0,
+                'lastChanged': time_str,
+                'stale': False
             })
         return status_changed
 
     def handle_zone_state_change(self, data):
         # Envisalink TPI is inconsistent at generating these
-        logging.debug("handle_zone_state_change: data='%s'" % data)
+        logging.debug("handle_zone_state_change: data='%s'", data)
+        if not self.is_hex_data(data, 16):
+            self.data_invalid("Data format invalid from Envisalink, ignoring...")
+            return
 
         # Data is an 64-bit number in hex, little endian: 8 2-char bytes.
         le_hex = data
@@ -439,13 +1302,16 @@ class EnvisalinkClient(LineOnlyReceiver):
             zone_status = 'open' if zone_bit == '1' else 'closed'
 
             # zone_state_change will often continue reporting zones as
-            # open when they have already closed, so we ignore open
-            # zones here and instead rely on keypad update to tell us
-            # when zones are open.
-            if zone_status == 'closed':
-                self.update_zone_status(zone_num, zone_status)
+            # open when they have already closed; the debouncer ignores
+            # those opens unless the zone type is configured to trust them.
+            self._debouncer.report(zone_num, zone_status, SOURCE_ZONECHANGE)
+        self.flush_state()
 
     def handle_partition_state_change(self, data):
+        if len(data) != 16 or any(data[i:i + 2] not in evl_Partition_Status_Codes
+                                  for i in range(0, 16, 2)):
+            self.data_invalid("Data format invalid from Envisalink, ignoring...")
+            return
         self._has_partition_state_changed = True
         for currentIndex in range(0, 8):
             partition_num = currentIndex + 1
@@ -476,40 +1342,107 @@ class EnvisalinkClient(LineOnlyReceiver):
             logging.debug('partition %d status update: %s',
                           partition_num, new_status)
             self.set_partition_status(partition_num, new_status)
+        self.flush_state()
 
     def set_partition_status(self, partition_num, new_status):
-        status_map = ALARMSTATE['partition'][partition_num]
+        status_map = self._state['partition'][partition_num]
         # compute list of all keys that are different between old and new status.
         # message change doesn't count as a state change.
         key_diff = [key for key in new_status
                     if (new_status[key] != status_map[key] and
                         key not in ('message', 'status'))]
+        new_text = new_status.get('status', status_map['status'])
+        if self._history is not None and (key_diff or new_text != status_map['status']):
+            self._history.record('partition', partition_num, new_text, ','.join(key_diff))
         if len(key_diff) > 0:
-            logging.debug('Partition old status: ' + str(status_map))
+            # str() now: the map is updated before the record is written
+            logging.debug('Partition old status: %s', str(status_map))
+            self._statedirty = True
             status_map['lastChanged'] = self.get_time_text()
-            logging.debug('Partition state change: ' + str(status_map))
-            logging.debug('Partition key diff: ' + str(key_diff))
+            logging.debug('Partition state change: %s', str(status_map))
+            logging.debug('Partition key diff: %s', key_diff)
 
+        if status_map['stale']:
+            status_map['stale'] = False
+            self._statedirty = True
         status_map.update(new_status)
         logging.debug('Partition %d status: %s', partition_num, str(new_status))
         if status_map['ready']:
             # close all zones and send a zone status update if necessary
-            for zoneNumber, zoneInfo in list(ALARMSTATE['zone'].items()):
-                self.update_zone_status(zoneNumber, 'closed')
+            for zoneNumber in list(self._state['zone'].keys()):
+                self._debouncer.report(zoneNumber, 'closed', SOURCE_KEYPAD)
 
+    # Contact ID events are the panel's own report of alarms, troubles and
+    # arming, so they are applied and sent as soon as they arrive rather
+    # than waiting for the next keypad update.
     def handle_realtime_cid_event(self, data):
-        event_type_int = int(data[0])
-        event_type = evl_CID_Qualifiers[event_type_int]
-        cid_event_int = int(data[1:4])
-        cid_event = evl_CID_Events[cid_event_int]
-        partition = data[4:6]
-        zone_or_user = int(data[6:9])
-
-        logging.debug('Event Type is ' + event_type)
-        logging.debug('CID Type is ' + cid_event['type'])
-        logging.debug('CID Description is ' + cid_event['label'])
-        logging.debug('Partition is ' + partition)
-        logging.debug(cid_event['type'] + ' value is ' + str(zone_or_user))
+        event = decode_cid_event(data)
+        if event is None:
+            self.data_invalid()
+            return
+        logging.info("CID event: %s %s (%d) partition %d zone %s user %s",
+                     event.qualifier, event.label, event.code, event.partition,
+                     event.zone, event.user)
+        self.apply_cid_event(event)
+        self.flush_state(priority=True)
+
+    def apply_cid_event(self, event: CIDEvent):
+        category = event.category
+        # "still present" reports count as the condition being active
+        active = event.qualifier != QUALIFIER_RESTORE
+        new_status: Dict[str, Any] = {}
+
+        if category in (CATEGORY_ALARM, CATEGORY_FIRE):
+            # a restore means the zone is back to normal, but the
+            # partition stays in alarm until it is disarmed
+            if active:
+                new_status['alarm'] = True
+                if category == CATEGORY_FIRE:
+                    new_status['fire'] = True
+                    new_status['alarm_fire'] = True
+                self._statedirty = True
+        elif category == CATEGORY_TROUBLE:
+            new_status['system_trouble'] = active
+        elif category == CATEGORY_AC_POWER:
+            new_status['ac_present'] = not active
+        elif category == CATEGORY_LOW_BATTERY:
+            new_status['low_battery'] = active
+        elif category in (CATEGORY_ARM_AWAY, CATEGORY_ARM_STAY):
+            # an opening is a disarm, a closing is an arm
+            if active:
+                new_status.update({'armed_away': False, 'armed_stay': False,
+                                   'armed_max': False, 'alarm': False,
+                                   'lastDisarmedBy': self.get_user_name(event.user)})
+            else:
+                armed_key = 'armed_away' if category == CATEGORY_ARM_AWAY else 'armed_stay'
+                new_status.update({armed_key: True, 'ready': False,
+                                   'lastArmedBy': self.get_user_name(event.user)})
+        elif category == CATEGORY_CANCEL:
+            new_status.update({'alarm': False,
+                               'lastDisarmedBy': self.get_user_name(event.user)})
+        elif category == CATEGORY_BYPASS:
+            new_status['bypass'] = active
+
+        # partition 0 is the whole system, e.g. AC power or the battery
+        if event.partition == 0:
+            partitions = list(self._state['partition'])
+        else:
+            partitions = [event.partition] if event.partition in self._state['partition'] else []
+        if new_status:
+            for partition_num in partitions:
+                self.set_partition_status(partition_num, new_status)
+
+        if event.zone is not None and category in (CATEGORY_ALARM, CATEGORY_FIRE):
+            self._debouncer.report(event.zone, 'open' if active else 'closed',
+                                   SOURCE_CID)
+
+    def get_user_name(self, user_num):
+        if user_num is None:
+            return ''
+        return self._config.ALARMUSERNAMES.get(user_num) or ('user %d' % user_num)
+
+    def is_hex_data(self, data, length):
+        return len(data) == length and HEXDATA.fullmatch(data) is not None
 
     # returns the current time in a human-readable format, optionally
     # offset by a number of seconds.
@@ -520,36 +1453,29 @@ class EnvisalinkClient(LineOnlyReceiver):
     # note that a request to dump zone timers generates both a standard command
     # response (handled elsewhere) as well as this event
     def handle_zone_timer_dump(self, zone_dump):
+        if not self.is_hex_data(zone_dump, 256):
+            self.data_invalid("Data format invalid from Envisalink, ignoring...")
+            return
         zone_info_array = self.convert_zone_dump(zone_dump)
+        zones = self._state['zone']
         for zone_number, zone_info in enumerate(zone_info_array, start=1):
-            zone_name = self._config.ZONENAMES[zone_number]
-
-            # skip zones we don't care about or that haven't changed state
-            if (not zone_name or
-                    ALARMSTATE['zone'][zone_number]['status'] == zone_info['status']):
-                continue
-
-            log_message = ("%s (zone %i) %s" % (zone_name, zone_number, zone_info))
-
-            # Set lastChanged time to closedSeconds, which is 0 if open.
-            zone_info['lastChanged'] = self.get_time_text(
-                seconds_ago=zone_info['closedSeconds'])
-
-            # zone dumps seem to be buggy and falsely report zone
-            # closed; leave an error margin of 60 seconds before
-            # closing a zone.
-            if (zone_info['status'] == 'closed' and
-                    zone_info['closedSeconds'] < 60):
-                logging.debug("ignoring zone status dump state "
-                              "change under 60 seconds: " + log_message)
-            else:
-                # update zone state
-                logging.info("zone state change: " + log_message)
-                ALARMSTATE['zone'][zone_number].update(zone_info)
+            # zone dumps seem to be buggy and falsely report zones
+            # closed; the debouncer only accepts a dump close once the
+            # zone has been closed for the type's dump margin.
+            self._debouncer.report(zone_number, zone_info['status'],
+                                   SOURCE_ZONEDUMP, zone_info['closedSeconds'])
+            # a restored zone is current once the dump confirms its
+            # status; zones the dump doesn't cover, or whose close is
+            # still held back, stay stale
+            zone = zones.get(zone_number)
+            if zone is not None and zone['stale'] and zone['status'] == zone_info['status']:
+                zone['stale'] = False
+                self._statedirty = True
+        self.flush_state()
 
     # convert a zone dump into something humans can make sense of
     def convert_zone_dump(self, raw_string):
-        logging.debug("converting zone dump, raw string='%s'" % raw_string)
+        logging.debug("converting zone dump, raw string='%s'", raw_string)
         return_items = []
 
         # every four characters
@@ -586,8 +1512,8 @@ class EnvisalinkClient(LineOnlyReceiver):
                 item_last_closed = "Last Closed " + item_last_closed
                 status = 'closed'
 
-            logging.debug("zone dump: index=%d raw='%s' swapped='%s' int=%d" %
-                          (len(return_items), inputItem, item_hex_string, item_int))
+            logging.debug("zone dump: index=%d raw='%s' swapped='%s' int=%d",
+                          len(return_items), inputItem, item_hex_string, item_int)
 
             return_items.append({'message': item_last_closed, 'status': status,
                                  'closedSeconds': item_seconds})
@@ -632,75 +1558,209 @@ class EnvisalinkClient(LineOnlyReceiver):
 
 
 class AlarmServer(Resource):
-    def __init__(self, in_config):
+    # config_loader reads the config again on reload, by default from the
+    # same file.
+    def __init__(self, in_config, config_loader: Optional[Callable[[], AlarmServerConfig]] = None):
         Resource.__init__(self)
+        self._config_loader = config_loader or (
+            lambda: AlarmServerConfig(self._config.CONFIGFILE))
 
         self._triggerid = reactor.addSystemEventTrigger('before', 'shutdown',
                                                         self.shutdown_event)
 
-        # Create Envisalink client connection
-        self._envisalinkClientFactory = EnvisalinkClientFactory(in_config)
-        self._envisaconnect = reactor.connectTCP(in_config.ENVISALINKHOST,
-                                                 in_config.ENVISALINKPORT,
-                                                 self._envisalinkClientFactory)
+        # Create an Envisalink client connection for each panel, or just
+        # the one configured in [envisalink] using ALARMSTATE
+        SENDER_POOL.configure(in_config.SENDERTHREADS)
+        self.factories: List[EnvisalinkClientFactory] = []
+        if in_config.PANELS:
+            for panel in in_config.PANELS:
+                panel_config = in_config.panel_config(panel)
+                self.factories.append(EnvisalinkClientFactory(
+                    panel_config, panel_config.initialize_alarmstate({})))
+            logging.info("Connecting to %d panels", len(self.factories))
+        else:
+            self.factories.append(EnvisalinkClientFactory(in_config))
+        self._connectors = [factory.connect() for factory in self.factories]
+
+        REGISTRY.callback_gauge(
+            'alarmserver_keypad_update_age_seconds',
+            'Seconds since the last keypad update from the Envisalink, '
+            'the oldest of any panel',
+            self.seconds_since_keypad_update)
 
         # Store config
         self._config = in_config
+        TRACER.configure(in_config.TRACESAMPLE, in_config.TRACEBUFFER)
+
+        self.lagmonitor: Optional[LagMonitor] = None
+        if in_config.LAGINTERVAL > 0:
+            self.lagmonitor = LagMonitor(in_config.LAGINTERVAL, in_config.LAGTHRESHOLD,
+                                         in_config.LAGOFFENDERS)
+            reactor.callWhenRunning(self.lagmonitor.start)
+
+        self.profiler = Profiler(in_config.PROFILEDIR, in_config.PROFILESECONDS,
+                                 in_config.PROFILEMODE)
 
     def shutdown_event(self):
         global SHUTTINGDOWN
         SHUTTINGDOWN = True
         logging.debug("Disconnecting from Envisalink...")
-        self._envisaconnect.disconnect()
+        for connector in self._connectors:
+            connector.disconnect()
+        for factory in self.factories:
+            factory.close_capture()
+            factory.close_history()
+            factory.close_snapshot()
+        return defer.DeferredList([factory.close_mqtt() for factory in self.factories])
+
+    # Re-read the config and apply it to every panel without dropping
+    # their sessions.  Options that are only read at startup, including
+    # the list of panels, keep their old values until a restart.
+    def reload(self) -> Dict[str, Any]:
+        old = self._config
+        try:
+            if old.CONFIGFILE is not None and not os.path.isfile(old.CONFIGFILE):
+                raise ValueError('Config file %s not found' % old.CONFIGFILE)
+            config = self._config_loader()
+        except (OSError, ValueError) as err:
+            logging.error("Not reloading config: %s", str(err))
+            return {'error': str(err)}
+
+        restart = [name for name in old.changes(config) if name in config.RESTART_OPTIONS]
+        if restart:
+            logging.warning("Config options %s changed; restart to apply them", ', '.join(restart))
+        available = set(config.PANELS)
+        config = config.replace(PANELS=old.PANELS)
+        self._config = config
+        TRACER.configure(config.TRACESAMPLE, config.TRACEBUFFER)
+        self.profiler.configure(config.PROFILEDIR, config.PROFILESECONDS, config.PROFILEMODE)
+
+        panels = []
+        for factory in self.factories:
+            if not config.PANELS:
+                panels.append(factory.reconfigure(config))
+            elif factory.name in available:
+                panels.append(factory.reconfigure(config.panel_config(factory.name)))
+        for summary in panels:
+            logging.info("Reloaded config for %s: %d options changed, %d zones or partitions "
+                         "added, %d removed, %d renamed%s", summary['panel'],
+                         len(summary['changed']), len(summary['added']), len(summary['removed']),
+                         len(summary['renamed']), ', reconnecting' if summary['reconnect'] else '')
+        return {'restart': restart, 'panels': panels}
+
+    def panel_states(self) -> Dict[str, AlarmState]:
+        return {factory.name: factory._state for factory in self.factories}
+
+    def seconds_since_keypad_update(self):
+        ages = [age for age in (factory.seconds_since_keypad_update()
+                                for factory in self.factories)
+                if age is not None]
+        return max(ages, default=None)
 
     def getChild(self, name, request):
         return self
 
 
-def usage():
-    print('Usage: ' + sys.argv[0] + ' -c <configfile>')
+class StateResource(Resource):
+    """The alarm state of every panel, by panel name."""
+    isLeaf = True
 
+    def __init__(self, alarm_server: AlarmServer):
+        Resource.__init__(self)
+        self._alarm_server: AlarmServer = alarm_server
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self._alarm_server.panel_states()).encode('utf-8')
 
-def main(argv):
-    try:
-        opts, args = getopt.getopt(argv, "hc:", ["help", "config="])
-    except getopt.GetoptError:
-        usage()
-        sys.exit(2)
-    for opt, arg in opts:
-        if opt in ("-h", "--help"):
-            usage()
-            sys.exit()
-        elif opt in ("-c", "--config"):
-            global conffile
-            conffile = arg
+
+class ReloadResource(Resource):
+    """POST re-reads the config, like SIGHUP, and returns what changed."""
+    isLeaf = True
+
+    def __init__(self, alarm_server: AlarmServer):
+        Resource.__init__(self)
+        self._alarm_server: AlarmServer = alarm_server
+
+    def render_POST(self, request):
+        result = self._alarm_server.reload()
+        if 'error' in result:
+            request.setResponseCode(400)
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(result, indent=2).encode('utf-8')
+
+
+# Serve /metrics, /state, /traces, /lag, /profile and /reload on the
+# local admin port, or on a unix socket for a supervisor.
+def start_admin_server(in_config: AlarmServerConfig, root: AlarmServer,
+                       socket_path: Optional[str] = None):
+    # only needed with an admin server, so not imported at startup
+    from twisted.web.server import Site
+
+    root.putChild(b'metrics', MetricsResource(REGISTRY))
+    root.putChild(b'state', StateResource(root))
+    root.putChild(b'traces', TracesResource(TRACER))
+    if root.lagmonitor is not None:
+        root.putChild(b'lag', LagResource(root.lagmonitor))
+    root.putChild(b'profile', ProfileResource(root.profiler))
+    root.putChild(b'reload', ReloadResource(root))
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            # left behind by a worker that crashed
+            os.unlink(socket_path)
+        port = reactor.listenUNIX(socket_path, Site(root))
+        logging.info("Admin server listening on %s", socket_path)
+        return port
+    port = reactor.listenTCP(in_config.ADMINPORT, Site(root),
+                             interface=in_config.ADMININTERFACE)
+    logging.info("Admin server listening on %s:%d",
+                 in_config.ADMININTERFACE, in_config.ADMINPORT)
+    return port
 
 
 if __name__ == "__main__":
-    conffile = 'alarmserver.cfg'
-    main(sys.argv[1:])
+    # also used to reload the config, keeping any --panels
+    def load_config() -> AlarmServerConfig:
+        config = AlarmServerConfig(conffile)
+        if panels is not None:
+            config = config.replace(PANELS=tuple(panels))
+        return config
 
     print('Using configuration file %s' % conffile)
-    alarm_config = AlarmServerConfig(conffile)
-    loggingconfig: Dict[str, Any] = {
-        'level': alarm_config.LOGLEVEL,
-        'format': '%(asctime)s %(levelname)s <%(name)s %(module)s %(funcName)s> %(message)s',
-        'datefmt': '%Y-%m-%d %H:%M:%S'}
-    if alarm_config.LOGFILE != '':
-        loggingconfig['filename'] = alarm_config.LOGFILE
-    logging.basicConfig(**loggingconfig)
+    try:
+        alarm_config = load_config()
+    except ValueError as err:
+        print(str(err))
+        sys.exit(2)
+    configure_logging(alarm_config.LOGLEVEL, alarm_config.LOGFILE, alarm_config.LOGFORMAT,
+                      alarm_config.FLIGHTRECORDER)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
     logging.info('AlarmServer Starting')
     logging.info('Tested on a Honeywell Vista 20p + EVL-4')
+    runtime.log_runtime()
+    for section, variable, default in alarm_config.DEFAULTED:
+        logging.info("Config option %s not set in [%s] defaulting to: '%s'",
+                     variable, section, default)
 
     # allow Twisted to hook into our logging
     observer = log.PythonLoggingObserver()
     observer.start()
 
     alarm_config.initialize_alarmstate()
-    alarm_server = AlarmServer(alarm_config)
+    alarm_server = AlarmServer(alarm_config, load_config)
+    if adminsocket is not None:
+        start_admin_server(alarm_config, alarm_server, adminsocket)
+    elif alarm_config.ADMINPORT:
+        start_admin_server(alarm_config, alarm_server)
+    if hasattr(signal, 'SIGUSR1'):
+        # the handler only schedules the toggle so it runs between reactor callbacks
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: reactor.callFromThread(alarm_server.profiler.toggle))
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: reactor.callFromThread(alarm_server.reload))
 
     try:
         reactor.run()
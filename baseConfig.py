@@ -1,34 +1,133 @@
 import configparser
+import copy
+from types import MappingProxyType
+from typing import Dict, List, Optional, Tuple
+
+# option name -> value for each section of a config file
+Sections = Dict[str, Dict[str, str]]
+
+
+# Parse configfile into a dict per section, in one pass.
+def read_sections(configfile) -> Sections:
+    parser = configparser.ConfigParser()
+    parser.read(configfile)
+    return {section: dict(parser.items(section)) for section in parser.sections()}
+
+
+# Convert a config value the way ConfigParser.getboolean does.
+def _boolean(text: str) -> bool:
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[text.lower()]
+    except KeyError:
+        raise ValueError(text) from None
 
 
 class BaseConfig(object):
-    def __init__(self, configfile):
-        self._config = configparser.SafeConfigParser()
-        self._config.read(configfile)
+    # Options are looked up in the sections parsed once from the file;
+    # a missing option is a dict miss rather than a caught exception.
+    # A panel's config reads options from [section:panel] before falling
+    # back to [section], sharing the sections of the main config.
+    #
+    # Subclasses call freeze() once every option has been read, after
+    # which the config can't be changed, nor can the dicts and lists it
+    # holds; replace() makes a changed copy.
+    def __init__(self, configfile, panel: Optional[str] = None,
+                 sections: Optional[Sections] = None):
+        if sections is None:
+            sections = read_sections(configfile)
+        self._sections: Sections = sections
+        # the file to re-read on reload; None for a panel's config
+        self.CONFIGFILE: Optional[str] = configfile
+        self.PANEL: Optional[str] = panel
+        # (section, option, default) for each option not set, logged at
+        # startup once logging is configured
+        self.DEFAULTED: List[Tuple[str, str, str]] = []
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError('config is immutable, use replace() to change %s' % name)
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        for name, value in list(vars(self).items()):
+            if not name.isupper():
+                continue
+            if isinstance(value, dict):
+                object.__setattr__(self, name, MappingProxyType(value))
+            elif isinstance(value, list):
+                object.__setattr__(self, name, tuple(value))
+        self._frozen = True
+
+    # A copy of this config with the given attributes changed.
+    def replace(self, **changes):
+        changed = copy.copy(self)
+        for name, value in changes.items():
+            object.__setattr__(changed, name, value)
+        return changed
+
+    # Names of the options whose values differ in other.
+    def changes(self, other: 'BaseConfig') -> List[str]:
+        mine, theirs = vars(self), vars(other)
+        return [name for name in sorted(mine)
+                if name.isupper() and name not in ('CONFIGFILE', 'DEFAULTED')
+                and mine[name] != theirs.get(name)]
+
+    def _lookup(self, section: str, variable: str) -> Optional[str]:
+        if self.PANEL is not None:
+            value = self._sections.get(section + ':' + self.PANEL, {}).get(variable)
+            if value is not None:
+                return value
+        return self._sections.get(section, {}).get(variable)
 
     def _defaulting(self, section: str, variable: str, default: str, quiet=False):
-        if quiet is False:
-            # can't use logging because we parse config before initializing logging
-            print('Config option %s not set in [%s] defaulting to: \'%s\'' %
-                  (variable, section, default))
+        # defaults were already reported for the main config
+        if quiet is False and self.PANEL is None:
+            self.DEFAULTED.append((section, variable, default))
 
-    def get_str(self, section: str, variable: str, default: str, quiet: bool = False) -> str:
+    def _convert(self, section: str, variable: str, value: str, convert, kind: str):
         try:
-            return self._config.get(section, variable)
-        except (configparser.NoSectionError, configparser.NoOptionError):
+            return convert(value)
+        except ValueError:
+            raise ValueError('Config option %s in [%s] is not %s: \'%s\'' %
+                             (variable, section, kind, value)) from None
+
+    def get_str(self, section: str, variable: str, default: str, quiet: bool = False) -> str:
+        value = self._lookup(section, variable)
+        if value is None:
             self._defaulting(section, variable, default, quiet)
             return default
+        return value
 
     def get_int(self, section: str, variable: str, default: int, quiet: bool = False) -> int:
-        try:
-            return self._config.getint(section, variable)
-        except (configparser.NoSectionError, configparser.NoOptionError):
+        value = self._lookup(section, variable)
+        if value is None:
             self._defaulting(section, variable, str(default), quiet)
             return default
+        return self._convert(section, variable, value, int, 'an integer')
+
+    def get_float(self, section: str, variable: str, default: float, quiet: bool = False) -> float:
+        value = self._lookup(section, variable)
+        if value is None:
+            self._defaulting(section, variable, str(default), quiet)
+            return default
+        return self._convert(section, variable, value, float, 'a number')
 
     def get_bool(self, section: str, variable: str, default: bool, quiet: bool = False) -> bool:
-        try:
-            return self._config.getboolean(section, variable)
-        except (configparser.NoSectionError, configparser.NoOptionError):
+        value = self._lookup(section, variable)
+        if value is None:
             self._defaulting(section, variable, str(default), quiet)
             return default
+        return self._convert(section, variable, value, _boolean, 'true or false')
+
+    # Every option named prefix<N> in section, e.g. zone1 ... zone128,
+    # found in one pass over the options that are actually set.
+    def get_numbered(self, section: str, prefix: str, maximum: int) -> Dict[int, str]:
+        options = dict(self._sections.get(section, {}))
+        if self.PANEL is not None:
+            options.update(self._sections.get(section + ':' + self.PANEL, {}))
+        numbered = {}
+        for variable, value in options.items():
+            number = variable[len(prefix):]
+            if variable.startswith(prefix) and number.isdigit() and 1 <= int(number) <= maximum:
+                numbered[int(number)] = value
+        return numbered
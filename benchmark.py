@@ -0,0 +1,787 @@
+#!/usr/bin/python3
+# AlarmServer benchmarks
+#
+# Microbenchmarks for the parse -> state -> serialize path, and an end
+# to end run from simulated TPI frames to local stand-ins for the
+# SmartThings api and an MQTT broker.  Results are written as JSON with stable keys so
+# runs can be compared across commits.
+#
+# This code is under the terms of the GPL v3 license.
+
+import getopt
+import http.server
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import urllib.request
+from typing import Any, Dict, List
+
+# installs the reactor chosen by ALARMSERVER_RUNTIME
+import runtime
+
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import alarmserver
+import mqttpublisher
+import smartthings
+from statestore import SnapshotEncoder, state_snapshot
+from tpisimulator import (ALARM_MIX, PanelModel, SimulatorFactory, SimulatorSettings,
+                          random_frame)
+
+# zone used to measure event-to-post latency; the simulator's random
+# traffic only touches the zones below it
+PROBE_ZONE = 100
+SIMULATED_ZONES = 64
+
+KEYPAD_READY = b'%00,01,1C08,08,00,****DISARMED****  Ready to Arm  $'
+KEYPAD_FAULT = b'%00,01,0008,03,00,FAULT 03 ZONE 3                 $'
+ZONE_CHANGE = b'%01,0400000000000000$'
+PARTITION_CHANGE = b'%02,0100000000000000$'
+
+
+def write_config(directory: str, callback_port: int = 0, envisalink_port: int = 4025,
+                 mqtt_port: int = 0, sender: str = 'thread') -> str:
+    lines = ['[alarmserver]', 'partition1=Home']
+    lines += ['zone%d=Zone %d' % (i, i) for i in range(1, alarmserver.MAXZONES + 1)]
+    lines += ['[envisalink]', 'host=127.0.0.1', 'port=%d' % envisalink_port,
+              'pass=user', 'keypadupdateinterval=0',
+              '[smartthings]',
+              'callbackurl_base=http://127.0.0.1:%d' % callback_port,
+              'callbackurl_app_id=bench', 'callbackurl_access_token=bench',
+              'repeat_update_interval=0', 'queue_size=1000', 'sender=' + sender,
+              'ratelimit=0']
+    if mqtt_port:
+        lines += ['[mqtt]', 'host=127.0.0.1', 'port=%d' % mqtt_port]
+    filename = os.path.join(directory, 'benchmark.cfg')
+    with open(filename, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+    return filename
+
+
+def write_panels_config(directory: str, panels: int, api_port: int = 0) -> str:
+    names = ['site%d' % i for i in range(1, panels + 1)]
+    lines = ['[alarmserver]', 'panels=' + ','.join(names),
+             '[envisalink]', 'host=127.0.0.1', 'pass=user', 'keypadupdateinterval=0',
+             '[smartthings]', 'callbackurl_base=http://127.0.0.1:%d' % api_port]
+    for name in names:
+        lines += ['[alarmserver:%s]' % name, 'partition1=Home']
+        lines += ['zone%d=Zone %d' % (i, i) for i in range(1, SIMULATED_ZONES + 1)]
+        lines += ['[envisalink:%s]' % name, 'pass=%s' % name]
+    filename = os.path.join(directory, 'panels.cfg')
+    with open(filename, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+    return filename
+
+
+# Panels for supervisor.py to shard, spread over the simulators' ports,
+# with the supervisor's admin port.
+def write_supervisor_config(directory: str, panels: int, simulator_ports: List[int],
+                            admin_port: int) -> str:
+    names = ['site%d' % i for i in range(1, panels + 1)]
+    lines = ['[alarmserver]', 'panels=' + ','.join(names), 'loglevel=ERROR',
+             'adminport=%d' % admin_port,
+             '[envisalink]', 'host=127.0.0.1', 'pass=user', 'keypadupdateinterval=0',
+             '[smartthings]', 'callbackurl_base=http://127.0.0.1:0']
+    for index, name in enumerate(names):
+        lines += ['[alarmserver:%s]' % name, 'partition1=Home']
+        lines += ['zone%d=Zone %d' % (i, i) for i in range(1, SIMULATED_ZONES + 1)]
+        lines += ['[envisalink:%s]' % name,
+                  'port=%d' % simulator_ports[index % len(simulator_ports)]]
+    filename = os.path.join(directory, 'supervisor.cfg')
+    with open(filename, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+    return filename
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+####
+# Microbenchmarks
+
+
+class NullSmartThings:
+    """Stands in for SmartThings so microbenchmarks measure only our code."""
+
+    def send_update(self, alarmserver_state, priority=False, trace=None):
+        pass
+
+    def send_error(self, error_state):
+        pass
+
+
+def time_call(func, number: int, repeat: int) -> Dict[str, float]:
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return {'usec_per_op': round(best / number * 1e6, 3),
+            'ops_per_sec': round(number / best, 1)}
+
+
+def run_microbenchmarks(config_file: str, number: int, repeat: int) -> Dict[str, Any]:
+    config = alarmserver.AlarmServerConfig(config_file)
+    config.initialize_alarmstate()
+    client = alarmserver.EnvisalinkClient(config, NullSmartThings())
+    client.makeConnection(StringTransport())
+    panel = PanelModel(SIMULATED_ZONES)
+    panel.open_zones.update({3, 17, 42})
+    zone_dump = panel.zone_dump_frame()[4:-1]
+    ready_status = dict(alarmserver.ALARMSTATE['partition'][1], ready=True)
+    fault_data = KEYPAD_FAULT.decode('ascii')[4:-1]
+
+    results = {
+        'lineReceived_keypad': time_call(lambda: client.lineReceived(KEYPAD_READY),
+                                         number, repeat),
+        'lineReceived_zone_change': time_call(lambda: client.lineReceived(ZONE_CHANGE),
+                                              number, repeat),
+        'lineReceived_partition_change': time_call(
+            lambda: client.lineReceived(PARTITION_CHANGE), number, repeat),
+        'handle_keypad_update': time_call(lambda: client.handle_keypad_update(fault_data),
+                                          number, repeat),
+        'handle_zone_state_change': time_call(
+            lambda: client.handle_zone_state_change('0400000000000000'), number, repeat),
+        'convert_zone_dump': time_call(lambda: client.convert_zone_dump(zone_dump),
+                                       number, repeat),
+        'set_partition_status': time_call(
+            lambda: client.set_partition_status(1, ready_status), number, repeat),
+        'json_dumps_state': time_call(lambda: json.dumps(alarmserver.ALARMSTATE),
+                                      number, repeat),
+    }
+
+    # what flush_state and the sender do per update instead: snapshot the
+    # state after one partition changed, then encode the snapshot
+    partition = alarmserver.ALARMSTATE['partition'][1]
+    encoder = SnapshotEncoder()
+
+    def touch_and_snapshot():
+        partition['status'] = partition['status']
+        return state_snapshot(alarmserver.ALARMSTATE)
+
+    results['state_snapshot'] = time_call(touch_and_snapshot, number, repeat)
+    results['encode_snapshot'] = time_call(lambda: encoder.encode(touch_and_snapshot()),
+                                           number, repeat)
+    # per-line cost of the metrics recorded by lineReceived, relative
+    # to handling a keypad line
+    handler_histogram = client.get_handler_histogram('%00')
+
+    def record_line_metrics():
+        start = time.perf_counter()
+        handler_histogram.observe(time.perf_counter() - start)
+    overhead = time_call(record_line_metrics, number * 10, repeat)
+    overhead['percent_of_line'] = round(
+        100.0 * overhead['usec_per_op'] / results['lineReceived_keypad']['usec_per_op'], 3)
+    results['metrics_overhead'] = overhead
+
+    client.stop_watchdogs()
+    return results
+
+
+####
+# Multi-panel
+
+
+class ApiServerStandIn(http.server.BaseHTTPRequestHandler):
+    """Accepts api posts for the multi-panel run, on its own thread."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+# Per-panel memory and CPU for panels in one process, each built by its
+# own EnvisalinkClientFactory with the real SmartThings sender and fed
+# the same mix of frames.  Memory covers the factory, client, state and
+# sender, and the api threads' objects but not their stacks.
+# cpu_usec_per_frame is the reactor thread's share; process_cpu also
+# counts the api threads until the queues drain, and the stand-in api
+# server.
+def run_panels(directory: str, panels: int, frames: int) -> Dict[str, Any]:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ApiServerStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = alarmserver.AlarmServerConfig(
+        write_panels_config(directory, panels, server.server_address[1]))
+    smartthings.SENDER_POOL.configure(config.SENDERTHREADS)
+    threads = threading.active_count()
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    factories = []
+    clients = []
+    for panel in config.PANELS:
+        panel_config = config.panel_config(panel)
+        factory = alarmserver.EnvisalinkClientFactory(
+            panel_config, panel_config.initialize_alarmstate({}))
+        client = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', 4025))
+        client.makeConnection(StringTransport())
+        client.handle_login_success('')
+        factories.append(factory)
+        clients.append(client)
+    setup_seconds = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+    threads = threading.active_count() - threads
+
+    model = PanelModel(SIMULATED_ZONES)
+    model.open_zones.update({3, 17, 42})
+    sample = [model.keypad_frame(), model.keypad_frame(), model.keypad_frame(),
+              model.zone_change_frame(), model.partition_frame(), model.zone_dump_frame()]
+    lines = [frame.encode('ascii') for frame in sample]
+    start = time.thread_time()
+    start_process = time.process_time()
+    for index in range(frames):
+        line = lines[index % len(lines)]
+        for client in clients:
+            client.lineReceived(line)
+    cpu_seconds = time.thread_time() - start
+    deadline = time.monotonic() + 30
+    while (time.monotonic() < deadline and
+           not all(factory._smartthings.idle() for factory in factories)):
+        time.sleep(0.01)
+    process_seconds = time.process_time() - start_process
+
+    for client in clients:
+        client.stop_watchdogs()
+    smartthings.SENDER_POOL.stop()
+    server.shutdown()
+    return {
+        'panels': panels,
+        'frames_per_panel': frames,
+        'sender_threads': threads,
+        'bytes_per_panel': memory // panels,
+        'setup_ms_per_panel': round(setup_seconds / panels * 1000, 3),
+        'cpu_usec_per_frame': round(cpu_seconds / (frames * panels) * 1e6, 3),
+        'process_cpu_usec_per_frame': round(process_seconds / (frames * panels) * 1e6, 3),
+    }
+
+
+####
+# Alarm storm
+
+
+class CountingSmartThings(NullSmartThings):
+    def __init__(self):
+        self.updates: int = 0
+
+    def send_update(self, alarmserver_state, priority=False, trace=None):
+        self.updates += 1
+
+
+# Reads of frames_per_read lines of the traffic tpisimulator.py --alarm
+# sends, handled with and without collapsing repeated keypad updates.
+# The tick budget is in force for both; max_tick_ms is the longest the
+# client held the reactor in one read or backlog call.
+def run_storm(config_file: str, reads: int, frames_per_read: int) -> Dict[str, Any]:
+    random.seed(1)
+    model = PanelModel(SIMULATED_ZONES)
+    model.open_zones.update({3, 17})
+    chunks = [b''.join(random_frame(model, ALARM_MIX).encode('ascii') + b'\r\n'
+                       for _ in range(frames_per_read)) for _ in range(reads)]
+    config = alarmserver.AlarmServerConfig(config_file)
+    results: Dict[str, Any] = {'frames_received': reads * frames_per_read}
+    for name, collapse in (('collapsed', True), ('uncollapsed', False)):
+        run_config = config.replace(ENVISACOLLAPSEFRAMES=collapse)
+        smartthings = CountingSmartThings()
+        clock = Clock()
+        client = alarmserver.EnvisalinkClient(run_config, smartthings, clock,
+                                              state=run_config.initialize_alarmstate({}))
+        client.makeConnection(StringTransport())
+        client.handle_login_success('')
+        processed = [0]
+        handle_line = client.handle_line
+
+        def counting_handle_line(line, rxtime):
+            processed[0] += 1
+            handle_line(line, rxtime)
+        client.handle_line = counting_handle_line
+
+        ticks = []
+        start = time.process_time()
+        for chunk in chunks:
+            tick = time.perf_counter()
+            client.dataReceived(chunk)
+            ticks.append(time.perf_counter() - tick)
+            while client._backlogcall is not None:
+                tick = time.perf_counter()
+                clock.advance(0)
+                ticks.append(time.perf_counter() - tick)
+        cpu_seconds = time.process_time() - start
+        client.stop_watchdogs()
+        results[name] = {
+            'frames_processed': processed[0],
+            'updates_sent': smartthings.updates,
+            'cpu_usec_per_frame_received': round(cpu_seconds / (reads * frames_per_read) * 1e6, 3),
+            'max_tick_ms': round(max(ticks) * 1000, 3),
+        }
+    return results
+
+
+####
+# Startup
+
+
+ALARMSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alarmserver.py')
+
+
+# Time from starting an alarmserver.py process to it sending the TPI
+# password to a listening socket that stands in for the Envisalink, and
+# to printing its usage for -h.  Runs without the reactor, so the
+# process under test has the cpu to itself.
+def run_startup(directory: str, runs: int) -> Dict[str, Any]:
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.settimeout(30)
+    config_file = write_config(directory, envisalink_port=listener.getsockname()[1])
+    login_times = []
+    help_times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, ALARMSERVER, '-h'], stdout=devnull)
+            help_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, ALARMSERVER, '-c', config_file],
+                                       stdout=devnull, stderr=devnull)
+            try:
+                connection, _ = listener.accept()
+                with connection:
+                    connection.sendall(b'Login:\r\n')
+                    received = b''
+                    while not received.endswith(b'\r\n'):
+                        data = connection.recv(64)
+                        if not data:
+                            break
+                        received += data
+                    login_times.append(time.perf_counter() - start)
+                    connection.sendall(b'OK\r\n')
+            finally:
+                process.terminate()
+                process.wait()
+    listener.close()
+    return {
+        'runs': runs,
+        'start_to_login_ms_min': round(min(login_times) * 1000, 3),
+        'start_to_login_ms_p50': round(percentile(login_times, 50) * 1000, 3),
+        'help_ms_p50': round(percentile(help_times, 50) * 1000, 3),
+    }
+
+
+####
+# Supervisor scaling
+
+
+SUPERVISOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'supervisor.py')
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpisimulator.py')
+
+
+# Lines received by every worker, summed from the supervisor's merged
+# /metrics; None until it answers.
+def lines_received(admin_port: int) -> Any:
+    url = 'http://127.0.0.1:%d/metrics' % admin_port
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    return sum(int(float(line.rsplit(' ', 1)[1])) for line in text.splitlines()
+               if line.startswith('alarmserver_handler_seconds_count'))
+
+
+# Frames per second handled with the panels sharded across 1 to
+# max_workers supervisor.py workers.  Each simulator offers rate frames
+# per second to every panel connected to it, more than a worker keeps
+# up with, so throughput is bounded by the workers; it should grow with
+# the workers until they outnumber the cpus.
+def run_supervisor(directory: str, panels: int, max_workers: int, rate: float,
+                   duration: float) -> Dict[str, Any]:
+    results: Dict[str, Any] = {
+        'panels': panels,
+        'cpus': os.cpu_count(),
+        'offered_rate_per_panel': rate,
+        'duration_seconds': duration,
+        'workers': {},
+    }
+    simulator_ports = [free_port() for _ in range(max_workers)]
+    with open(os.devnull, 'w') as devnull:
+        simulators = [subprocess.Popen([sys.executable, SIMULATOR, '-p', str(port),
+                                        '-z', str(SIMULATED_ZONES), '-r', str(rate)],
+                                       stdout=devnull, stderr=devnull)
+                      for port in simulator_ports]
+        try:
+            baseline = None
+            for workers in range(1, max_workers + 1):
+                admin_port = free_port()
+                config_file = write_supervisor_config(directory, panels, simulator_ports,
+                                                      admin_port)
+                supervisor = subprocess.Popen(
+                    [sys.executable, SUPERVISOR, '-c', config_file, '-w', str(workers)],
+                    stdout=devnull, stderr=devnull)
+                try:
+                    deadline = time.monotonic() + 30
+                    while lines_received(admin_port) is None and time.monotonic() < deadline:
+                        time.sleep(0.2)
+                    # let every worker connect and log in
+                    time.sleep(2)
+                    start, start_lines = time.monotonic(), lines_received(admin_port)
+                    time.sleep(duration)
+                    elapsed, lines = time.monotonic() - start, lines_received(admin_port)
+                finally:
+                    supervisor.terminate()
+                    supervisor.wait()
+                frames_per_second = (lines - start_lines) / elapsed \
+                    if lines is not None and start_lines is not None else 0.0
+                if baseline is None:
+                    baseline = frames_per_second
+                results['workers'][str(workers)] = {
+                    'frames_per_second': round(frames_per_second, 1),
+                    'speedup': round(frames_per_second / baseline, 2) if baseline else 0.0,
+                }
+        finally:
+            for simulator in simulators:
+                simulator.terminate()
+                simulator.wait()
+    return results
+
+
+####
+# End to end
+
+
+class SmartThingsStandIn(Resource):
+    """Accepts api posts and notes when the probe zone changes state."""
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.posts: int = 0
+        self.post_bytes: int = 0
+        self.probe_status = None
+        self.probe_changed = threading.Event()
+        self.changed_at: float = 0.0
+
+    def render_POST(self, request):
+        now = time.monotonic()
+        self.posts += 1
+        body = request.content.read()
+        self.post_bytes += len(body)
+        state = json.loads(body)
+        status = state['zone'][str(PROBE_ZONE)]['status']
+        if status != self.probe_status:
+            self.probe_status = status
+            self.changed_at = now
+            self.probe_changed.set()
+        return b'{}'
+
+
+class MQTTBrokerStandIn(Protocol):
+    """Just enough of an MQTT 3.1.1 broker to accept the publisher's
+    session: acknowledges publishes, answers pings and keeps retained
+    messages, publishing the will if the connection drops uncleanly."""
+
+    def __init__(self, broker: 'MQTTBrokerFactory'):
+        self._broker: 'MQTTBrokerFactory' = broker
+        self._buffer: bytes = b''
+        self._will = None
+        self._clean: bool = False
+
+    def dataReceived(self, data: bytes):
+        packets, self._buffer = mqttpublisher.split_packets(self._buffer + data)
+        for first_byte, body in packets:
+            packet_type = first_byte & 0xF0
+            if packet_type == mqttpublisher.CONNECT:
+                self.handle_connect(body)
+            elif packet_type == mqttpublisher.PUBLISH:
+                self.handle_publish(first_byte, body)
+            elif packet_type == mqttpublisher.PINGREQ:
+                self.transport.write(bytes((mqttpublisher.PINGRESP, 0)))
+            elif packet_type == mqttpublisher.DISCONNECT:
+                self._clean = True
+
+    def handle_connect(self, body: bytes):
+        flags = body[7]
+        offset = 10
+        _, offset = self.read_string(body, offset)  # client id
+        if flags & 0x04:
+            topic, offset = self.read_string(body, offset)
+            message, offset = self.read_string(body, offset)
+            self._will = (topic, message)
+        self.transport.write(bytes((mqttpublisher.CONNACK, 2, 0, 0)))
+
+    def handle_publish(self, first_byte: int, body: bytes):
+        topic, offset = self.read_string(body, 0)
+        if first_byte & 0x06:
+            self.transport.write(bytes((mqttpublisher.PUBACK, 2)) + body[offset:offset + 2])
+            offset += 2
+        self._broker.received(topic, body[offset:], len(body))
+
+    def connectionLost(self, reason):
+        if self._will is not None and not self._clean:
+            self._broker.received(self._will[0], self._will[1], 0)
+
+    @staticmethod
+    def read_string(body: bytes, offset: int):
+        length = struct.unpack('!H', body[offset:offset + 2])[0]
+        return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+class MQTTBrokerFactory(Factory):
+    def __init__(self):
+        self.retained: Dict[bytes, bytes] = {}
+        self.messages: int = 0
+        self.bytes: int = 0
+
+    def buildProtocol(self, addr):
+        return MQTTBrokerStandIn(self)
+
+    def received(self, topic: bytes, payload: bytes, size: int):
+        self.retained[topic] = payload
+        self.messages += 1
+        self.bytes += size
+
+
+class EndToEndRun:
+    def __init__(self, rate: float, duration: float, probe_interval: float, sender: str):
+        self._rate: float = rate
+        self._sender: str = sender
+        self._duration: float = duration
+        self._probe_interval: float = probe_interval
+        self._latencies: List[float] = []
+        self._sent_at: float = 0.0
+        self._lines: int = 0
+        self._factory = None
+        self._simulator_factory = None
+        self._standin = SmartThingsStandIn()
+        self._broker = MQTTBrokerFactory()
+
+    def start(self, directory: str):
+        http_port = reactor.listenTCP(0, Site(self._standin), interface='127.0.0.1')
+        mqtt_port = reactor.listenTCP(0, self._broker, interface='127.0.0.1')
+        settings = SimulatorSettings()
+        settings.zones = SIMULATED_ZONES
+        settings.rate = self._rate
+        self._simulator_factory = CapturingSimulatorFactory(settings)
+        tpi_port = reactor.listenTCP(0, self._simulator_factory, interface='127.0.0.1')
+        config = alarmserver.AlarmServerConfig(write_config(
+            directory, http_port.getHost().port, tpi_port.getHost().port,
+            mqtt_port.getHost().port, self._sender))
+        config.initialize_alarmstate()
+        self._factory = alarmserver.EnvisalinkClientFactory(config)
+        self._factory.connect()
+        reactor.callLater(1.0, self.begin)
+
+    def begin(self):
+        client = self._factory._envisalinkClient
+        line_received = client.lineReceived
+
+        def counting_line_received(line):
+            self._lines += 1
+            line_received(line)
+        client.lineReceived = counting_line_received
+
+        self._start = time.monotonic()
+        self._start_lines = self._lines
+        self._start_posts = self._standin.posts
+        self._start_post_bytes = self._standin.post_bytes
+        self._start_mqtt_messages = self._broker.messages
+        self._start_mqtt_bytes = self._broker.bytes
+        self.probe()
+        reactor.callLater(self._duration, self.finish)
+
+    # open the probe zone, and close it again once the open was posted
+    def probe(self):
+        simulator = self._simulator_factory.protocol_instance
+        if self._standin.probe_status == 'open':
+            # a CID alarm restore closes the zone
+            simulator.send_frame('%%03,313401%03d$' % PROBE_ZONE)
+        else:
+            self._standin.probe_changed.clear()
+            self._sent_at = time.monotonic()
+            simulator.send_frame('%%00,01,0008,%03d,00,FAULT %d ZONE %d$'
+                                 % (PROBE_ZONE, PROBE_ZONE, PROBE_ZONE))
+            reactor.callInThread(self.wait_for_probe)
+        reactor.callLater(self._probe_interval, self.probe)
+
+    def wait_for_probe(self):
+        sent_at = self._sent_at
+        if self._standin.probe_changed.wait(5) and self._standin.probe_status == 'open':
+            self._latencies.append(self._standin.changed_at - sent_at)
+
+    def finish(self):
+        elapsed = time.monotonic() - self._start
+        posts = self._standin.posts - self._start_posts
+        mqtt_messages = self._broker.messages - self._start_mqtt_messages
+        self.results = {
+            'offered_rate': self._rate,
+            'duration_seconds': round(elapsed, 3),
+            'frames_per_second': round((self._lines - self._start_lines) / elapsed, 1),
+            'posts': posts,
+            'bytes_per_post': (self._standin.post_bytes - self._start_post_bytes) // max(posts, 1),
+            'mqtt_messages': mqtt_messages,
+            'bytes_per_mqtt_message':
+                (self._broker.bytes - self._start_mqtt_bytes) // max(mqtt_messages, 1),
+            'latency_samples': len(self._latencies),
+            'latency_ms_p50': round(percentile(self._latencies, 50) * 1000, 3),
+            'latency_ms_p90': round(percentile(self._latencies, 90) * 1000, 3),
+            'latency_ms_p99': round(percentile(self._latencies, 99) * 1000, 3),
+            'latency_ms_max': round(max(self._latencies, default=0) * 1000, 3),
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        reactor.stop()
+
+
+class CapturingSimulatorFactory(SimulatorFactory):
+    """Keeps the simulator connection so the benchmark can inject frames."""
+    protocol_instance = None
+
+    def buildProtocol(self, addr):
+        self.protocol_instance = SimulatorFactory.buildProtocol(self, addr)
+        return self.protocol_instance
+
+
+def run_end_to_end(directory: str, rate: float, duration: float,
+                   sender: str) -> Dict[str, Any]:
+    run = EndToEndRun(rate, duration, probe_interval=0.25, sender=sender)
+    reactor.callWhenRunning(run.start, directory)
+    reactor.run()
+    return run.results
+
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' [options]\n'
+          '  -o, --output=FILE    write JSON results to FILE (default stdout)\n'
+          '  -n, --number=N       iterations per microbenchmark (default 2000)\n'
+          '  -r, --rate=N         simulated frames per second end to end (default 1000)\n'
+          '  -d, --duration=S     end to end run length in seconds (default 10)\n'
+          '  -m, --micro-only     skip the end to end run\n'
+          '  -p, --panels=N       measure per-panel cost with N panels (default 0, skip)\n'
+          '  -w, --workers=K      with --panels, shard them across 1 to K supervisor.py\n'
+          '                       workers and report frames/s for each (default 0, skip);\n'
+          '                       --rate is then per panel and --duration per run\n'
+          '  -l, --loglevel=L     logging level while benchmarking (default WARNING)\n'
+          '  -s, --sender=S       SmartThings sender end to end: thread or async\n'
+          '                       (default thread)\n'
+          'Set ALARMSERVER_RUNTIME=twisted, asyncio or uvloop to pick the event loop.')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "ho:n:r:d:mp:w:l:s:",
+                                   ["help", "output=", "number=", "rate=", "duration=",
+                                    "micro-only", "panels=", "workers=", "loglevel=",
+                                    "sender="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    output = None
+    number = 2000
+    rate = 1000.0
+    duration = 10.0
+    micro_only = False
+    panels = 0
+    workers = 0
+    loglevel = 'WARNING'
+    sender = 'thread'
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-n", "--number"):
+            number = int(arg)
+        elif opt in ("-r", "--rate"):
+            rate = float(arg)
+        elif opt in ("-d", "--duration"):
+            duration = float(arg)
+        elif opt in ("-m", "--micro-only"):
+            micro_only = True
+        elif opt in ("-p", "--panels"):
+            panels = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-l", "--loglevel"):
+            loglevel = arg
+        elif opt in ("-s", "--sender"):
+            sender = arg
+
+    logging.basicConfig(level=loglevel)
+    results: Dict[str, Any] = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'loglevel': loglevel,
+        'runtime': runtime.RUNTIME,
+        'sender': sender,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = write_config(directory)
+        results['micro'] = run_microbenchmarks(config_file, number, repeat=5)
+        results['storm'] = run_storm(config_file, reads=max(number // 20, 10),
+                                     frames_per_read=50)
+        if panels:
+            results['panels'] = run_panels(directory, panels, frames=number // 10)
+        if panels and workers:
+            results['supervisor'] = run_supervisor(directory, panels, workers,
+                                                   rate, duration)
+        if not micro_only:
+            results['startup'] = run_startup(directory, runs=5)
+            results['end_to_end'] = run_end_to_end(directory, rate, duration, sender)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+import bisect
+import logging
+import os
+import struct
+import time
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+# A capture is a header followed by one record per received frame:
+#   float64 seconds since the capture started (monotonic clock)
+#   uint16 frame length
+#   frame bytes, without the line delimiter
+# A sidecar .idx file holds (seconds, file offset) pairs written every
+# index interval so a reader can seek without scanning the capture.
+MAGIC = b'EVLCAP1\n'
+RECORD = struct.Struct('<dH')
+INDEX_RECORD = struct.Struct('<dQ')
+INDEX_SUFFIX = '.idx'
+
+
+class CaptureWriter:
+    """Appends received frames to a capture file."""
+
+    def __init__(self, filename: str, index_interval: float = 60):
+        self._filename: str = filename
+        self._index_interval: float = index_interval
+        self._file: BinaryIO = open(filename, 'wb')
+        self._index: BinaryIO = open(filename + INDEX_SUFFIX, 'wb')
+        self._file.write(MAGIC)
+        self._start: float = time.monotonic()
+        self._next_index: float = 0.0
+        self.frames: int = 0
+        logging.info("Capturing received frames to %s", filename)
+
+    def record(self, frame: bytes, timestamp: Optional[float] = None):
+        if self._file.closed:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        offset = timestamp - self._start
+        if offset >= self._next_index:
+            self._index.write(INDEX_RECORD.pack(offset, self._file.tell()))
+            self._next_index = offset + self._index_interval
+            # index points are a convenient time to get data onto disk
+            self._file.flush()
+            self._index.flush()
+        self._file.write(RECORD.pack(offset, len(frame)))
+        self._file.write(frame)
+        self.frames += 1
+
+    def close(self):
+        logging.info("Closing capture %s after %d frames", self._filename, self.frames)
+        self._file.close()
+        self._index.close()
+
+
+class CaptureReader:
+    """Iterates over the (seconds, frame) records of a capture file."""
+
+    def __init__(self, filename: str):
+        self._filename: str = filename
+        self._file: BinaryIO = open(filename, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % filename)
+        self._index: List[Tuple[float, int]] = self._read_index()
+
+    def _read_index(self) -> List[Tuple[float, int]]:
+        index_file = self._filename + INDEX_SUFFIX
+        if not os.path.exists(index_file):
+            return []
+        with open(index_file, 'rb') as index:
+            data = index.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        return [INDEX_RECORD.unpack_from(data, pos)
+                for pos in range(0, usable, INDEX_RECORD.size)]
+
+    # Position the reader at the last index point at or before seconds;
+    # records before seconds may still follow and should be skipped.
+    def seek(self, seconds: float):
+        times = [entry[0] for entry in self._index]
+        position = bisect.bisect_right(times, seconds) - 1
+        if position >= 0:
+            self._file.seek(self._index[position][1])
+        else:
+            self._file.seek(len(MAGIC))
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        read = self._file.read
+        while True:
+            header = read(RECORD.size)
+            if len(header) < RECORD.size:
+                # end of file, or a record cut short by a crash
+                return
+            offset, length = RECORD.unpack(header)
+            frame = read(length)
+            if len(frame) < length:
+                return
+            yield offset, frame
+
+    def close(self):
+        self._file.close()
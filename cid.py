@@ -0,0 +1,92 @@
+import logging
+from typing import Dict, NamedTuple, Optional
+
+from envisalinkdefs import evl_CID_Events, evl_CID_Qualifiers
+
+# event categories, derived from the Contact ID code ranges
+CATEGORY_ALARM = 'alarm'
+CATEGORY_FIRE = 'fire'
+CATEGORY_TROUBLE = 'trouble'
+CATEGORY_AC_POWER = 'ac_power'
+CATEGORY_LOW_BATTERY = 'low_battery'
+CATEGORY_ARM_AWAY = 'arm_away'
+CATEGORY_ARM_STAY = 'arm_stay'
+CATEGORY_CANCEL = 'cancel'
+CATEGORY_BYPASS = 'bypass'
+CATEGORY_OTHER = 'other'
+
+# qualifiers: a new event (or opening, i.e. disarm), a restore (or
+# closing, i.e. arm), or a repeat of a condition that is still present
+QUALIFIER_EVENT = 'event'
+QUALIFIER_RESTORE = 'restore'
+QUALIFIER_STATUS = 'status'
+
+
+class CIDEvent(NamedTuple):
+    qualifier: str
+    code: int
+    label: str
+    category: str
+    partition: int
+    # exactly one of zone and user is set, depending on the event type
+    zone: Optional[int]
+    user: Optional[int]
+
+    @property
+    def is_new(self) -> bool:
+        return self.qualifier == QUALIFIER_EVENT
+
+
+def _category(code: int) -> str:
+    if 110 <= code <= 119:
+        return CATEGORY_FIRE
+    if 100 <= code <= 199:
+        return CATEGORY_ALARM
+    if code == 301:
+        return CATEGORY_AC_POWER
+    if code in (302, 309, 311, 384):
+        return CATEGORY_LOW_BATTERY
+    if 300 <= code <= 399:
+        return CATEGORY_TROUBLE
+    if code in (401, 403, 407, 408, 409):
+        return CATEGORY_ARM_AWAY
+    if code in (441, 442):
+        return CATEGORY_ARM_STAY
+    if code == 406:
+        return CATEGORY_CANCEL
+    if code in (570, 574):
+        return CATEGORY_BYPASS
+    return CATEGORY_OTHER
+
+
+# Lookup tables keyed by the raw text of each field, built once so
+# decoding an event is a handful of dict lookups.
+_QUALIFIER_NAMES = {1: QUALIFIER_EVENT, 3: QUALIFIER_RESTORE, 6: QUALIFIER_STATUS}
+CID_QUALIFIERS: Dict[str, str] = {
+    str(qualifier): _QUALIFIER_NAMES[qualifier] for qualifier in evl_CID_Qualifiers}
+CID_EVENTS: Dict[str, tuple] = {
+    '%03d' % code: (code, event['label'], event['type'], _category(code))
+    for code, event in evl_CID_Events.items()}
+
+
+# Decode a %03 payload: QEEEPPZZZ (qualifier, event code, partition,
+# zone or user).  Returns None if the event can't be decoded.
+def decode_cid_event(data: str) -> Optional[CIDEvent]:
+    if len(data) != 9:
+        logging.error("CID event data format invalid: '%s'", data)
+        return None
+    qualifier = CID_QUALIFIERS.get(data[0])
+    event = CID_EVENTS.get(data[1:4])
+    if qualifier is None or event is None:
+        logging.warning("Unknown CID event '%s', skipping...", data)
+        return None
+    code, label, event_type, category = event
+    try:
+        partition = int(data[4:6])
+        zone_or_user = int(data[6:9])
+    except ValueError:
+        logging.error("CID event data format invalid: '%s'", data)
+        return None
+    if event_type == 'user':
+        return CIDEvent(qualifier, code, label, category, partition, None, zone_or_user)
+    return CIDEvent(qualifier, code, label, category, partition, zone_or_user, None)
@@ -0,0 +1,156 @@
+import logging
+from typing import Callable, Dict, Mapping, NamedTuple, Optional
+
+from baseConfig import BaseConfig
+from timers import MONOTONIC
+
+# zone status sources, in rough order of reliability
+SOURCE_KEYPAD = 'keypad'          # %00 FAULT messages and the ready flag
+SOURCE_ZONECHANGE = 'zonechange'  # %01 zone state change bitfield
+SOURCE_ZONEDUMP = 'zonedump'      # %FF zone timer dump
+SOURCE_CID = 'cid'                # %03 Contact ID alarm and restore events
+
+ZONE_TYPES = ('door', 'motion', 'smoke')
+DEFAULT_ZONE_TYPE = 'door'
+
+
+class DebounceSettings(NamedTuple):
+    # seconds a zone must be reported open before it is marked open
+    open_hold: float
+    # seconds a zone must be reported closed before it is marked closed
+    close_hold: float
+    # zone dumps falsely report zones closed; a dump close only counts
+    # once the zone has been closed this many seconds
+    dump_margin: float
+    # %01 keeps reporting zones open after they close, so by default
+    # only closes are taken from it
+    zonechange_opens: bool
+
+
+DEFAULT_SETTINGS: Dict[str, DebounceSettings] = {
+    'door': DebounceSettings(0, 0, 60, False),
+    'motion': DebounceSettings(0, 0, 10, False),
+    'smoke': DebounceSettings(0, 0, 60, False),
+}
+
+
+# Read per-zone-type debounce settings from the [debounce] section, e.g.
+# motion_close_hold = 5
+def read_debounce_settings(config: BaseConfig) -> Dict[str, DebounceSettings]:
+    settings = {}
+    for zone_type in ZONE_TYPES:
+        default = DEFAULT_SETTINGS[zone_type]
+        settings[zone_type] = DebounceSettings(
+            config.get_float('debounce', zone_type + '_open_hold',
+                             default.open_hold, True),
+            config.get_float('debounce', zone_type + '_close_hold',
+                             default.close_hold, True),
+            config.get_float('debounce', zone_type + '_dump_margin',
+                             default.dump_margin, True),
+            config.get_bool('debounce', zone_type + '_zonechange_opens',
+                            default.zonechange_opens, True))
+    return settings
+
+
+class _PendingChange:
+    def __init__(self, status: str, since: float):
+        self.status: str = status
+        # monotonic time the zone was first seen in the new status
+        self.since: float = since
+        self.call = None
+
+
+class ZoneDebouncer:
+    """Merges zone reports from every source into one debounced status.
+
+    A report that differs from the current status starts a hold timer
+    for the zone's type; the change is committed when the hold expires,
+    and a report of the current status before then cancels it.  Time a
+    source says the zone has already spent in the new status (the zone
+    dump's closed seconds) counts toward the hold.
+    """
+
+    def __init__(self,
+                 settings: Mapping[int, DebounceSettings],
+                 current_status: Callable[[int], Optional[str]],
+                 commit: Callable[[int, str, float, bool], None],
+                 clock=MONOTONIC):
+        # zone number -> settings for the zone's type; untracked zones
+        # are absent
+        self._settings: Mapping[int, DebounceSettings] = settings
+        self._current_status = current_status
+        # commit(zone_num, status, seconds_in_status, deferred)
+        self._commit = commit
+        self._clock = clock
+        self._pending: Dict[int, _PendingChange] = {}
+
+    # Switch to new per-zone settings, dropping pending changes for zones
+    # that are no longer tracked.
+    def update_settings(self, settings: Mapping[int, DebounceSettings]):
+        self._settings = settings
+        for zone_num in [zone_num for zone_num in self._pending if zone_num not in settings]:
+            self.cancel(zone_num)
+
+    def report(self, zone_num: int, status: str, source: str, seconds_ago: float = 0):
+        settings = self._settings.get(zone_num)
+        if settings is None:
+            return
+        if (source == SOURCE_ZONECHANGE and status == 'open' and
+                not settings.zonechange_opens):
+            return
+
+        pending = self._pending.get(zone_num)
+        if status == self._current_status(zone_num):
+            if pending is not None:
+                logging.debug("zone %d back to %s from %s, cancelling change "
+                              "to %s", zone_num, status, source, pending.status)
+                self.cancel(zone_num)
+            return
+
+        if status == 'open':
+            hold = settings.open_hold
+        elif source == SOURCE_ZONEDUMP:
+            hold = max(settings.close_hold, settings.dump_margin)
+        else:
+            hold = settings.close_hold
+
+        now = self._clock.seconds()
+        since = now - seconds_ago
+        if pending is not None and pending.status == status:
+            since = min(since, pending.since)
+        elif pending is not None:
+            self.cancel(zone_num)
+            pending = None
+
+        remaining = hold - (now - since)
+        if remaining <= 0:
+            self.cancel(zone_num)
+            self._commit(zone_num, status, now - since, False)
+            return
+
+        if pending is None:
+            pending = _PendingChange(status, since)
+            self._pending[zone_num] = pending
+            logging.debug("zone %d reported %s by %s, holding %.1f seconds",
+                          zone_num, status, source, remaining)
+        pending.since = since
+        if pending.call is not None and pending.call.active():
+            pending.call.reset(remaining)
+        else:
+            pending.call = self._clock.callLater(remaining, self._expire, zone_num)
+
+    def cancel(self, zone_num: int):
+        pending = self._pending.pop(zone_num, None)
+        if pending is not None and pending.call is not None and pending.call.active():
+            pending.call.cancel()
+
+    def cancel_all(self):
+        for zone_num in list(self._pending):
+            self.cancel(zone_num)
+
+    def _expire(self, zone_num: int):
+        pending = self._pending.pop(zone_num, None)
+        if pending is None:
+            return
+        self._commit(zone_num, pending.status,
+                     self._clock.seconds() - pending.since, True)
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# Event history
+#
+# Persists every zone and partition transition to a local SQLite
+# database from a writer thread, and queries it from the command line.
+#
+# This code is under the terms of the GPL v3 license.
+
+import getopt
+import json
+import logging
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+KIND_ZONE = 'zone'
+KIND_PARTITION = 'partition'
+
+# events holds every transition until it is older than the retention
+# period, when it is rolled up into per-day counts in daily.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    detail TEXT
+);
+-- last N changes for zone X
+CREATE INDEX IF NOT EXISTS events_by_number ON events (kind, number, ts);
+-- all openings between T1 and T2
+CREATE INDEX IF NOT EXISTS events_by_status ON events (kind, status, ts);
+CREATE TABLE IF NOT EXISTS daily (
+    day TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, kind, number, status)
+) WITHOUT ROWID;
+"""
+
+INSERT = 'INSERT INTO events (ts, kind, number, status, detail) VALUES (?, ?, ?, ?, ?)'
+
+ROLLUP = """
+INSERT INTO daily (day, kind, number, status, count)
+    SELECT date(ts, 'unixepoch', 'localtime'), kind, number, status, count(*)
+    FROM events WHERE ts < ? GROUP BY 1, 2, 3, 4
+    ON CONFLICT (day, kind, number, status) DO UPDATE SET count = count + excluded.count
+"""
+
+Event = Tuple[float, str, int, str, Optional[str]]
+
+# written on the writer thread
+EVENTS_WRITTEN = REGISTRY.counter(
+    'alarmserver_history_events_written_total', 'Transitions written to the history database')
+BATCH_SECONDS = REGISTRY.histogram(
+    'alarmserver_history_batch_seconds', 'Time taken to write each batch of transitions')
+
+
+class EventHistory:
+    """Writes transitions to SQLite from a writer thread.
+
+    record only puts a tuple on a queue, so the reactor never waits on
+    the database.  The writer thread inserts whatever has queued up in
+    one transaction, and rolls up and deletes events older than the
+    retention period once an hour.
+    """
+
+    def __init__(self, filename: str, retention_days: float = 30, batch: int = 1000):
+        self._filename: str = filename
+        self._retention: float = retention_days * 86400
+        self._batch: int = batch
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._next_prune: float = 0.0
+        # create the schema here so errors show up at startup
+        connection = connect(filename)
+        connection.close()
+        self._thread = threading.Thread(target=self._run, name="history writer", daemon=True)
+        self._thread.start()
+        REGISTRY.callback_gauge('alarmserver_history_queue_depth',
+                                'Transitions waiting to be written', self._queue.qsize)
+        logging.info("Recording event history to %s", filename)
+
+    def record(self, kind: str, number: int, status: str, detail: Optional[str] = None,
+               timestamp: Optional[float] = None):
+        self._queue.put((time.time() if timestamp is None else timestamp,
+                         kind, number, status, detail))
+
+    # Write everything queued so far and stop the writer thread.
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    # Runs in the writer thread.
+    def _run(self):
+        connection = connect(self._filename)
+        stopping = False
+        while not stopping:
+            try:
+                events = [self._queue.get(timeout=60)]
+            except queue.Empty:
+                events = []
+            try:
+                while len(events) < self._batch:
+                    events.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in events:
+                stopping = True
+                events = [event for event in events if event is not None]
+            try:
+                if events:
+                    self._write(connection, events)
+                if time.time() >= self._next_prune:
+                    self._prune(connection)
+            except sqlite3.Error as err:
+                logging.error("Error writing event history: %s", str(err))
+            except Exception:
+                # anything escaping would end the thread while record()
+                # goes on filling the queue
+                logging.exception("Error writing event history")
+        connection.close()
+
+    def _write(self, connection: sqlite3.Connection, events: List[Event]):
+        start = time.perf_counter()
+        with connection:
+            connection.executemany(INSERT, events)
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+        EVENTS_WRITTEN.inc(len(events))
+
+    def _prune(self, connection: sqlite3.Connection):
+        self._next_prune = time.time() + 3600
+        if self._retention <= 0:
+            return
+        cutoff = time.time() - self._retention
+        with connection:
+            connection.execute(ROLLUP, (cutoff,))
+            deleted = connection.execute('DELETE FROM events WHERE ts < ?', (cutoff,)).rowcount
+        if deleted:
+            logging.info("Rolled up %d history events older than %s", deleted,
+                         datetime.fromtimestamp(cutoff).strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(filename)
+    # readers don't block the writer, and a commit doesn't wait for fsync
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+# Last limit transitions of one zone or partition, newest first.
+def last_changes(connection: sqlite3.Connection, kind: str, number: int,
+                 limit: int = 20) -> List[Dict[str, Any]]:
+    rows = connection.execute(
+        'SELECT ts, kind, number, status, detail FROM events '
+        'WHERE kind = ? AND number = ? ORDER BY ts DESC LIMIT ?', (kind, number, limit))
+    return [_row_dict(row) for row in rows]
+
+
+# Transitions of any zone or partition to status between start and end.
+def changes_between(connection: sqlite3.Connection, kind: str, status: str,
+                    start: float, end: float) -> List[Dict[str, Any]]:
+    rows = connection.execute(
+        'SELECT ts, kind, number, status, detail FROM events '
+        'WHERE kind = ? AND status = ? AND ts BETWEEN ? AND ? ORDER BY ts', (kind, status, start, end))
+    return [_row_dict(row) for row in rows]
+
+
+def _row_dict(row: Tuple) -> Dict[str, Any]:
+    return {
+        'time': datetime.fromtimestamp(row[0]).strftime("%Y-%m-%d %H:%M:%S.%f"),
+        'kind': row[1],
+        'number': row[2],
+        'status': row[3],
+        'detail': row[4],
+    }
+
+
+def _parse_time(text: str) -> float:
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' -d <database> [options]\n'
+          '  -z, --zone=N            last changes of zone N\n'
+          '  -p, --partition=N       last changes of partition N\n'
+          '  -n, --last=N            number of changes to show (default 20)\n'
+          '  -s, --status=S          zone changes to status S, e.g. open\n'
+          '      --since="Y-m-d H:M:S", --until="Y-m-d H:M:S"\n'
+          '                          time range for --status (default the last day)')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hd:z:p:n:s:",
+                                   ["help", "database=", "zone=", "partition=", "last=",
+                                    "status=", "since=", "until="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    database = None
+    kind = None
+    number = 0
+    limit = 20
+    status = None
+    until = time.time()
+    since = until - 86400
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-d", "--database"):
+            database = arg
+        elif opt in ("-z", "--zone"):
+            kind, number = KIND_ZONE, int(arg)
+        elif opt in ("-p", "--partition"):
+            kind, number = KIND_PARTITION, int(arg)
+        elif opt in ("-n", "--last"):
+            limit = int(arg)
+        elif opt in ("-s", "--status"):
+            status = arg
+        elif opt == "--since":
+            since = _parse_time(arg)
+        elif opt == "--until":
+            until = _parse_time(arg)
+    if database is None or (kind is None and status is None):
+        usage()
+        sys.exit(2)
+
+    connection = sqlite3.connect(database)
+    if status is not None:
+        results = changes_between(connection, KIND_ZONE, status, since, until)
+    else:
+        results = last_changes(connection, kind, number, limit)
+    connection.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
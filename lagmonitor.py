@@ -0,0 +1,119 @@
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Optional
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+from metrics import REGISTRY
+
+REACTOR_LAG = REGISTRY.histogram(
+    'alarmserver_reactor_lag_seconds',
+    'How late the reactor ran the lag monitor tick',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+# written from the monitor thread
+REACTOR_STALLS = REGISTRY.counter(
+    'alarmserver_reactor_stalls_total', 'Times the reactor was blocked past the lag threshold')
+
+
+class LagMonitor:
+    """Measures reactor scheduling delay and catches callbacks that block it.
+
+    A timer on the reactor records how late each tick runs.  A separate
+    thread watches for a tick that is overdue by more than the threshold
+    and, while the reactor is still stuck, captures the reactor thread's
+    stack so the blocking call can be found.
+    """
+
+    def __init__(self, interval: float, threshold: float, keep: int = 20):
+        self._interval: float = interval
+        self._threshold: float = threshold
+        self._expected: float = 0.0
+        self._call = None
+        self._reactor_thread: Optional[int] = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # the stall the reactor is currently stuck in, if any
+        self._stall: Optional[Dict[str, Any]] = None
+        # recent stalls with the stack that caused them
+        self.offenders: Deque[Dict[str, Any]] = deque(maxlen=keep)
+        self.max_lag: float = 0.0
+
+    # Must be called from the reactor thread.
+    def start(self):
+        self._reactor_thread = threading.get_ident()
+        self._schedule()
+        self._thread = threading.Thread(target=self._watch, name="reactor lag monitor",
+                                        daemon=True)
+        self._thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        logging.info("Reactor lag monitor started, interval %.3fs threshold %.3fs",
+                     self._interval, self._threshold)
+
+    def stop(self):
+        self._stopping.set()
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+    def _schedule(self):
+        self._expected = time.monotonic() + self._interval
+        self._call = reactor.callLater(self._interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, time.monotonic() - self._expected)
+        REACTOR_LAG.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        stall = self._stall
+        if stall is not None:
+            # the reactor is running again; record how long it was stuck
+            stall['blocked_seconds'] = round(lag, 6)
+            self._stall = None
+            logging.warning("Reactor was blocked for %.3f seconds in:\n%s",
+                            lag, stall['stack'])
+        self._schedule()
+
+    # Runs in the monitor thread.
+    def _watch(self):
+        poll = self._threshold / 2
+        while not self._stopping.wait(poll):
+            overdue = time.monotonic() - self._expected
+            if overdue <= self._threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._reactor_thread)
+            if frame is None:
+                continue
+            stall = {
+                'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                'overdue_seconds': round(overdue, 6),
+                'blocked_seconds': None,
+                'stack': ''.join(traceback.format_stack(frame)),
+            }
+            self._stall = stall
+            self.offenders.append(stall)
+            REACTOR_STALLS.inc()
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'interval_seconds': self._interval,
+            'threshold_seconds': self._threshold,
+            'max_lag_seconds': round(self.max_lag, 6),
+            'offenders': list(self.offenders),
+        }
+
+
+class LagResource(Resource):
+    isLeaf = True
+
+    def __init__(self, monitor: LagMonitor):
+        Resource.__init__(self)
+        self._monitor: LagMonitor = monitor
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self._monitor.report(), indent=2).encode('utf-8')
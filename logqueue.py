@@ -0,0 +1,192 @@
+import collections
+import json
+import logging
+import queue
+import sys
+import threading
+from typing import Deque, List, Optional, TextIO
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s <%(name)s %(module)s %(funcName)s> %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# attributes every LogRecord has; anything else came from extra={...}
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats records as key=value pairs, one record per line.
+
+    Values containing spaces, quotes or newlines are quoted and escaped,
+    and fields passed with extra={...} are appended.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = [
+            ('ts', '%s.%03d' % (self.formatTime(record, DATE_FORMAT), record.msecs)),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('module', record.module),
+            ('func', record.funcName),
+            ('thread', record.threadName),
+            ('msg', record.getMessage()),
+        ]
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                fields.append((key, value))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields.append(('exc', record.exc_text))
+        return ' '.join('%s=%s' % (key, _quote(value)) for key, value in fields)
+
+
+class BackgroundLogHandler(logging.Handler):
+    """Writes log records from a separate thread.
+
+    emit only puts the record on a queue, so the reactor thread never
+    formats a message or waits on the log file.  The writer thread
+    formats whatever has queued up and writes it with a single flush.
+    """
+
+    def __init__(self, filename: Optional[str] = None, batch: int = 256):
+        logging.Handler.__init__(self)
+        self._filename: Optional[str] = filename
+        self._stream: TextIO = open(filename, 'a') if filename else sys.stderr
+        self._batch: int = batch
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="log writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        self._queue.put(record)
+
+    # Queue a record regardless of the handler level, for the flight
+    # recorder.
+    def write(self, record: logging.LogRecord):
+        self._queue.put(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._filename:
+            self._stream.close()
+        logging.Handler.close(self)
+
+    # Runs in the writer thread.
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self._batch:
+                    records.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            stopping = False
+            for record in records:
+                if record is None:
+                    stopping = True
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                try:
+                    self._stream.write('\n'.join(lines) + '\n')
+                    self._stream.flush()
+                except Exception:
+                    self.handleError(records[-1])
+            if stopping:
+                return
+
+
+class FlightRecorder(logging.Handler):
+    """Keeps the records too detailed to be logged in a ring buffer.
+
+    The buffer is written out when an error is logged, or dump is
+    called, so the log shows what led up to the error without running
+    at DEBUG all the time.
+    """
+
+    def __init__(self, target: BackgroundLogHandler, size: int = 1000,
+                 trigger: int = logging.ERROR):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self._target: BackgroundLogHandler = target
+        self._trigger: int = trigger
+        self._records: Deque[logging.LogRecord] = collections.deque(maxlen=size)
+        self.dumps: int = 0
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno >= self._trigger:
+            self.dump(record.getMessage())
+        elif record.levelno < self._target.level:
+            self._records.append(record)
+
+    # Write out the buffered records with the reason they were dumped.
+    def dump(self, reason: str):
+        records: List[logging.LogRecord] = []
+        while self._records:
+            records.append(self._records.popleft())
+        if not records:
+            return
+        self.dumps += 1
+        self._target.write(self._marker('flight recorder: %d records before: %s',
+                                        len(records), reason))
+        for record in records:
+            self._target.write(record)
+        self._target.write(self._marker('flight recorder: end'))
+
+    def _marker(self, message: str, *args) -> logging.LogRecord:
+        return logging.LogRecord('flightrecorder', logging.WARNING, __file__, 0,
+                                 message, args, None, 'dump')
+
+
+FLIGHT_RECORDER: Optional[FlightRecorder] = None
+
+
+# Replace the root logger's handlers with a background handler writing
+# to filename (or stderr) at level, and a flight recorder keeping the
+# last flight_records records below level.  Returns the background
+# handler.
+def configure_logging(level: str, filename: str = '', log_format: str = 'text',
+                      flight_records: int = 0) -> BackgroundLogHandler:
+    global FLIGHT_RECORDER
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+    handler = BackgroundLogHandler(filename or None)
+    handler.setLevel(level)
+    if log_format == 'keyvalue':
+        handler.setFormatter(KeyValueFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    if flight_records > 0:
+        # records below level are only kept in memory, so the root
+        # logger has to let them through; the recorder goes first so a
+        # dump is written ahead of the error that caused it
+        FLIGHT_RECORDER = FlightRecorder(handler, flight_records)
+        root.addHandler(FLIGHT_RECORDER)
+        root.setLevel(logging.DEBUG)
+    else:
+        FLIGHT_RECORDER = None
+        root.setLevel(level)
+    root.addHandler(handler)
+    return handler
+
+
+# Dump the flight recorder, if there is one.
+def dump_flight_recorder(reason: str):
+    if FLIGHT_RECORDER is not None:
+        FLIGHT_RECORDER.dump(reason)
+
+
+def _quote(value) -> str:
+    text = str(value)
+    if text and not any(char in text for char in ' "=\n\t'):
+        return text
+    return json.dumps(text)
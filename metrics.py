@@ -0,0 +1,240 @@
+import bisect
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from twisted.web.resource import Resource
+
+# Default histogram buckets in seconds, from 10us handler calls up to
+# multi-second http requests and outages.
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Metric values are plain attributes updated without locks.  Each child
+# must only be written from one thread (the reactor or one SmartThings
+# api thread), so metrics written on the api threads are labelled by
+# panel; scrapes read them from the reactor thread.
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _GaugeValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets: Tuple[float, ...] = buckets
+        # one count per bucket plus +Inf; cumulated at exposition time
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    # Returns the child for a set of label values, creating it on first
+    # use.  Hot paths should keep the child rather than look it up per call.
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+            child = self._children[key] = self._new_value()
+        return child
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = '') -> str:
+        pairs = ['%s="%s"' % (name, _escape(value))
+                 for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def expose(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        # copy first: another thread may add a child mid-scrape
+        for key, child in sorted(self._children.copy().items()):
+            lines.extend(self._expose_child(key, child))
+        return lines
+
+    def _expose_child(self, key, child) -> List[str]:
+        return ['%s%s %s' % (self.name, self._label_text(key), _format(child.value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self._default.value += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value: float):
+        self._default.value = value
+
+    def inc(self, amount: float = 1):
+        self._default.value += amount
+
+    def dec(self, amount: float = 1):
+        self._default.value -= amount
+
+
+class CallbackGauge(Metric):
+    """A gauge whose value is computed when scraped."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Optional[float]]):
+        self._callback = callback
+        super().__init__(name, documentation)
+
+    def _new_value(self):
+        return None
+
+    def _expose_child(self, key, child) -> List[str]:
+        value = self._callback()
+        if value is None:
+            return []
+        return ['%s %s' % (self.name, _format(value))]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _expose_child(self, key, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            le = 'le="%s"' % ('+Inf' if bound == math.inf else _format(bound))
+            lines.append('%s_bucket%s %d' % (self.name, self._label_text(key, le), cumulative))
+        labels = self._label_text(key)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format(child.sum)))
+        lines.append('%s_count%s %d' % (self.name, labels, child.count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    # Registering a name twice returns the existing metric, so a module
+    # can be reloaded or a class instantiated more than once.
+    def _register(self, metric_class, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def callback_gauge(self, name: str, documentation: str,
+                       callback: Callable[[], Optional[float]]) -> CallbackGauge:
+        # the callback is replaced so it follows the newest owner
+        metric = self._register(CallbackGauge, name, documentation, callback)
+        metric._callback = callback
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    # Render all metrics in the Prometheus text exposition format.
+    def exposition(self) -> str:
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY):
+        Resource.__init__(self)
+        self._registry: MetricsRegistry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self._registry.exposition().encode('utf-8')
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,293 @@
+import json
+import logging
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+
+from metrics import REGISTRY
+
+# MQTT 3.1.1 control packet types, already shifted into the high nibble
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+CONNACK_ERRORS = {
+    1: 'unacceptable protocol version',
+    2: 'client identifier rejected',
+    3: 'server unavailable',
+    4: 'bad user name or password',
+    5: 'not authorized',
+}
+
+ONLINE = b'online'
+OFFLINE = b'offline'
+# seconds a clean disconnect may take before the connection is dropped
+STOP_TIMEOUT = 2
+
+MQTT_CONNECTIONS = REGISTRY.counter(
+    'alarmserver_mqtt_connections_total', 'Sessions established with the MQTT broker')
+MQTT_MESSAGES = REGISTRY.counter(
+    'alarmserver_mqtt_messages_total', 'Entity updates published to the MQTT broker')
+MQTT_BATCHES = REGISTRY.counter(
+    'alarmserver_mqtt_batches_total', 'Batches of entity updates written to the MQTT broker')
+
+
+def _remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(value: bytes) -> bytes:
+    return struct.pack('!H', len(value)) + value
+
+
+def _packet(first_byte: int, body: bytes) -> bytes:
+    return bytes((first_byte,)) + _remaining_length(len(body)) + body
+
+
+# Split the complete packets off the front of buffer, returning them as
+# (first byte, body) pairs along with whatever is left over.
+def split_packets(buffer: bytes) -> Tuple[List[Tuple[int, bytes]], bytes]:
+    packets = []
+    while len(buffer) >= 2:
+        length, offset, multiplier = 0, 1, 1
+        while True:
+            if offset >= len(buffer):
+                return packets, buffer
+            byte = buffer[offset]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            offset += 1
+            if not byte & 0x80:
+                break
+        if len(buffer) < offset + length:
+            break
+        packets.append((buffer[0], buffer[offset:offset + length]))
+        buffer = buffer[offset + length:]
+    return packets, buffer
+
+
+class MQTTProtocol(Protocol):
+    """One session with the broker: connect, publish, keep alive."""
+
+    def __init__(self, publisher: 'MQTTPublisher'):
+        self._publisher: 'MQTTPublisher' = publisher
+        self._buffer: bytes = b''
+        self._connected: bool = False
+        self._ping = None
+        self._pingtimeout = None
+        self._nextid: int = 0
+        # QoS 1 publishes waiting for their PUBACK; the full state is
+        # republished on reconnect, so these are not resent
+        self.inflight: Dict[int, bytes] = {}
+
+    def connectionMade(self):
+        self.transport.write(self._publisher.connect_packet())
+
+    def connectionLost(self, reason):
+        self._connected = False
+        for call in (self._ping, self._pingtimeout):
+            if call is not None and call.active():
+                call.cancel()
+        self._publisher.session_lost(self)
+
+    def dataReceived(self, data: bytes):
+        packets, self._buffer = split_packets(self._buffer + data)
+        for first_byte, body in packets:
+            self.handle_packet(first_byte & 0xF0, body)
+
+    def handle_packet(self, packet_type: int, body: bytes):
+        if packet_type == CONNACK:
+            code = body[1]
+            if code != 0:
+                logging.error("MQTT broker refused connection: %s",
+                              CONNACK_ERRORS.get(code, 'error %d' % code))
+                self.transport.loseConnection()
+                return
+            self._connected = True
+            self.schedule_ping()
+            self._publisher.session_ready(self)
+        elif packet_type == PUBACK:
+            self.inflight.pop(struct.unpack('!H', body[:2])[0], None)
+        elif packet_type == PINGRESP:
+            if self._pingtimeout is not None and self._pingtimeout.active():
+                self._pingtimeout.cancel()
+
+    def schedule_ping(self):
+        keepalive = self._publisher.keepalive
+        if keepalive > 0:
+            self._ping = reactor.callLater(keepalive * 0.75, self.send_ping)
+
+    def send_ping(self):
+        self.transport.write(_packet(PINGREQ, b''))
+        self._pingtimeout = reactor.callLater(self._publisher.keepalive, self.ping_timed_out)
+        self.schedule_ping()
+
+    def ping_timed_out(self):
+        logging.error("MQTT broker stopped answering pings, reconnecting...")
+        self.transport.abortConnection()
+
+    def publish_packet(self, topic: bytes, payload: bytes, qos: int) -> bytes:
+        header = PUBLISH | (qos << 1) | 0x01  # retained
+        if qos == 0:
+            return _packet(header, _string(topic) + payload)
+        self._nextid = self._nextid % 0xFFFF + 1
+        packet = _packet(header, _string(topic) + struct.pack('!H', self._nextid) + payload)
+        self.inflight[self._nextid] = packet
+        return packet
+
+    # Write several packets with one call.
+    def write_packets(self, packets: List[bytes]):
+        if self._connected:
+            self.transport.write(b''.join(packets))
+
+    def disconnect(self):
+        if self._connected:
+            self.transport.write(_packet(DISCONNECT, b''))
+        self.transport.loseConnection()
+
+
+class MQTTPublisher(ReconnectingClientFactory):
+    """Publishes each zone and partition to its own retained topic.
+
+    Only entities that changed since they were last published are sent.
+    Changes are collected for batch_interval seconds and written to the
+    broker together.  The availability topic is set to online after
+    connecting, and to offline by the broker's last will if the
+    connection drops, or by a clean shutdown.
+    """
+
+    def __init__(self, host: str, port: int = 1883, topic: str = 'alarmserver',
+                 client_id: str = 'alarmserver', username: str = '', password: str = '',
+                 qos: int = 0, keepalive: int = 60, batch_interval: float = 0.05):
+        self.host: str = host
+        self.port: int = port
+        self.topic: str = topic
+        self.client_id: str = client_id
+        self.username: str = username
+        self.password: str = password
+        self.qos: int = min(max(qos, 0), 1)
+        self.keepalive: int = keepalive
+        self.batch_interval: float = batch_interval
+        self.maxDelay = 60
+        self._availability: bytes = (topic + '/availability').encode('utf-8')
+        self._session: Optional[MQTTProtocol] = None
+        self._state: Optional[Dict[str, Any]] = None
+        # last published copy of each entity, by topic
+        self._published: Dict[bytes, Dict[str, Any]] = {}
+        self._flush = None
+        self._connector = None
+        self._stopped: Optional[defer.Deferred] = None
+
+    def start(self):
+        self._connector = reactor.connectTCP(self.host, self.port, self)
+        logging.info("Publishing to MQTT broker %s:%d under %s/", self.host, self.port, self.topic)
+
+    def buildProtocol(self, addr):
+        return MQTTProtocol(self)
+
+    def connect_packet(self) -> bytes:
+        flags = 0x02 | 0x04 | (self.qos << 3) | 0x20  # clean session, retained will
+        payload = _string(self.client_id.encode('utf-8'))
+        payload += _string(self._availability) + _string(OFFLINE)
+        if self.username:
+            flags |= 0x80
+            payload += _string(self.username.encode('utf-8'))
+            if self.password:
+                flags |= 0x40
+                payload += _string(self.password.encode('utf-8'))
+        variable = _string(b'MQTT') + struct.pack('!BBH', 4, flags, self.keepalive)
+        return _packet(CONNECT, variable + payload)
+
+    def session_ready(self, session: MQTTProtocol):
+        logging.info("Connected to MQTT broker %s:%d", self.host, self.port)
+        MQTT_CONNECTIONS.inc()
+        self.resetDelay()
+        self._session = session
+        # the broker may have lost retained messages; send everything
+        self._published.clear()
+        session.write_packets([session.publish_packet(self._availability, ONLINE, self.qos)])
+        if self._state is not None:
+            self.flush()
+
+    def session_lost(self, session: MQTTProtocol):
+        if self._session is session:
+            self._session = None
+            if self._stopped is None:
+                logging.warning("Lost connection to MQTT broker %s:%d", self.host, self.port)
+        if self._stopped is not None and not self._stopped.called:
+            self._stopped.callback(None)
+
+    # Note that state changed; changed entities are published after the
+    # batch interval.  state is an immutable snapshot.
+    def publish_state(self, state: Dict[str, Any]):
+        self._state = state
+        if self._flush is None or not self._flush.active():
+            self._flush = reactor.callLater(self.batch_interval, self.flush)
+
+    def flush(self):
+        session = self._session
+        if session is None or self._state is None:
+            return
+        packets = []
+        for topic, entity in self.changed_entities():
+            # an empty retained message clears the topic of a removed entity
+            payload = json.dumps(entity).encode('utf-8') if entity is not None else b''
+            packets.append(session.publish_packet(topic, payload, self.qos))
+        if packets:
+            session.write_packets(packets)
+            MQTT_MESSAGES.inc(len(packets))
+            MQTT_BATCHES.inc()
+
+    # The entities that changed since they were last published, with None
+    # for those no longer in the state.  Snapshots share the records of
+    # unchanged entities, so a record that is the same object as the one
+    # last published hasn't changed.
+    def changed_entities(self) -> List[Tuple[bytes, Optional[Dict[str, Any]]]]:
+        changed = []
+        current = set()
+        for kind in ('zone', 'partition'):
+            for number, entity in self._state[kind].items():
+                topic = ('%s/%s/%d' % (self.topic, kind, number)).encode('utf-8')
+                current.add(topic)
+                if self._published.get(topic) is not entity:
+                    self._published[topic] = entity
+                    changed.append((topic, entity))
+        if len(current) != len(self._published):
+            for topic in [topic for topic in self._published if topic not in current]:
+                del self._published[topic]
+                changed.append((topic, None))
+        return changed
+
+    # Publish offline and disconnect cleanly.  Fires once the connection
+    # is closed, so shutdown can wait for the last messages to be sent.
+    def stop(self) -> defer.Deferred:
+        self.stopTrying()
+        if self._flush is not None and self._flush.active():
+            self._flush.cancel()
+        session = self._session
+        if session is None:
+            if self._connector is not None:
+                self._connector.disconnect()
+            return defer.succeed(None)
+        self._stopped = defer.Deferred()
+        self.flush()
+        session.write_packets([session.publish_packet(self._availability, OFFLINE, 0)])
+        session.disconnect()
+        timeout = reactor.callLater(STOP_TIMEOUT, session.transport.abortConnection)
+
+        def stopped(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        return self._stopped.addBoth(stopped)
@@ -0,0 +1,217 @@
+import collections
+import io
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+if TYPE_CHECKING:
+    import cProfile
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+
+class Profiler:
+    """Profiles the reactor thread on demand for a limited time.
+
+    cprofile mode runs the deterministic profiler on the reactor thread
+    and writes a pstats file.  sample mode takes the reactor thread's
+    stack from a separate thread every sample interval and writes
+    collapsed stacks for flame graph tools; it is much cheaper but
+    misses short calls.  Nothing is installed while the profiler is
+    stopped.
+    """
+
+    def __init__(self, directory: str = '.', seconds: float = 30, mode: str = MODE_CPROFILE,
+                 sample_interval: float = 0.005, top: int = 20):
+        self._directory: str = directory
+        self._seconds: float = seconds
+        self._mode: str = mode
+        self._sample_interval: float = sample_interval
+        self._top: int = top
+        self._running_mode: Optional[str] = None
+        self._started: float = 0.0
+        self._stopcall = None
+        self._profile: Optional['cProfile.Profile'] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._sampling = threading.Event()
+        self._stacks: collections.Counter = collections.Counter()
+        self._samples: int = 0
+        self.last_file: Optional[str] = None
+
+    # Change the defaults used by the next start.
+    def configure(self, directory: str, seconds: float, mode: str):
+        self._directory = directory
+        self._seconds = seconds
+        self._mode = mode
+
+    @property
+    def running(self) -> bool:
+        return self._running_mode is not None
+
+    # Start profiling for seconds.  Must be called from the reactor thread.
+    def start(self, seconds: Optional[float] = None, mode: Optional[str] = None) -> bool:
+        if self.running:
+            return False
+        seconds = self._seconds if seconds is None else seconds
+        mode = self._mode if mode is None else mode
+        if mode not in MODES:
+            raise ValueError('unknown profiler mode %s' % mode)
+        if not (math.isfinite(seconds) and seconds > 0):
+            raise ValueError('profile seconds must be a positive number, not %s' % seconds)
+        # fail now rather than after profiling for nothing
+        if not os.path.isdir(self._directory):
+            raise ValueError('profile directory %s does not exist' % self._directory)
+
+        if mode == MODE_CPROFILE:
+            # only loaded when a profile is taken
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stacks = collections.Counter()
+            self._samples = 0
+            self._sampling.clear()
+            self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),),
+                                             name="profiler sampler", daemon=True)
+            self._sampler.start()
+        self._running_mode = mode
+        self._started = time.monotonic()
+        self._stopcall = reactor.callLater(seconds, self.stop)
+        logging.warning("Profiling the reactor (%s) for %.0f seconds", mode, seconds)
+        return True
+
+    # Stop profiling, write the results and log a summary.  Returns the
+    # file written, or None if it couldn't be written.
+    def stop(self) -> Optional[str]:
+        if not self.running:
+            return None
+        if self._stopcall is not None and self._stopcall.active():
+            self._stopcall.cancel()
+        self._stopcall = None
+        elapsed = time.monotonic() - self._started
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        # stopped whatever happens writing the results, so the next
+        # start isn't refused
+        try:
+            if self._running_mode == MODE_CPROFILE:
+                self._profile.disable()
+                filename = os.path.join(self._directory, 'profile-%s.pstats' % stamp)
+                self._profile.dump_stats(filename)
+                summary = self._summarize_profile(self._profile)
+            else:
+                self._sampling.set()
+                self._sampler.join()
+                filename = os.path.join(self._directory, 'profile-%s.folded' % stamp)
+                with open(filename, 'w') as folded:
+                    for stack, count in self._stacks.most_common():
+                        folded.write('%s %d\n' % (stack, count))
+                summary = self._summarize_samples()
+        except OSError as err:
+            logging.error("Couldn't write the profile: %s", str(err))
+            return None
+        finally:
+            self._running_mode = None
+            self._profile = None
+            self._sampler = None
+
+        self.last_file = filename
+        logging.warning("Profiled the reactor for %.1f seconds, written to %s\n%s",
+                        elapsed, filename, summary)
+        return filename
+
+    # Start with the defaults, or stop early if already running.  Used by
+    # the SIGUSR1 handler.
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            try:
+                self.start()
+            except ValueError as err:
+                logging.error("Can't start profiling: %s", str(err))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'mode': self._running_mode,
+            'elapsed_seconds': round(time.monotonic() - self._started, 3) if self.running else None,
+            'last_file': self.last_file,
+        }
+
+    def _summarize_profile(self, profile: 'cProfile.Profile') -> str:
+        import pstats
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(self._top)
+        return output.getvalue()
+
+    def _summarize_samples(self) -> str:
+        if not self._samples:
+            return 'no samples taken'
+        # a function counts once per sample however deep it recurses
+        cumulative: collections.Counter = collections.Counter()
+        for stack, count in self._stacks.items():
+            for function in set(stack.split(';')):
+                cumulative[function] += count
+        lines = ['%d samples, top functions by cumulative samples:' % self._samples]
+        for function, count in cumulative.most_common(self._top):
+            lines.append('%6.1f%%  %s' % (100.0 * count / self._samples, function))
+        return '\n'.join(lines)
+
+    # Runs in the sampler thread.
+    def _sample(self, thread_id: int):
+        while not self._sampling.wait(self._sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            self._stacks[';'.join(stack)] += 1
+            self._samples += 1
+
+
+class ProfileResource(Resource):
+    """GET returns the profiler status; POST starts or stops it.
+
+    POST accepts optional seconds and mode arguments; bad values get a
+    400 response.
+    """
+    isLeaf = True
+
+    def __init__(self, profiler: Profiler):
+        Resource.__init__(self)
+        self._profiler: Profiler = profiler
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self._profiler.status(), indent=2).encode('utf-8')
+
+    def render_POST(self, request):
+        if self._profiler.running:
+            self._profiler.stop()
+        else:
+            seconds = request.args.get(b'seconds')
+            mode = request.args.get(b'mode')
+            try:
+                self._profiler.start(float(seconds[0]) if seconds else None,
+                                     mode[0].decode('utf-8') if mode else None)
+            except ValueError as error:
+                request.setResponseCode(400)
+                return str(error).encode('utf-8')
+        return self.render_GET(request)
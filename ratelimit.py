@@ -0,0 +1,89 @@
+import email.utils
+import time
+from typing import NamedTuple, Optional
+
+# responses that mean "slow down": the request is retried, with the
+# newest state, once the server's Retry-After or our backoff has passed
+THROTTLE_STATUSES = (429, 503)
+
+
+class RateLimitSettings(NamedTuple):
+    # requests per second sustained; zero for no limit
+    rate: float
+    # requests that may be sent back to back before the rate applies
+    burst: int
+    # first wait after an error, doubled on each error in a row
+    backoff_min: float
+    # longest wait after errors, unless the server asks for longer
+    backoff_max: float
+
+
+class RateLimiter:
+    """A token bucket plus backoff for one api endpoint.
+
+    Each request takes a token; tokens refill at settings.rate up to
+    settings.burst.  After an error nothing is sent until the backoff,
+    or the server's Retry-After, has passed.  Times are monotonic
+    seconds passed in by the caller, so it needs no clock of its own.
+    """
+
+    def __init__(self, settings: RateLimitSettings, now: float):
+        self.settings: RateLimitSettings = settings
+        self._tokens: float = float(settings.burst)
+        self._updated: float = now
+        self._blocked_until: float = 0.0
+        self._backoff: float = 0.0
+
+    def update_settings(self, settings: RateLimitSettings):
+        self.settings = settings
+        self._tokens = min(self._tokens, float(settings.burst))
+
+    def _refill(self, now: float):
+        elapsed = max(now - self._updated, 0.0)
+        self._tokens = min(self._tokens + elapsed * self.settings.rate, float(self.settings.burst))
+        self._updated = now
+
+    # Seconds to wait before the next request may be sent; zero if it
+    # can go now.
+    def delay(self, now: float) -> float:
+        wait = max(self._blocked_until - now, 0.0)
+        if self.settings.rate > 0:
+            self._refill(now)
+            if self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / self.settings.rate)
+        return wait
+
+    # Take a token for a request being sent now.
+    def consume(self, now: float):
+        if self.settings.rate > 0:
+            self._refill(now)
+            self._tokens -= 1
+
+    def succeeded(self):
+        self._backoff = 0.0
+
+    # Back off after an error, or for retry_after seconds if the server
+    # said how long.  Returns the seconds until the next request.
+    def failed(self, now: float, retry_after: Optional[float] = None) -> float:
+        self._backoff = min(max(self._backoff * 2, self.settings.backoff_min),
+                            self.settings.backoff_max)
+        wait = retry_after if retry_after is not None else self._backoff
+        self._blocked_until = max(self._blocked_until, now + wait)
+        return self._blocked_until - now
+
+
+# Seconds to wait from a Retry-After header, which is either a number of
+# seconds or an http date; None if it is missing or can't be parsed.
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None or when.tzinfo is None:
+        return None
+    return max(when.timestamp() - (time.time() if now is None else now), 0.0)
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Capture replay
+#
+# Feeds a capture recorded with the capturefile option through an
+# EnvisalinkClient on a virtual clock, so hours of real panel traffic
+# can be replayed in seconds for regression and performance testing.
+#
+# This code is under the terms of the GPL v3 license.
+
+import getopt
+import json
+import logging
+import sys
+import time
+from typing import Dict, Any, Optional
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+import alarmserver
+from capture import CaptureReader
+from history import EventHistory
+
+
+class ReplaySmartThings:
+    """Counts updates instead of posting them."""
+
+    def __init__(self):
+        self.updates: int = 0
+        self.priority_updates: int = 0
+        self.errors: int = 0
+
+    def send_update(self, alarmserver_state, priority=False, trace=None):
+        self.updates += 1
+        if priority:
+            self.priority_updates += 1
+
+    def send_error(self, error_state):
+        self.errors += 1
+
+
+# Replay a capture; speed is the virtual seconds per wall second, or 0
+# to replay as fast as possible.
+def replay(config: alarmserver.AlarmServerConfig, capture_file: str,
+           speed: float = 0, start: float = 0,
+           history: Optional[EventHistory] = None) -> Dict[str, Any]:
+    reader = CaptureReader(capture_file)
+    reader.seek(start)
+    clock = Clock()
+    smartthings = ReplaySmartThings()
+    client = alarmserver.EnvisalinkClient(config, smartthings, clock, history=history)
+    transport = StringTransport()
+    client.makeConnection(transport)
+
+    frames = 0
+    first = None
+    offset = 0.0
+    wall_start = time.perf_counter()
+    for offset, frame in reader:
+        if offset < start:
+            continue
+        if first is None:
+            first = offset
+            clock.advance(offset)
+            if frame != b'Login:':
+                # the capture starts mid-session
+                client.handle_login_success('')
+        if speed > 0:
+            delay = (offset - first) / speed - (time.perf_counter() - wall_start)
+            if delay > 0:
+                time.sleep(delay)
+        # fire any timers that came due before this frame
+        clock.advance(offset - clock.seconds())
+        client.lineReceived(frame)
+        frames += 1
+    wall_seconds = time.perf_counter() - wall_start
+    client.stop_watchdogs()
+    reader.close()
+
+    virtual_seconds = offset - first if first is not None else 0.0
+    return {
+        'frames': frames,
+        'virtual_seconds': round(virtual_seconds, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'speedup': round(virtual_seconds / wall_seconds, 1) if wall_seconds else 0,
+        'frames_per_second': round(frames / wall_seconds, 1) if wall_seconds else 0,
+        'updates': smartthings.updates,
+        'priority_updates': smartthings.priority_updates,
+        'errors': smartthings.errors,
+        'commands_sent': transport.value().count(b'^'),
+    }
+
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' -c <configfile> -f <capturefile> [options]\n'
+          '  -s, --speed=N      replay at N times real time, 0 for as fast as possible\n'
+          '  -t, --start=S      start S seconds into the capture\n'
+          '  -H, --history=DB   record transitions to a history database\n'
+          '  -l, --loglevel=L   logging level (default WARNING)\n'
+          '  -S, --state        print the final alarm state')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hc:f:s:t:H:l:S",
+                                   ["help", "config=", "file=", "speed=", "start=",
+                                    "history=", "loglevel=", "state"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    conffile = 'alarmserver.cfg'
+    capture_file = None
+    speed = 0.0
+    start = 0.0
+    history_file = None
+    loglevel = 'WARNING'
+    print_state = False
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-c", "--config"):
+            conffile = arg
+        elif opt in ("-f", "--file"):
+            capture_file = arg
+        elif opt in ("-s", "--speed"):
+            speed = float(arg)
+        elif opt in ("-t", "--start"):
+            start = float(arg)
+        elif opt in ("-H", "--history"):
+            history_file = arg
+        elif opt in ("-l", "--loglevel"):
+            loglevel = arg
+        elif opt in ("-S", "--state"):
+            print_state = True
+    if capture_file is None:
+        usage()
+        sys.exit(2)
+
+    logging.basicConfig(level=loglevel,
+                        format='%(levelname)s <%(module)s %(funcName)s> %(message)s')
+    config = alarmserver.AlarmServerConfig(conffile)
+    config.initialize_alarmstate()
+    history = EventHistory(history_file) if history_file else None
+    results = replay(config, capture_file, speed, start, history)
+    if history is not None:
+        history.close()
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if print_state:
+        print(json.dumps(alarmserver.ALARMSTATE, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
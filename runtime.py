@@ -0,0 +1,54 @@
+import logging
+import os
+import sys
+from typing import List
+
+# Which event loop the reactor runs on:
+#   twisted  Twisted's default reactor (epoll on Linux)
+#   asyncio  Twisted's asyncio reactor on the standard library loop
+#   uvloop   Twisted's asyncio reactor on uvloop, if it is installed
+#
+# The reactor has to be installed before anything imports
+# twisted.internet.reactor, so the choice comes from the
+# ALARMSERVER_RUNTIME environment variable when this module is imported.
+RUNTIMES = ('twisted', 'asyncio', 'uvloop')
+ENVIRONMENT_VARIABLE = 'ALARMSERVER_RUNTIME'
+
+# messages for the log, which isn't set up yet when the reactor is installed
+_messages: List[str] = []
+
+
+def _install(name: str) -> str:
+    if name not in RUNTIMES:
+        _messages.append("Unknown %s '%s', using twisted" % (ENVIRONMENT_VARIABLE, name))
+        return 'twisted'
+    if name == 'twisted':
+        return name
+    if 'twisted.internet.reactor' in sys.modules:
+        _messages.append("The reactor was installed before the %s runtime could be, "
+                         "using it instead" % name)
+        return 'twisted'
+
+    import asyncio
+    from twisted.internet import asyncioreactor
+
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            _messages.append("uvloop is not installed, using the asyncio event loop")
+            name = 'asyncio'
+    loop = uvloop.new_event_loop() if name == 'uvloop' else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+    return name
+
+
+RUNTIME: str = _install(os.environ.get(ENVIRONMENT_VARIABLE, 'twisted'))
+
+
+# Log the runtime in use, once logging is configured.
+def log_runtime():
+    for message in _messages:
+        logging.warning(message)
+    logging.info("Running on the %s runtime", RUNTIME)
@@ -1,31 +1,175 @@
+import heapq
+import importlib.util
+import io
+import itertools
 import json
 import logging
 import queue
 import threading
+import time
+import weakref
 from datetime import datetime
 from datetime import timedelta
-from typing import Dict, Mapping
+from typing import Dict, List, Mapping, Optional, Tuple
 
-import requests
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 
 from baseConfig import BaseConfig
+from metrics import REGISTRY
+from ratelimit import THROTTLE_STATUSES, RateLimiter, RateLimitSettings, parse_retry_after
+from statestore import FrozenDict, SnapshotEncoder
+from tracing import TRACER, Trace
+
+# Labelled by panel.  Each panel's children are written on the reactor
+# thread, or on the panel's api thread, so panels sharing an api thread
+# never write the same child from two threads.
+# written on the reactor thread
+REQUESTS_ENQUEUED = REGISTRY.counter(
+    'smartthings_requests_enqueued_total', 'Api requests queued for the api thread', ['panel'])
+REQUESTS_DROPPED = REGISTRY.counter(
+    'smartthings_requests_dropped_total',
+    'Queued api requests dropped because the queue was full', ['panel'])
+REQUESTS_COALESCED = REGISTRY.counter(
+    'smartthings_requests_coalesced_total',
+    'Queued api requests replaced by a priority request', ['panel'])
+# written on the panel's api thread, or the reactor thread by the async
+# sender
+REQUESTS_DEDUPED = REGISTRY.counter(
+    'smartthings_requests_deduped_total',
+    'Api requests skipped as repeats of a recent post', ['panel'])
+POSTS = REGISTRY.counter(
+    'smartthings_posts_total', 'Api posts by http status, or error', ['panel', 'status'])
+POST_SECONDS = REGISTRY.histogram(
+    'smartthings_post_seconds', 'Time taken by each api post', ['panel'])
+THROTTLED_SECONDS = REGISTRY.counter(
+    'smartthings_throttled_seconds_total',
+    'Seconds api requests waited for the rate limit or backoff', ['panel', 'path'])
+TOKENS_CONSUMED = REGISTRY.counter(
+    'smartthings_tokens_consumed_total', 'Rate limit tokens taken by api posts',
+    ['panel', 'path'])
+RETRIES = REGISTRY.counter(
+    'smartthings_retries_total', 'Api requests retried after a 429 or 503 response', ['panel'])
+REQUESTS_SUPERSEDED = REGISTRY.counter(
+    'smartthings_requests_superseded_total',
+    'Api requests held by the rate limit and replaced by a newer one', ['panel'])
+
+# every sender, for the total queue depth
+_SENDERS: 'weakref.WeakSet[SmartThings]' = weakref.WeakSet()
+
+
+def _queue_depth() -> int:
+    return sum(sender._queue.qsize() for sender in list(_SENDERS))
+
+
+REGISTRY.callback_gauge('smartthings_queue_depth',
+                        'Api requests waiting to be sent, over all panels', _queue_depth)
+
+SENDER_THREAD = 'thread'
+SENDER_ASYNC = 'async'
+SENDERS = (SENDER_THREAD, SENDER_ASYNC)
+
+
+class _ApiThread:
+    """One api thread, posting for the panels assigned to it in turn."""
+
+    def __init__(self, index: int):
+        # panels with a request to send
+        self._ready: queue.Queue = queue.Queue()
+        # (when, order, panel) for panels held by their rate limit; only
+        # used on this thread
+        self._held: List[Tuple[float, int, 'SmartThings']] = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._is_exiting = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="SmartThings api thread %d" % index)
+        self._thread.start()
+
+    # Called on the reactor thread once sender has queued a request.  A
+    # panel is in the ready queue, held or being posted for at most once.
+    def schedule(self, sender: 'SmartThings'):
+        with self._lock:
+            if sender._scheduled:
+                return
+            sender._scheduled = True
+        self._ready.put(sender)
+
+    def stop(self):
+        self._is_exiting.set()
+        # wake up the thread if necessary
+        self._ready.put(None)
+
+    def _run(self):
+        logging.info("SmartThings api thread starting")
+        while not self._is_exiting.is_set():
+            now = time.monotonic()
+            while self._held and self._held[0][0] <= now:
+                self._ready.put(heapq.heappop(self._held)[2])
+            try:
+                sender = self._ready.get(
+                    timeout=self._held[0][0] - now if self._held else None)
+            except queue.Empty:
+                continue
+            if sender is None:
+                continue
+            delay = sender._post_next()
+            with self._lock:
+                if delay > 0:
+                    heapq.heappush(self._held,
+                                   (time.monotonic() + delay, next(self._order), sender))
+                elif sender._has_work():
+                    self._ready.put(sender)
+                else:
+                    sender._scheduled = False
+        logging.info("SmartThings api thread exiting")
+
+
+class SenderPool:
+    """The api threads shared by every panel's thread sender.
+
+    Panels are assigned to the threads in turn when they are created, so
+    a panel's requests go out in order and its metrics are only written
+    by its thread.  A thread posts for its panels one request at a
+    time; a panel held by its rate limit doesn't hold up the others.
+    """
+
+    def __init__(self):
+        self.size: int = 1
+        self._threads: List[_ApiThread] = []
+        self._assigned: int = 0
+
+    # Set the number of threads; only threads not yet started are affected.
+    def configure(self, size: int):
+        self.size = size
+
+    def assign(self) -> _ApiThread:
+        index = self._assigned % self.size
+        self._assigned += 1
+        if index < len(self._threads):
+            return self._threads[index]
+        if not self._threads:
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        thread = _ApiThread(len(self._threads))
+        self._threads.append(thread)
+        return thread
+
+    # Signal the api threads to exit.  Senders created later start new
+    # ones.
+    def stop(self):
+        threads, self._threads = self._threads, []
+        self._assigned = 0
+        if threads:
+            logging.info("Shutting down SmartThings api threads")
+        for thread in threads:
+            thread.stop()
+
+
+SENDER_POOL = SenderPool()
 
 
 class SmartThings:
     def __init__(self, config: BaseConfig):
-        self._config: BaseConfig = config
-        self._CALLBACKURL_BASE: str = self._get_config_str('callbackurl_base')
-        self._CALLBACKURL_APP_ID: str = self._get_config_str('callbackurl_app_id')
-        self._CALLBACKURL_ACCESS_TOKEN: str = self._get_config_str('callbackurl_access_token')
-        # http timeout in seconds for api requests
-        self._API_TIMEOUT: int = self._get_config_int('api_timeout', 10)
-        # max number of requests to enqueue before dropping them
-        self._QUEUE_SIZE: int = self._get_config_int('queue_size', 100)
-
-        #  URL example: ${url_base}/${app_id}/update?access_token=${token}
-        self._urlbase: str = self._CALLBACKURL_BASE + "/" + self._CALLBACKURL_APP_ID
-        logging.info("SmartThings url: %s", self._urlbase)
+        self._read_config(config)
 
         # Track recent payloads and their timestamps so we can avoid
         # sending duplicate updates.  We track the last N updates to
@@ -33,23 +177,73 @@ class SmartThings:
         # cycles between several messages.  Dedup updates within the
         # past N seconds.
         self._cache: Dict[str, datetime] = {}
-        # Max interval between sending duplicate updates.
-        self._REPEAT_UPDATE_INTERVAL = timedelta(
-            seconds=self._get_config_int('repeat_update_interval', 55))
+        # rate limit and backoff for each api path
+        self._limiters: Dict[str, RateLimiter] = {}
+        # used only by the sender, which serializes state snapshots
+        self._encoder = SnapshotEncoder()
+        # this panel's metric children
+        self._panel: str = config.PANEL or 'default'
+        self._enqueued = REQUESTS_ENQUEUED.labels(self._panel)
+        self._dropped = REQUESTS_DROPPED.labels(self._panel)
+        self._coalesced = REQUESTS_COALESCED.labels(self._panel)
+        self._deduped = REQUESTS_DEDUPED.labels(self._panel)
+        self._post_seconds = POST_SECONDS.labels(self._panel)
+        self._retries = RETRIES.labels(self._panel)
+        self._superseded = REQUESTS_SUPERSEDED.labels(self._panel)
 
-        # set up a queue and thread to send api request asynchronously
+        # set up a queue and a sender to send api request asynchronously
         self._is_exiting = threading.Event()
         self._queue: queue.Queue = queue.Queue(self._QUEUE_SIZE)
-        self._api_thread = threading.Thread(
-            target=self._run_api_thread, name="SmartThings api thread")
-        self._api_thread.start()
+        # the request held by the rate limit or to be retried, and
+        # whether the api thread has this panel in hand
+        self._pending: Optional[list] = None
+        self._scheduled: bool = False
+        self._start_sender()
+        _SENDERS.add(self)
 
         self._shutdowntriggerid = reactor.addSystemEventTrigger(
             'before', 'shutdown', self._shutdown_event_handler)
 
-    # Sends a regular polling update to SmartThings.
-    def send_update(self, alarmserver_state: Mapping):
-        self.send_api_request("update", alarmserver_state)
+    def _start_sender(self):
+        self._api_thread: _ApiThread = SENDER_POOL.assign()
+
+    # Let the sender know a request was queued.
+    def _wake_sender(self):
+        self._api_thread.schedule(self)
+
+    def _read_config(self, config: BaseConfig):
+        self._config: BaseConfig = config
+        self._CALLBACKURL_BASE: str = config.CALLBACKURL_BASE
+        self._CALLBACKURL_APP_ID: str = config.CALLBACKURL_APP_ID
+        self._CALLBACKURL_ACCESS_TOKEN: str = config.CALLBACKURL_ACCESS_TOKEN
+        # http timeout in seconds for api requests
+        self._API_TIMEOUT: int = config.API_TIMEOUT
+        # max number of requests to enqueue before dropping them
+        self._QUEUE_SIZE: int = config.QUEUE_SIZE
+        # Max interval between sending duplicate updates.
+        self._REPEAT_UPDATE_INTERVAL = timedelta(seconds=config.REPEAT_UPDATE_INTERVAL)
+        self._RATE_LIMIT = RateLimitSettings(config.RATE_LIMIT, config.RATE_LIMIT_BURST,
+                                             config.BACKOFF_MIN, config.BACKOFF_MAX)
+
+        #  URL example: ${url_base}/${app_id}/update?access_token=${token}
+        self._urlbase: str = self._CALLBACKURL_BASE + "/" + self._CALLBACKURL_APP_ID
+        logging.info("SmartThings url: %s", self._urlbase)
+
+    # Apply a reloaded config.  The api thread uses the new settings from
+    # its next request; requests already queued are kept, even past a
+    # smaller queue size.
+    def reconfigure(self, config: BaseConfig):
+        self._read_config(config)
+        with self._queue.mutex:
+            self._queue.maxsize = self._QUEUE_SIZE
+        for limiter in list(self._limiters.values()):
+            limiter.update_settings(self._RATE_LIMIT)
+
+    # Sends a regular polling update to SmartThings.  Every update carries
+    # the full state, so a priority update replaces any queued ones.
+    def send_update(self, alarmserver_state: Mapping, priority: bool = False,
+                    trace: Optional[Trace] = None):
+        self.send_api_request("update", alarmserver_state, priority, trace)
 
     # TODO: send an error to SmartThings.
     def send_error(self, error_state: str):
@@ -59,17 +253,30 @@ class SmartThings:
 
     # Send an api request to SmartThings, asynchronously.
     # path: relative to self._urlbase
-    # payload: dict used as body of the post, json-encoded.
-    def send_api_request(self, path: str, payload):
-        # because we're sending this asynchronously, dump the payload
-        # to a string so it's not affected by future updates
-        data = json.dumps(payload)
+    # payload: dict used as body of the post, json-encoded; a state
+    # snapshot is encoded by the sender, off the reactor thread.
+    # priority: drop queued requests to the same path so this one goes
+    # out next.
+    # trace: follows the request to the api thread to time each stage.
+    def send_api_request(self, path: str, payload, priority: bool = False,
+                         trace: Optional[Trace] = None):
+        # because we're sending this asynchronously, dump anything but
+        # an immutable snapshot to a string so it's not affected by
+        # future updates
+        data = payload if isinstance(payload, FrozenDict) else json.dumps(payload)
+
+        if priority:
+            dropped = self._drop_queued_requests(path)
+            if dropped:
+                self._coalesced.inc(len(dropped))
+                self._finish_coalesced(dropped)
 
         # if the queue is full, pull off the oldest item to make
         # space for the newer item.
         if self._queue.full():
             logging.warning("Queue is full, dropping one item, size=%d",
                             self._queue.qsize())
+            self._dropped.inc()
             try:
                 self._queue.get(block=False)
             except queue.Empty:
@@ -77,23 +284,38 @@ class SmartThings:
                 pass
 
         try:
-            self._queue.put([path, data], block=False)
+            self._queue.put([path, data, trace], block=False)
+            self._enqueued.inc()
+            if trace is not None:
+                trace.mark('queued')
             logging.debug("Enqueued smartthings api request to /%s", path)
         except queue.Full:
             logging.error("SmartThings api request failed: queue is full; "
                           "qsize=%d path=%s payload=%s",
                           self._queue.qsize(), path, payload)
+        self._wake_sender()
 
-    def _get_config_int(self, variable: str, default: int) -> int:
-        return self._config.get_int('smartthings', variable, default)
+    # Remove queued requests for path, keeping any others in order.
+    # Returns the removed requests, oldest first.
+    def _drop_queued_requests(self, path: str) -> List[list]:
+        with self._queue.mutex:
+            kept = [item for item in self._queue.queue if item[0] != path]
+            dropped = [item for item in self._queue.queue if item[0] == path]
+            self._queue.queue.clear()
+            self._queue.queue.extend(kept)
+            self._queue.unfinished_tasks -= len(dropped)
+        if dropped:
+            logging.debug("Dropped %d queued requests to /%s", len(dropped), path)
+        return dropped
 
-    # read smartthings config var
-    def _get_config_str(self, varname: str) -> str:
-        return self._config.get_str('smartthings', varname, 'not_provided')
+    @staticmethod
+    def _finish_coalesced(requests: List[list]):
+        for _, _, trace in requests:
+            if trace is not None:
+                TRACER.finish(trace, 'coalesced')
 
     ####
     # Methods used by the api thread
-    # TODO: encapsulate api thread as an object
 
     # Add a payload to the cache, removing the oldest item if necessary.
     def _add_to_cache(self, payload: str, timestamp: datetime):
@@ -106,52 +328,325 @@ class SmartThings:
         self._cache[payload] = timestamp
         logging.debug("payload cache size is %d", len(self._cache))
 
-    # Callback which runs before shutdown: signal the api thread to exit.
+    # Suppress identical updates within the repeat update interval.
+    def _is_repeat(self, payload: str, now: datetime) -> bool:
+        update_delta = now - self._cache.get(payload, datetime.min)
+        if update_delta < self._REPEAT_UPDATE_INTERVAL:
+            logging.debug("Skipping repeat update at %s seconds", update_delta)
+            self._deduped.inc()
+            return True
+        return False
+
+    def _limiter(self, path: str) -> RateLimiter:
+        limiter = self._limiters.get(path)
+        if limiter is None:
+            limiter = self._limiters[path] = RateLimiter(self._RATE_LIMIT, time.monotonic())
+        return limiter
+
+    # Seconds request must wait for its path's rate limit or backoff.
+    def _throttle_delay(self, request: list) -> float:
+        delay = self._limiter(request[0]).delay(time.monotonic())
+        if delay > 0:
+            THROTTLED_SECONDS.labels(self._panel, request[0]).inc(delay)
+            logging.debug("Holding api request to /%s for %.3f seconds", request[0], delay)
+        return delay
+
+    # After waiting out the rate limit, send the newest request queued for
+    # the same path instead: every update carries the full state.  Runs
+    # on the sender, so it is counted apart from the reactor's coalescing.
+    def _newest_request(self, request: list) -> list:
+        newer = self._drop_queued_requests(request[0])
+        if not newer:
+            return request
+        self._superseded.inc(len(newer))
+        self._finish_coalesced([request] + newer[:-1])
+        if newer[-1][2] is not None:
+            newer[-1][2].mark('dequeued')
+        return newer[-1]
+
+    # Note a response in the limiter for path and return the outcome:
+    # posted, throttled (to be retried) or failed.
+    def _response_outcome(self, path: str, status: int, retry_after: Optional[str]) -> str:
+        limiter = self._limiter(path)
+        if status in (200, 201, 202):
+            limiter.succeeded()
+            return 'posted'
+        if status in THROTTLE_STATUSES:
+            wait = limiter.failed(time.monotonic(), parse_retry_after(retry_after))
+            self._retries.inc()
+            logging.warning("SmartThings api returned %d for /%s, retrying the newest "
+                            "update in %.1f seconds", status, path, wait)
+            return 'throttled'
+        if status >= 500:
+            limiter.failed(time.monotonic())
+        return 'failed'
+
+    # Encode a queued payload, off the reactor thread.  Snapshots share
+    # unchanged zones and partitions with the last one, whose text is
+    # reused.
+    def _serialize(self, payload) -> str:
+        if not isinstance(payload, str):
+            payload = self._encoder.encode(payload)
+        return payload
+
+    @staticmethod
+    def _finish(trace: Optional[Trace], outcome: str):
+        if trace is not None:
+            if outcome == 'posted':
+                trace.mark('posted')
+            TRACER.finish(trace, outcome)
+
+    def _url(self, path: str) -> str:
+        return self._urlbase + "/" + path + "?access_token=" + self._CALLBACKURL_ACCESS_TOKEN
+
+    # Callback which runs before shutdown: stop sending.  The api
+    # threads are stopped by SENDER_POOL.
     def _shutdown_event_handler(self):
-        logging.info("Shutting down SmartThings api thread")
-        # set the is_exiting event so the loop will exit
         self._is_exiting.set()
-        # put an empty item on the queue to wake up the thread if necessary
-        self._queue.put(["", ""])
 
-    # Main loop for worker thread: loop forever, pulling requests off the queue.
-    def _run_api_thread(self):
-        logging.info("SmartThings api thread starting")
-        while not self._is_exiting.is_set():
-            try:
-                # wake up once per second
-                [path, payload] = self._queue.get(block=True, timeout=1)
-                # only post if not empty
-                if path:
-                    self._post_api_synchronous(path, payload)
+    # Whether every queued request has been sent or dropped.
+    def idle(self) -> bool:
+        return not self._scheduled
+
+    def _has_work(self) -> bool:
+        return not self._is_exiting.is_set() and (
+            self._pending is not None or not self._queue.empty())
+
+    # Runs on the panel's api thread: post the next request, or the one
+    # held back.  A request held by the rate limit, or throttled by the
+    # server, is kept until it can be sent or a newer one replaces it.
+    # Returns the seconds it has to wait, or zero.
+    def _post_next(self) -> float:
+        if self._is_exiting.is_set():
+            return 0
+        request = None
+        try:
+            if self._pending is not None:
+                request = self._newest_request(self._pending)
+                self._pending = None
+            else:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    return 0
                 self._queue.task_done()
-            except queue.Empty:
-                pass
-        logging.info("SmartThings api thread exiting")
+                if request[2] is not None:
+                    request[2].mark('dequeued')
+            delay = self._throttle_delay(request)
+            if delay > 0:
+                self._pending = request
+                return delay
+            path, payload, trace = request
+            data = self._serialize(payload)
+            if trace is not None:
+                trace.mark('serialized')
+            outcome = self._post_api_synchronous(path, data)
+        except Exception:
+            # e.g. the encoder raised; the thread posts for other panels
+            # too, so it carries on with the next request
+            logging.exception("Error sending a smartthings api request")
+            self._pending = None
+            if request is not None:
+                self._finish(request[2], 'error')
+            return 0
+        if outcome == 'throttled':
+            self._pending = request
+            return 0
+        self._finish(trace, outcome)
+        return 0
 
     # Sends an api request synchronously, should only run in worker thread.
-    def _post_api_synchronous(self, path: str, payload: str):
-        # suppress identical updates within a specified interval.
+    # Returns the outcome: posted, deduped, failed or error.
+    def _post_api_synchronous(self, path: str, payload: str) -> str:
+        # requests takes longer to import than the rest of startup, so it
+        # is imported here, on the api thread, once the first update is
+        # ready rather than before connecting to the Envisalink
+        import requests
+
         now = datetime.now()
-        update_delta = now - self._cache.get(payload, datetime.min)
-        if update_delta < self._REPEAT_UPDATE_INTERVAL:
-            logging.debug("Skipping repeat update at %s seconds", update_delta)
-            return
+        if self._is_repeat(payload, now):
+            return 'deduped'
 
+        self._limiter(path).consume(time.monotonic())
+        TOKENS_CONSUMED.labels(self._panel, path).inc()
         try:
             logging.debug("Posting smartthings api to /%s", path)
-            url = (self._urlbase + "/" + path +
-                   "?access_token=" + self._CALLBACKURL_ACCESS_TOKEN)
-            response = requests.post(url, data=payload, timeout=self._API_TIMEOUT)
-            if response.status_code not in [requests.codes.ok,
-                                            requests.codes.created,
-                                            requests.codes.accepted]:
+            url = self._url(path)
+            start = time.perf_counter()
+            try:
+                response = requests.post(url, data=payload, timeout=self._API_TIMEOUT)
+            finally:
+                self._post_seconds.observe(time.perf_counter() - start)
+            POSTS.labels(self._panel, response.status_code).inc()
+            outcome = self._response_outcome(path, response.status_code,
+                                             response.headers.get('Retry-After'))
+            if outcome == 'throttled':
+                return outcome
+            if outcome == 'failed':
                 logging.error("Problem posting a smartthings notification; "
                               "url: %s status: %d response: %s",
                               url, response.status_code, response.text)
-            else:
-                logging.debug("Successfully posted smartthings api; "
-                              "path=%s payload=%s", path, payload)
-                self._add_to_cache(payload, now)
+                return 'failed'
+            logging.debug("Successfully posted smartthings api; "
+                          "path=%s payload=%s", path, payload)
+            self._add_to_cache(payload, now)
+            return 'posted'
         except requests.exceptions.RequestException as err:
+            POSTS.labels(self._panel, 'error').inc()
+            self._limiter(path).failed(time.monotonic())
             logging.error("Error communicating with smartthings server: %s", str(err))
+            return 'error'
+
+
+class AsyncSmartThings(SmartThings):
+    """Posts from the reactor with Twisted's http client instead of a thread.
+
+    Requests go through the same queue, with the same coalescing and
+    deduplication, one at a time over a persistent connection.  Works
+    on any reactor, including the asyncio and uvloop runtimes.
+    """
+
+    def _start_sender(self):
+        # only imported when this sender is chosen
+        from twisted.web.client import Agent, HTTPConnectionPool
+
+        self._posting: bool = False
+        # the request being sent, or held by the rate limit
+        self._request: Optional[list] = None
+        self._holding = None
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = 1
+        self._agent = Agent(reactor, pool=self._pool, connectTimeout=self._API_TIMEOUT)
+
+    def _wake_sender(self):
+        self._send_next()
+
+    def idle(self) -> bool:
+        return not self._posting and self._holding is None and self._queue.empty()
+
+    # Post the next queued request unless one is in flight or held by
+    # the rate limit.
+    def _send_next(self):
+        while not self._posting and self._holding is None and not self._is_exiting.is_set():
+            if self._request is None:
+                try:
+                    self._request = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+                self._queue.task_done()
+                if self._request[2] is not None:
+                    self._request[2].mark('dequeued')
+            delay = self._throttle_delay(self._request)
+            if delay > 0:
+                self._holding = reactor.callLater(delay, self._held)
+                return
+            path, payload, trace = self._request
+            self._posting = True
+            posting = threads.deferToThread(self._prepare, payload)
+            posting.addCallback(self._post_prepared, path, trace)
+            posting.addErrback(self._send_failed)
+            posting.addCallback(self._outcome)
+            posting.addBoth(self._posted)
+            return
+
+    # Serialize in the reactor's thread pool.  Only the encoder is used
+    # there; metrics and the repeat cache stay on the reactor thread.
+    def _prepare(self, payload) -> str:
+        data = self._serialize(payload)
+        # strings cache their hash, so the repeat check costs the reactor
+        # nothing more
+        hash(data)
+        return data
+
+    def _post_prepared(self, data: str, path: str, trace: Optional[Trace]):
+        if trace is not None:
+            trace.mark('serialized')
+        now = datetime.now()
+        if self._is_repeat(data, now):
+            return 'deduped'
+        self._limiter(path).consume(time.monotonic())
+        TOKENS_CONSUMED.labels(self._panel, path).inc()
+        return self._post(path, data, now)
+
+    # e.g. the encoder raised, or the body of a response was cut off
+    @staticmethod
+    def _send_failed(failure) -> str:
+        logging.error("Error sending a smartthings api request: %s", failure.getTraceback())
+        return 'error'
+
+    def _held(self):
+        self._holding = None
+        self._request = self._newest_request(self._request)
+        self._send_next()
+
+    # A throttled request stays current, to be retried.
+    def _outcome(self, outcome: str):
+        if outcome != 'throttled':
+            self._finish(self._request[2], outcome)
+            self._request = None
+
+    def _post(self, path: str, payload: str, now: datetime):
+        from twisted.internet.defer import succeed
+        from twisted.web.client import FileBodyProducer, readBody
+
+        logging.debug("Posting smartthings api to /%s", path)
+        url = self._url(path)
+        start = time.perf_counter()
+        request = self._agent.request(b'POST', url.encode('utf-8'), None,
+                                      FileBodyProducer(io.BytesIO(payload.encode('utf-8'))))
+        request.addTimeout(self._API_TIMEOUT, reactor)
+
+        def received(response):
+            self._post_seconds.observe(time.perf_counter() - start)
+            POSTS.labels(self._panel, response.code).inc()
+            body = readBody(response)
+            retry_after = response.headers.getRawHeaders(b'retry-after', [b''])[0]
+            outcome = self._response_outcome(path, response.code, retry_after.decode('latin-1'))
+            if outcome == 'throttled':
+                return body.addBoth(lambda _: outcome)
+            if outcome == 'failed':
+                body.addCallback(lambda text: logging.error(
+                    "Problem posting a smartthings notification; url: %s status: %d "
+                    "response: %s", url, response.code, text.decode('utf-8', 'replace')))
+                return body.addCallback(lambda _: 'failed')
+            logging.debug("Successfully posted smartthings api; path=%s payload=%s",
+                          path, payload)
+            self._add_to_cache(payload, now)
+            # read the body so the connection can be reused
+            return body.addCallback(lambda _: 'posted')
+
+        def failed(failure):
+            self._post_seconds.observe(time.perf_counter() - start)
+            POSTS.labels(self._panel, 'error').inc()
+            self._limiter(path).failed(time.monotonic())
+            # ResponseFailed and friends wrap the failures that caused them
+            reasons = getattr(failure.value, 'reasons', None) or [failure]
+            logging.error("Error communicating with smartthings server: %s",
+                          ', '.join(reason.getErrorMessage() for reason in reasons))
+            return succeed('error')
+
+        return request.addCallbacks(received, failed)
+
+    def _posted(self, result):
+        self._posting = False
+        self._send_next()
+
+    def _shutdown_event_handler(self):
+        logging.info("Shutting down SmartThings sender")
+        self._is_exiting.set()
+        if self._holding is not None and self._holding.active():
+            self._holding.cancel()
+        return self._pool.closeCachedConnections()
+
+
+# The sender chosen by sender= in [smartthings].  The async sender needs
+# Twisted's tls extra for an https callback url.
+def create_smartthings(config: BaseConfig) -> SmartThings:
+    if config.SENDER == SENDER_ASYNC:
+        if (config.CALLBACKURL_BASE.startswith('https:') and
+                importlib.util.find_spec('OpenSSL') is None):
+            logging.error("The async SmartThings sender needs pyOpenSSL for https, "
+                          "install twisted[tls]; using the thread sender")
+        else:
+            return AsyncSmartThings(config)
+    return SmartThings(config)
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from twisted.internet import reactor
+
+from timers import MONOTONIC
+
+
+class StateSnapshot:
+    """Checkpoints the alarm state to a JSON file and restores it on boot.
+
+    Changes are written at most once every min_interval seconds, from a
+    reactor pool thread so the reactor never waits on the disk.  Each
+    write goes to a temporary file that replaces the snapshot, so a
+    crash mid-write leaves the previous snapshot intact.
+    """
+
+    def __init__(self, filename: str, min_interval: float = 5, clock=MONOTONIC):
+        self._filename: str = filename
+        self._min_interval: float = min_interval
+        self._clock = clock
+        self._lastwrite: float = -min_interval
+        self._call = None
+        self._state: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+
+    # Merge the saved state into state, marking every restored zone and
+    # partition stale until the panel confirms it.  Zones and partitions
+    # no longer configured are ignored.
+    def load(self, state: Dict[str, Any]) -> bool:
+        try:
+            with open(self._filename) as snapshot_file:
+                saved = json.load(snapshot_file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as err:
+            logging.warning("Ignoring unreadable state snapshot %s: %s", self._filename, str(err))
+            return False
+
+        restored = 0
+        for kind in ('zone', 'partition'):
+            for number, saved_entry in saved.get(kind, {}).items():
+                entry = state[kind].get(int(number))
+                if entry is None:
+                    continue
+                name = entry['name']
+                entry.update(saved_entry)
+                entry['name'] = name
+                entry['stale'] = True
+                restored += 1
+        logging.info("Restored %d zones and partitions from state snapshot saved %s",
+                     restored, saved.get('saved', 'at an unknown time'))
+        return True
+
+    # Called with an immutable snapshot whenever state changes; schedules
+    # a write if none is due.
+    def changed(self, state: Dict[str, Any]):
+        self._state = state
+        if self._call is not None and self._call.active():
+            return
+        delay = max(0.0, self._lastwrite + self._min_interval - self._clock.seconds())
+        self._call = self._clock.callLater(delay, self._checkpoint)
+
+    def _checkpoint(self):
+        self._lastwrite = self._clock.seconds()
+        # the snapshot can't change, so the thread serializes it
+        reactor.callInThread(self._write, self._state)
+
+    # Write the latest state now and stop scheduling writes.
+    def close(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._state is not None:
+            self._write(self._state)
+
+    @staticmethod
+    def _serialize(state: Dict[str, Any]) -> str:
+        return json.dumps({
+            'saved': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'zone': state['zone'],
+            'partition': state['partition'],
+        })
+
+    def _write(self, state: Dict[str, Any]):
+        data = self._serialize(state)
+        temporary = self._filename + '.tmp'
+        with self._lock:
+            try:
+                with open(temporary, 'w') as snapshot_file:
+                    snapshot_file.write(data)
+                    snapshot_file.flush()
+                    os.fsync(snapshot_file.fileno())
+                os.replace(temporary, self._filename)
+            except OSError as err:
+                logging.error("Error writing state snapshot %s: %s", self._filename, str(err))
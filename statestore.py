@@ -0,0 +1,177 @@
+import json
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed once built.
+
+    Still a dict, so json.dumps and readers of the state take it as is.
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('state snapshots are immutable')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class EntityState(dict):
+    """A zone or partition record that tells its EntityMap when it changes."""
+    __slots__ = ('_map', '_key')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._map: Optional['EntityMap'] = None
+        self._key = None
+
+    def _touch(self):
+        if self._map is not None:
+            self._map.touched(self._key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._touch()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._touch()
+        return value
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        self._touch()
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        self._touch()
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._touch()
+        return item
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class EntityMap(dict):
+    """The zones or partitions of the state, by number.
+
+    Entities are updated in place on the reactor thread.  snapshot()
+    returns an immutable copy that other threads can read while the
+    state keeps changing.  Only entities changed since the last snapshot
+    are copied; the others are the same objects as in that snapshot.
+    The map of entities itself is copied whole on a change, which is one
+    reference per zone or partition, so a snapshot costs O(entities)
+    rather than O(changed entities).
+    """
+    __slots__ = ('_touched', '_snapshot')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._touched: Set[Any] = set()
+        self._snapshot: Optional[FrozenDict] = None
+        self.update(*args, **kwargs)
+
+    def touched(self, key):
+        self._touched.add(key)
+
+    def __setitem__(self, key, entity):
+        if not isinstance(entity, EntityState):
+            entity = EntityState(entity)
+        entity._map, entity._key = self, key
+        dict.__setitem__(self, key, entity)
+        # added or replaced: the snapshot is rebuilt in order
+        self._snapshot = None
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._snapshot = None
+
+    def update(self, *args, **kwargs):
+        for key, entity in dict(*args, **kwargs).items():
+            self[key] = entity
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._snapshot = None
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        self._snapshot = None
+
+    def snapshot(self) -> FrozenDict:
+        previous = self._snapshot
+        if previous is None:
+            self._snapshot = FrozenDict((key, FrozenDict(entity)) for key, entity in self.items())
+        elif self._touched:
+            # only the records are shared; the top-level map is copied
+            entities = dict(previous)
+            for key in self._touched:
+                entities[key] = FrozenDict(self[key])
+            self._snapshot = FrozenDict(entities)
+        self._touched.clear()
+        return self._snapshot
+
+
+# An immutable snapshot of the alarm state: the zone and partition
+# snapshots of its EntityMaps, which are reused while nothing changes.
+def state_snapshot(state: Dict[str, EntityMap]) -> FrozenDict:
+    return FrozenDict((kind, entities.snapshot()) for kind, entities in state.items())
+
+
+class SnapshotEncoder:
+    """Encodes snapshots as json.dumps does, reusing unchanged parts.
+
+    Snapshots share every record, and every zone or partition map, that
+    didn't change, so the text of each is kept from the last snapshot
+    encoded and only what changed is encoded again.  Keeps no more than
+    the last snapshot's parts; use one encoder per thread.
+    """
+
+    def __init__(self):
+        self._texts: Dict[int, Tuple[FrozenDict, str]] = {}
+
+    def encode(self, value) -> str:
+        if not isinstance(value, FrozenDict):
+            return json.dumps(value)
+        texts: Dict[int, Tuple[FrozenDict, str]] = {}
+        text = self._encode(value, texts)
+        self._texts = texts
+        return text
+
+    def _encode(self, value: FrozenDict, texts: Dict[int, Tuple[FrozenDict, str]]) -> str:
+        cached = self._texts.get(id(value))
+        if cached is not None and cached[0] is value:
+            texts[id(value)] = cached
+            return cached[1]
+        if not any(isinstance(item, FrozenDict) for item in value.values()):
+            # a record: encoded whole
+            text = json.dumps(value)
+            texts[id(value)] = (value, text)
+            return text
+        parts = []
+        for key, item in value.items():
+            if isinstance(item, FrozenDict):
+                item_text = self._encode(item, texts)
+            else:
+                item_text = json.dumps(item)
+            parts.append(json.dumps(key if isinstance(key, str) else str(key)) + ': ' + item_text)
+        text = '{' + ', '.join(parts) + '}'
+        texts[id(value)] = (value, text)
+        return text
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+# AlarmServer supervisor
+#
+# Shards the panels of a multi-panel config across worker processes so
+# parsing and state updates use more than one core.  Crashed workers are
+# restarted on their own, and the workers' metrics and state are served
+# together on the admin port, fetched from each worker over a unix
+# socket.
+#
+# This code is under the terms of the GPL v3 license.
+
+import getopt
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.python import log
+from twisted.web.client import Agent, readBody
+from twisted.web.iweb import IAgentEndpointFactory
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from zope.interface import implementer
+
+from alarmserver import AlarmServerConfig
+from logqueue import configure_logging
+from metrics import MetricsRegistry
+
+ALARMSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alarmserver.py')
+
+# restart delays double from the minimum up to the maximum, and reset
+# once a worker has stayed up for the maximum
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+# how long workers get to shut down before they are killed
+STOP_TIMEOUT = 10.0
+
+# the supervisor's own metrics, kept apart from the alarmserver metrics
+# that importing alarmserver registers
+SUPERVISOR_REGISTRY = MetricsRegistry()
+WORKER_STARTS = SUPERVISOR_REGISTRY.counter(
+    'alarmserver_supervisor_worker_starts_total', 'Worker processes started', ['shard'])
+WORKER_EXITS = SUPERVISOR_REGISTRY.counter(
+    'alarmserver_supervisor_worker_exits_total', 'Worker processes that exited', ['shard'])
+
+
+@implementer(IAgentEndpointFactory)
+class _UnixEndpointFactory:
+    def __init__(self, path: str):
+        self._path: str = path
+
+    def endpointForURI(self, uri):
+        return UNIXClientEndpoint(reactor, self._path)
+
+
+class Worker(protocol.ProcessProtocol):
+    """One alarmserver.py process serving a shard of the panels."""
+
+    def __init__(self, supervisor: 'Supervisor', shard: int, panels: List[str],
+                 socket_path: str):
+        self.supervisor: 'Supervisor' = supervisor
+        self.shard: int = shard
+        self.panels: List[str] = panels
+        self.socket_path: str = socket_path
+        self.agent = Agent.usingEndpointFactory(reactor, _UnixEndpointFactory(socket_path))
+        self.started: float = 0.0
+        self.running: bool = False
+        self.restart_delay: float = MIN_RESTART_DELAY
+        self.ended: Optional[defer.Deferred] = None
+
+    def processEnded(self, reason):
+        self.running = False
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor:
+    def __init__(self, config_file: str, config: AlarmServerConfig, workers: int,
+                 socket_dir: str):
+        self._config_file: str = config_file
+        self._stopping: bool = False
+        self.workers: List[Worker] = []
+        for shard in range(min(workers, len(config.PANELS))):
+            # round robin so shards get similar numbers of panels
+            self.workers.append(Worker(self, shard, list(config.PANELS[shard::workers]),
+                                       os.path.join(socket_dir, 'worker%d.sock' % shard)))
+
+    def start(self):
+        for worker in self.workers:
+            self.spawn(worker)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, worker: Worker):
+        if self._stopping:
+            return
+        args = [sys.executable, ALARMSERVER, '-c', self._config_file,
+                '--panels', ','.join(worker.panels), '--admin-socket', worker.socket_path]
+        logging.info("Starting worker %d for panels %s", worker.shard, ','.join(worker.panels))
+        worker.started = time.monotonic()
+        worker.running = True
+        worker.ended = defer.Deferred()
+        WORKER_STARTS.labels(worker.shard).inc()
+        # workers share our stdout and stderr
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                             childFDs={0: 'w', 1: 1, 2: 2})
+
+    def worker_ended(self, worker: Worker, reason):
+        WORKER_EXITS.labels(worker.shard).inc()
+        ended, worker.ended = worker.ended, None
+        if ended is not None:
+            ended.callback(None)
+        if self._stopping:
+            return
+        if time.monotonic() - worker.started >= MAX_RESTART_DELAY:
+            worker.restart_delay = MIN_RESTART_DELAY
+        logging.error("Worker %d for panels %s exited (%s), restarting in %.0f seconds",
+                      worker.shard, ','.join(worker.panels), reason.getErrorMessage(),
+                      worker.restart_delay)
+        reactor.callLater(worker.restart_delay, self.spawn, worker)
+        worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+
+    # Ask every worker to shut down, killing any that take too long.
+    def stop(self) -> defer.Deferred:
+        self._stopping = True
+        waiting = []
+        for worker in self.workers:
+            if worker.running and worker.ended is not None:
+                waiting.append(worker.ended)
+                self._signal(worker, 'TERM')
+                kill = reactor.callLater(STOP_TIMEOUT, self._signal, worker, 'KILL')
+                worker.ended.addBoth(self._cancel_call, kill)
+        return defer.DeferredList(waiting)
+
+    @staticmethod
+    def _cancel_call(result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def _signal(self, worker: Worker, signal_name: str):
+        if worker.running and worker.transport is not None:
+            try:
+                worker.transport.signalProcess(signal_name)
+            except OSError:
+                pass
+
+    # Ask every worker to reload the config.
+    def reload(self):
+        logging.info("Reloading config in every worker")
+        for worker in self.workers:
+            self._signal(worker, 'HUP')
+
+    # GET path from every running worker; fires with (worker, body)
+    # pairs for the workers that answered.
+    @defer.inlineCallbacks
+    def fetch(self, path: str):
+        requests = []
+        for worker in self.workers:
+            if worker.running:
+                request = worker.agent.request(b'GET', b'http://worker' + path)
+                request.addCallback(readBody)
+                requests.append((worker, request))
+        results = []
+        for worker, request in requests:
+            try:
+                body = yield request
+            except Exception as err:
+                logging.warning("Worker %d did not answer %s: %s",
+                                worker.shard, path.decode('ascii'), str(err))
+                continue
+            results.append((worker, body))
+        return results
+
+    def status(self) -> List[Dict]:
+        now = time.monotonic()
+        return [{
+            'shard': worker.shard,
+            'panels': worker.panels,
+            'running': worker.running,
+            'uptime_seconds': round(now - worker.started, 3) if worker.running else None,
+        } for worker in self.workers]
+
+
+# Merge the Prometheus text from each worker, adding a shard label to
+# every sample and keeping each metric's lines together.
+def merge_expositions(expositions: List[Tuple[int, str]]) -> str:
+    families: Dict[str, List[str]] = {}
+    for shard, text in expositions:
+        family: List[str] = []
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = [line]
+                continue
+            if line.startswith('#') or not line:
+                if line.startswith('# TYPE ') and len(family) == 1:
+                    family.append(line)
+                continue
+            name, separator, rest = line.partition('{')
+            if separator:
+                family.append('%s{shard="%d",%s' % (name, shard, rest))
+            else:
+                name, _, value = line.partition(' ')
+                family.append('%s{shard="%d"} %s' % (name, shard, value))
+    lines = []
+    for name in sorted(families):
+        lines.extend(families[name])
+    return '\n'.join(lines) + '\n'
+
+
+class SupervisorResource(Resource):
+    """Serves /metrics, /state and /workers for all the workers."""
+    isLeaf = True
+
+    def __init__(self, supervisor: Supervisor):
+        Resource.__init__(self)
+        self._supervisor: Supervisor = supervisor
+
+    def render_GET(self, request):
+        if request.path == b'/workers':
+            request.setHeader(b'content-type', b'application/json')
+            return json.dumps(self._supervisor.status(), indent=2).encode('utf-8')
+        if request.path == b'/metrics':
+            fetching = self._supervisor.fetch(b'/metrics')
+            fetching.addCallback(self._merge_metrics)
+            request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        elif request.path == b'/state':
+            fetching = self._supervisor.fetch(b'/state')
+            fetching.addCallback(self._merge_state)
+            request.setHeader(b'content-type', b'application/json')
+        else:
+            request.setResponseCode(404)
+            return b'not found'
+        fetching.addCallback(request.write)
+        fetching.addErrback(self._failed, request)
+        fetching.addBoth(lambda _: request.finish())
+        return NOT_DONE_YET
+
+    # e.g. a worker answered with something that isn't json
+    @staticmethod
+    def _failed(failure, request):
+        logging.error("Couldn't serve %s from the workers: %s",
+                      request.path.decode('ascii', 'replace'), failure.getErrorMessage())
+        if not request.startedWriting:
+            request.setResponseCode(500)
+            request.setHeader(b'content-type', b'text/plain')
+            request.write(b'error merging worker responses')
+
+    @staticmethod
+    def _merge_metrics(results) -> bytes:
+        expositions = [(worker.shard, body.decode('utf-8')) for worker, body in results]
+        return (merge_expositions(expositions) + SUPERVISOR_REGISTRY.exposition()).encode('utf-8')
+
+    @staticmethod
+    def _merge_state(results) -> bytes:
+        state = {}
+        for worker, body in results:
+            state.update(json.loads(body))
+        return json.dumps(state).encode('utf-8')
+
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' -c <configfile> [options]\n'
+          '  -w, --workers=N    worker processes (default workers= in the config,\n'
+          '                     or one per cpu)')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hc:w:", ["help", "config=", "workers="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    conffile = 'alarmserver.cfg'
+    workers = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-c", "--config"):
+            conffile = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+
+    try:
+        config = AlarmServerConfig(conffile)
+    except ValueError as err:
+        print(str(err))
+        sys.exit(2)
+    configure_logging(config.LOGLEVEL, config.LOGFILE, config.LOGFORMAT)
+    log.PythonLoggingObserver().start()
+    if not config.PANELS:
+        logging.error("The supervisor shards panels; list them with panels= in [alarmserver]")
+        sys.exit(2)
+    if workers is None:
+        workers = config.WORKERS or os.cpu_count() or 1
+
+    socket_dir = tempfile.mkdtemp(prefix='alarmserver-')
+    supervisor = Supervisor(os.path.abspath(conffile), config, workers, socket_dir)
+    reactor.callWhenRunning(supervisor.start)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: reactor.callFromThread(supervisor.reload))
+    reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree, socket_dir, True)
+    if config.ADMINPORT:
+        reactor.listenTCP(config.ADMINPORT, Site(SupervisorResource(supervisor)),
+                          interface=config.ADMININTERFACE)
+        logging.info("Supervisor admin server listening on %s:%d",
+                     config.ADMININTERFACE, config.ADMINPORT)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+import alarmserver
+from admission import collapse_frames, keypad_key
+
+READY = b'%00,01,1C08,08,00,****DISARMED****  Ready to Arm  $'
+NOT_READY = b'%00,01,1C08,00,00,****DISARMED****Hit * for faults$'
+FAULT_3 = b'%00,01,1C08,03,00,FAULT 03 BACK DOOR               $'
+FAULT_3_AGAIN = b'%00,01,1C08,03,00,FAULT 03                        $'
+FAULT_5 = b'%00,01,1C08,05,00,FAULT 05 KITCHEN                 $'
+PARTITION_2 = b'%00,02,1C08,08,00,****DISARMED****  Ready to Arm  $'
+ZONE_CHANGE = b'%01,0000000000000000$'
+PARTITION_STATE = b'%02,0100000000000000$'
+
+
+class KeypadKeyTest(unittest.TestCase):
+    def test_keypad_update(self):
+        self.assertEqual(keypad_key(READY), (b'01', b'1C08', b'08', b'00', False))
+        self.assertEqual(keypad_key(FAULT_3), (b'01', b'1C08', b'03', b'00', True))
+
+    def test_alpha_text_is_ignored(self):
+        self.assertEqual(keypad_key(FAULT_3), keypad_key(FAULT_3_AGAIN))
+
+    def test_other_frames(self):
+        for line in (ZONE_CHANGE, PARTITION_STATE, b'^02,00$', b'Login:', b''):
+            self.assertIsNone(keypad_key(line), line)
+
+    def test_malformed_frames(self):
+        for line in (b'%00,01,1C08,08$', b'%00,01,1C08,08,00,Ready%01,0000$', b'%00,$'):
+            self.assertIsNone(keypad_key(line), line)
+
+
+class CollapseFramesTest(unittest.TestCase):
+    @staticmethod
+    def frames(*lines):
+        return [(line, float(index)) for index, line in enumerate(lines)]
+
+    def test_nothing_to_collapse(self):
+        self.assertEqual(collapse_frames([]), ([], 0))
+        frames = self.frames(READY, ZONE_CHANGE, NOT_READY)
+        self.assertEqual(collapse_frames(frames), (frames, 0))
+
+    def test_run_keeps_last_frame_and_first_time(self):
+        frames = self.frames(FAULT_3, FAULT_3_AGAIN, FAULT_3)
+        self.assertEqual(collapse_frames(frames), ([(FAULT_3, 0.0)], 2))
+
+    def test_other_codes_end_a_run(self):
+        frames = self.frames(READY, READY, ZONE_CHANGE, READY, PARTITION_STATE, READY, READY)
+        self.assertEqual(collapse_frames(frames),
+                         ([(READY, 0.0), (ZONE_CHANGE, 2.0), (READY, 3.0),
+                           (PARTITION_STATE, 4.0), (READY, 5.0)], 2))
+
+    def test_partitions_are_kept_apart(self):
+        frames = self.frames(READY, PARTITION_2, READY, PARTITION_2)
+        self.assertEqual(collapse_frames(frames), (frames, 0))
+
+    def test_fault_and_non_fault_runs(self):
+        # cycling faults, each zone its own key, then the panel going ready
+        frames = self.frames(FAULT_3, FAULT_5, FAULT_5, FAULT_3, NOT_READY, NOT_READY, READY)
+        self.assertEqual(collapse_frames(frames),
+                         ([(FAULT_3, 0.0), (FAULT_5, 1.0), (FAULT_3, 3.0),
+                           (NOT_READY, 4.0), (READY, 6.0)], 2))
+
+    def test_malformed_frames_end_a_run(self):
+        malformed = b'%00,01,1C08$'
+        frames = self.frames(READY, malformed, malformed, READY)
+        self.assertEqual(collapse_frames(frames), (frames, 0))
+
+
+class TickBudgetTest(unittest.TestCase):
+    """Lines cost a fake two milliseconds each against a three
+    millisecond tick budget, so two are handled per reactor iteration."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'test.cfg')
+        with open(filename, 'w') as config_file:
+            config_file.write('[alarmserver]\npartition1=Home\nzone3=Back Door\n'
+                              'zone5=Kitchen\n'
+                              '[envisalink]\npass=user\ntickbudget=0.003\n'
+                              'keypadupdateinterval=0\n')
+        config = alarmserver.AlarmServerConfig(filename)
+        self.smartthings = mock.Mock()
+        self.clock = Clock()
+        self.client = alarmserver.EnvisalinkClient(config, self.smartthings, self.clock,
+                                                   state=config.initialize_alarmstate({}))
+        # lenient: a tcp transport may resume producing after
+        # loseConnection
+        self.transport = StringTransport(lenient=True)
+        self.client.makeConnection(self.transport)
+        self.client.handle_login_success('')
+        self.addCleanup(self.client.stop_watchdogs)
+
+        self.now = 0.0
+        patcher = mock.patch.object(alarmserver.time, 'perf_counter', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handled = []
+        handle_line = self.client.handle_line
+
+        def timed_handle_line(line, rxtime):
+            self.handled.append(line)
+            handle_line(line, rxtime)
+            self.now += 0.002
+        self.client.handle_line = timed_handle_line
+
+    def receive(self, *lines):
+        self.client.dataReceived(b''.join(line + b'\r\n' for line in lines))
+
+    # Run the backlog call for the next reactor iteration; Clock.advance
+    # would also run the calls it schedules.
+    def iterate(self):
+        call = self.client._backlogcall
+        self.assertTrue(call.active())
+        call.cancel()
+        self.client.handle_backlog()
+
+    def test_within_budget(self):
+        self.receive(FAULT_3, ZONE_CHANGE)
+        self.assertEqual(self.handled, [FAULT_3, ZONE_CHANGE])
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertIsNone(self.client._backlogcall)
+
+    def test_deferred_with_reading_paused(self):
+        lines = [FAULT_3, ZONE_CHANGE, FAULT_5, PARTITION_STATE, READY]
+        self.receive(*lines)
+        self.assertEqual(self.handled, lines[:2])
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        self.iterate()
+        self.assertEqual(self.handled, lines[:4])
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        self.iterate()
+        self.assertEqual(self.handled, lines)
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertIsNone(self.client._backlogcall)
+
+    def test_lines_wait_behind_the_backlog(self):
+        self.receive(FAULT_3, ZONE_CHANGE, FAULT_5)
+        # a line arriving outside a read still waits its turn
+        self.client.lineReceived(READY)
+        self.assertEqual(self.handled, [FAULT_3, ZONE_CHANGE])
+        self.iterate()
+        self.assertEqual(self.handled, [FAULT_3, ZONE_CHANGE, FAULT_5, READY])
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_collapsed_before_the_budget(self):
+        self.receive(FAULT_3, FAULT_3_AGAIN, FAULT_3, ZONE_CHANGE)
+        self.assertEqual(self.handled, [FAULT_3, ZONE_CHANGE])
+        self.assertIsNone(self.client._backlogcall)
+
+    def test_handler_errors_skip_the_line(self):
+        bad_partition = b'%00,XX,1C08,03,00,FAULT 03 BACK DOOR               $'
+        not_ascii = b'%00,01,1C08,05,00,FAULT 05 K\xc3\x9cCHE                $'
+        lines = [FAULT_3, ZONE_CHANGE, bad_partition, not_ascii, READY]
+        with self.assertLogs(level='ERROR') as logs:
+            self.receive(*lines)
+            self.assertEqual(self.transport.producerState, 'paused')
+            self.iterate()
+        self.assertEqual(len([record for record in logs.records
+                              if record.getMessage().startswith("Couldn't handle")]), 2)
+        self.assertEqual(self.handled, lines)
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertIsNone(self.client._backlogcall)
+
+    def test_backlog_dropped_on_disconnect(self):
+        self.receive(FAULT_3, ZONE_CHANGE, FAULT_5, READY)
+        self.transport.loseConnection()
+        self.iterate()
+        self.assertEqual(self.handled, [FAULT_3, ZONE_CHANGE])
+        self.assertEqual(self.transport.producerState, 'producing')
+
+
+if __name__ == '__main__':
+    unittest.main()
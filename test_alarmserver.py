@@ -0,0 +1,107 @@
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+import alarmserver
+
+
+def write_config(test: unittest.TestCase, text: str) -> str:
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    filename = os.path.join(directory.name, 'test.cfg')
+    with open(filename, 'w') as config_file:
+        config_file.write(text)
+    return filename
+
+
+class ConfigTest(unittest.TestCase):
+    def config(self, text):
+        return alarmserver.AlarmServerConfig(write_config(self, text))
+
+    def test_invalid_values_name_the_option(self):
+        for text, option in [
+                ('[envisalink]\nproxyport=70000\n', 'proxyport in [envisalink]'),
+                ('[envisalink]\nhosts=evl:0\n', 'hosts in [envisalink]'),
+                ('[envisalink]\nzonedumpmininterval=120\n', 'zonedumpmininterval'),
+                ('[smartthings]\nbackoffmin=10\nbackoffmax=5\n', 'backoffmax in [smartthings]'),
+                ('[alarmserver]\nzone1=Hall\nzonetype1=lava\n', 'zonetype1 in [alarmserver]'),
+                ('[mqtt]\nqos=2\n', 'qos in [mqtt]')]:
+            with self.assertRaisesRegex(ValueError, re.escape(option)):
+                self.config(text)
+
+    def test_unparsable_values_name_the_option(self):
+        with self.assertRaisesRegex(ValueError, 'port in \\[envisalink\\] is not an integer'):
+            self.config('[envisalink]\nport=many\n')
+
+    def test_frozen(self):
+        config = self.config('[alarmserver]\nzone1=Front Door\n'
+                             '[envisalink]\nhosts=evl-a:4025, evl-b\n')
+        with self.assertRaises(AttributeError):
+            config.ALARMCODE = 1234
+        with self.assertRaises(TypeError):
+            config.ZONENAMES[1] = 'Back Door'
+        with self.assertRaises(TypeError):
+            config.ZONETYPES[2] = 'door'
+        with self.assertRaises(TypeError):
+            config.PARTITIONNAMES[1] = 'Home'
+        with self.assertRaises(AttributeError):
+            config.ENVISALINKHOSTS.append(('evl-c', 4025))
+        self.assertEqual(config.ENVISALINKHOSTS, (('evl-a', 4025), ('evl-b', 4025)))
+        self.assertEqual(config.ZONENAMES[1], 'Front Door')
+
+    def test_replace(self):
+        config = self.config('[alarmserver]\nzone1=Front Door\n')
+        changed = config.replace(ALARMCODE=1234, ZONENAMES={1: 'Back Door'})
+        self.assertEqual((config.ALARMCODE, config.ZONENAMES[1]), (1111, 'Front Door'))
+        self.assertEqual((changed.ALARMCODE, changed.ZONENAMES[1]), (1234, 'Back Door'))
+        self.assertEqual(config.changes(changed), ['ALARMCODE', 'ZONENAMES'])
+        self.assertEqual(config.changes(self.config('[alarmserver]\nzone1=Front Door\n')), [])
+        with self.assertRaises(AttributeError):
+            changed.ALARMCODE = 1111
+
+
+class PeriodicCommandTest(unittest.TestCase):
+    """Periodic commands that come due during another command wait their
+    turn, in order, each once."""
+
+    def setUp(self):
+        config = alarmserver.AlarmServerConfig(write_config(
+            self, '[alarmserver]\npartition1=Home\nzone1=Front Door\n'
+                  '[envisalink]\npass=user\npollinterval=30\n'))
+        self.client = alarmserver.EnvisalinkClient(config, mock.Mock(), Clock(),
+                                                   state=config.initialize_alarmstate({}))
+        self.transport = StringTransport()
+        self.client.makeConnection(self.transport)
+        self.client.handle_login_success('')
+        self.addCleanup(self.client.stop_watchdogs)
+        self.transport.clear()
+
+    def sent(self):
+        value = self.transport.value()
+        self.transport.clear()
+        return value
+
+    def test_deferred_commands_are_all_sent(self):
+        self.client.poll_due()
+        self.assertEqual(self.sent(), b'^00,$\r\n')
+        # the zone dump, then a poll and a heartbeat, during the poll
+        self.client.zone_dump_due()
+        self.client.poll_due()
+        self.client.send_periodic_command('00')
+        self.assertEqual(self.sent(), b'')
+
+        self.client.handle_command_response('00')
+        self.assertEqual(self.sent(), b'^02,$\r\n')
+        self.client.handle_command_response('00')
+        self.assertEqual(self.sent(), b'^00,$\r\n')
+        self.client.handle_command_response('00')
+        self.assertEqual(self.sent(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
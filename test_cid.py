@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+import alarmserver
+from cid import (CATEGORY_AC_POWER, CATEGORY_ALARM, CATEGORY_ARM_AWAY, CATEGORY_ARM_STAY,
+                 CATEGORY_BYPASS, CATEGORY_CANCEL, CATEGORY_FIRE, CATEGORY_LOW_BATTERY,
+                 CATEGORY_OTHER, QUALIFIER_EVENT, QUALIFIER_RESTORE, QUALIFIER_STATUS,
+                 decode_cid_event)
+
+# data, then (qualifier, code, category, partition, zone, user)
+DECODED = [
+    ('113001003', (QUALIFIER_EVENT, 130, CATEGORY_ALARM, 1, 3, None)),
+    ('313001003', (QUALIFIER_RESTORE, 130, CATEGORY_ALARM, 1, 3, None)),
+    ('613001003', (QUALIFIER_STATUS, 130, CATEGORY_ALARM, 1, 3, None)),
+    ('111002012', (QUALIFIER_EVENT, 110, CATEGORY_FIRE, 2, 12, None)),
+    ('130100000', (QUALIFIER_EVENT, 301, CATEGORY_AC_POWER, 0, 0, None)),
+    ('330200000', (QUALIFIER_RESTORE, 302, CATEGORY_LOW_BATTERY, 0, 0, None)),
+    ('340101002', (QUALIFIER_RESTORE, 401, CATEGORY_ARM_AWAY, 1, None, 2)),
+    ('144101004', (QUALIFIER_EVENT, 441, CATEGORY_ARM_STAY, 1, None, 4)),
+    ('140601001', (QUALIFIER_EVENT, 406, CATEGORY_CANCEL, 1, None, 1)),
+    ('157001007', (QUALIFIER_EVENT, 570, CATEGORY_BYPASS, 1, 7, None)),
+    ('160200000', (QUALIFIER_EVENT, 602, CATEGORY_OTHER, 0, 0, None)),
+]
+
+MALFORMED = [
+    '',
+    '11300100',      # too short
+    '1130010030',    # too long
+    '213001003',     # unknown qualifier
+    '199901003',     # unknown event code
+    '11300x003',     # partition not a number
+    '1130010a3',     # zone not a number
+]
+
+
+class DecodeTest(unittest.TestCase):
+    def test_decoded(self):
+        for data, expected in DECODED:
+            event = decode_cid_event(data)
+            self.assertEqual((event.qualifier, event.code, event.category, event.partition,
+                              event.zone, event.user), expected, data)
+            self.assertEqual(event.is_new, expected[0] == QUALIFIER_EVENT, data)
+
+    def test_malformed(self):
+        for data in MALFORMED:
+            with self.assertLogs(level='WARNING'):
+                self.assertIsNone(decode_cid_event(data), data)
+
+
+class ApplyTest(unittest.TestCase):
+    """%03 frames applied to a client with two partitions."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'test.cfg')
+        with open(filename, 'w') as config_file:
+            config_file.write('[alarmserver]\npartition1=Home\npartition2=Garage\n'
+                              'zone3=Back Door\nuser2=Alice\n[envisalink]\npass=user\n')
+        config = alarmserver.AlarmServerConfig(filename)
+        self.smartthings = mock.Mock()
+        self.client = alarmserver.EnvisalinkClient(config, self.smartthings, Clock(),
+                                                   state=config.initialize_alarmstate({}))
+        self.client.makeConnection(StringTransport())
+        self.partitions = self.client._state['partition']
+
+    def receive(self, data):
+        self.client.handle_line(('%03,' + data + '$').encode('ascii'), 0.0)
+
+    def test_partition_zero_applies_to_every_partition(self):
+        self.receive('130100000')
+        self.assertEqual([self.partitions[n]['ac_present'] for n in (1, 2)], [False, False])
+        self.receive('330100000')
+        self.assertEqual([self.partitions[n]['ac_present'] for n in (1, 2)], [True, True])
+        self.receive('130200000')
+        self.assertEqual([self.partitions[n]['low_battery'] for n in (1, 2)], [True, True])
+
+    def test_other_partitions_are_left_alone(self):
+        self.receive('130101000')
+        self.receive('330102000')
+        self.assertEqual(self.partitions[1]['ac_present'], False)
+        self.assertEqual(self.partitions[2]['ac_present'], True)
+        # unconfigured partitions are skipped
+        self.receive('130107000')
+
+    def test_alarm_and_restore(self):
+        self.receive('113001003')
+        self.assertTrue(self.partitions[1]['alarm'])
+        self.assertEqual(self.client._state['zone'][3]['status'], 'open')
+        self.receive('313001003')
+        # the partition stays in alarm until disarmed
+        self.assertTrue(self.partitions[1]['alarm'])
+        self.assertEqual(self.client._state['zone'][3]['status'], 'closed')
+        self.smartthings.send_update.assert_called()
+        self.assertTrue(self.smartthings.send_update.call_args[0][1])
+
+    def test_arming_by_user(self):
+        self.receive('340101002')
+        self.assertTrue(self.partitions[1]['armed_away'])
+        self.assertEqual(self.partitions[1]['lastArmedBy'], 'Alice')
+        self.receive('140101005')
+        self.assertFalse(self.partitions[1]['armed_away'])
+        self.assertEqual(self.partitions[1]['lastDisarmedBy'], 'user 5')
+
+    def test_malformed_frames_are_invalid(self):
+        before = alarmserver.INVALID_FRAMES._default.value
+        with self.assertLogs(level='WARNING'):
+            for data in MALFORMED:
+                self.receive(data)
+        self.assertEqual(alarmserver.INVALID_FRAMES._default.value - before, len(MALFORMED))
+        self.smartthings.send_update.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import unittest
+
+from twisted.internet.task import Clock
+
+import alarmserver
+from debounce import (DEFAULT_SETTINGS, SOURCE_CID, SOURCE_KEYPAD, SOURCE_ZONECHANGE,
+                      SOURCE_ZONEDUMP, DebounceSettings, ZoneDebouncer)
+
+HELD = DebounceSettings(open_hold=2, close_hold=5, dump_margin=60, zonechange_opens=False)
+
+
+class ZoneDebouncerTest(unittest.TestCase):
+    """Zone 1 is a door, zone 2 motion and zone 3 held; zone 9 is not
+    tracked.  Every zone starts closed."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.status = {1: 'closed', 2: 'closed', 3: 'closed', 9: 'closed'}
+        self.commits = []
+        self.debouncer = ZoneDebouncer(
+            {1: DEFAULT_SETTINGS['door'], 2: DEFAULT_SETTINGS['motion'], 3: HELD},
+            self.status.get, self.commit, self.clock)
+
+    def commit(self, zone_num, status, seconds, deferred):
+        self.status[zone_num] = status
+        self.commits.append((zone_num, status, seconds, deferred))
+
+    def test_no_hold_commits_at_once(self):
+        self.debouncer.report(1, 'open', SOURCE_KEYPAD)
+        self.assertEqual(self.commits, [(1, 'open', 0, False)])
+        self.debouncer.report(1, 'closed', SOURCE_KEYPAD)
+        self.assertEqual(self.commits[-1], (1, 'closed', 0, False))
+
+    def test_current_status_is_not_committed(self):
+        self.debouncer.report(1, 'closed', SOURCE_KEYPAD)
+        self.assertEqual(self.commits, [])
+
+    def test_untracked_zones_are_ignored(self):
+        self.debouncer.report(9, 'open', SOURCE_KEYPAD)
+        self.assertEqual(self.commits, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_open_hold(self):
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.clock.advance(1.5)
+        # repeated reports don't restart the hold
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.assertEqual(self.commits, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.commits, [(3, 'open', 2, True)])
+
+    def test_report_of_current_status_cancels_the_hold(self):
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.clock.advance(1)
+        self.debouncer.report(3, 'closed', SOURCE_KEYPAD)
+        self.clock.advance(10)
+        self.assertEqual(self.commits, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_close_hold(self):
+        self.status[3] = 'open'
+        self.debouncer.report(3, 'closed', SOURCE_CID)
+        self.clock.advance(4.9)
+        self.assertEqual(self.commits, [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.commits, [(3, 'closed', 5, True)])
+
+    def test_opposite_report_replaces_the_pending_change(self):
+        self.status[3] = 'open'
+        self.debouncer.report(3, 'closed', SOURCE_KEYPAD)
+        self.clock.advance(1)
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.clock.advance(10)
+        self.assertEqual(self.commits, [])
+
+    def test_zonechange_opens_ignored_by_default(self):
+        self.debouncer.report(1, 'open', SOURCE_ZONECHANGE)
+        self.assertEqual(self.commits, [])
+        self.status[1] = 'open'
+        self.debouncer.report(1, 'closed', SOURCE_ZONECHANGE)
+        self.assertEqual(self.commits, [(1, 'closed', 0, False)])
+
+    def test_zonechange_opens_when_enabled(self):
+        self.debouncer.update_settings(
+            {1: DEFAULT_SETTINGS['door']._replace(zonechange_opens=True)})
+        self.debouncer.report(1, 'open', SOURCE_ZONECHANGE)
+        self.assertEqual(self.commits, [(1, 'open', 0, False)])
+
+    def test_dump_close_waits_out_the_margin(self):
+        self.status[1] = 'open'
+        self.status[2] = 'open'
+        # doors wait 60 seconds, motion sensors 10, counting the time the
+        # dump says the zone has been closed
+        self.debouncer.report(1, 'closed', SOURCE_ZONEDUMP, seconds_ago=45)
+        self.debouncer.report(2, 'closed', SOURCE_ZONEDUMP, seconds_ago=4)
+        self.clock.advance(6)
+        self.assertEqual(self.commits, [(2, 'closed', 10, True)])
+        self.clock.advance(9)
+        self.assertEqual(self.commits[-1], (1, 'closed', 60, True))
+
+    def test_dump_close_past_the_margin_commits_at_once(self):
+        self.status[1] = 'open'
+        self.debouncer.report(1, 'closed', SOURCE_ZONEDUMP, seconds_ago=75)
+        self.assertEqual(self.commits, [(1, 'closed', 75, False)])
+
+    def test_cancel_all(self):
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.status[1] = 'open'
+        self.debouncer.report(1, 'closed', SOURCE_ZONEDUMP)
+        self.debouncer.cancel_all()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(100)
+        self.assertEqual(self.commits, [])
+
+    def test_update_settings_drops_untracked_zones(self):
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.debouncer.update_settings({1: DEFAULT_SETTINGS['door']})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.debouncer.report(3, 'open', SOURCE_KEYPAD)
+        self.assertEqual(self.commits, [])
+
+
+class DebounceSettingsTest(unittest.TestCase):
+    def config(self, text):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'test.cfg')
+        with open(filename, 'w') as config_file:
+            config_file.write(text)
+        return alarmserver.AlarmServerConfig(filename)
+
+    def test_zone_types_pick_settings(self):
+        config = self.config('[alarmserver]\nzone1=Front Door\nzone2=Hall\nzonetype2=motion\n'
+                             'zone3=Kitchen Smoke\nzonetype3=smoke\n'
+                             '[debounce]\nmotion_close_hold=5\nsmoke_open_hold=1.5\n')
+        self.assertEqual(config.ZONEDEBOUNCE[1], DEFAULT_SETTINGS['door'])
+        self.assertEqual(config.ZONEDEBOUNCE[2], DebounceSettings(0, 5, 10, False))
+        self.assertEqual(config.ZONEDEBOUNCE[3], DebounceSettings(1.5, 0, 60, False))
+        self.assertEqual(set(config.ZONEDEBOUNCE), {1, 2, 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
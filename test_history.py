@@ -0,0 +1,77 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import history
+from history import KIND_PARTITION, KIND_ZONE, EventHistory
+
+
+class EventHistoryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'history.db')
+
+    def connect(self):
+        connection = history.connect(self.filename)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_write(self):
+        events = EventHistory(self.filename)
+        now = time.time()
+        events.record(KIND_ZONE, 3, 'open', timestamp=now - 20)
+        events.record(KIND_ZONE, 3, 'closed', timestamp=now - 10)
+        events.record(KIND_PARTITION, 1, 'armed_away', 'Alice', timestamp=now)
+        events.close()
+        connection = self.connect()
+        self.assertEqual([(change['status'], change['detail'])
+                          for change in history.last_changes(connection, KIND_ZONE, 3)],
+                         [('closed', None), ('open', None)])
+        self.assertEqual([change['number'] for change in
+                          history.changes_between(connection, KIND_PARTITION, 'armed_away',
+                                                  now - 60, now)], [1])
+
+    def test_rollup(self):
+        events = EventHistory(self.filename, retention_days=1)
+        now = time.time()
+        old = now - 3 * 86400
+        events.record(KIND_ZONE, 3, 'open', timestamp=old)
+        events.record(KIND_ZONE, 3, 'open', timestamp=old + 1)
+        events.record(KIND_ZONE, 3, 'closed', timestamp=old + 2)
+        events.record(KIND_ZONE, 3, 'open', timestamp=now)
+        events.close()
+        # the writer may have pruned only the first batch
+        connection = self.connect()
+        events._prune(connection)
+        day = datetime.fromtimestamp(old).strftime('%Y-%m-%d')
+        self.assertEqual(
+            connection.execute('SELECT * FROM daily ORDER BY status').fetchall(),
+            [(day, KIND_ZONE, 3, 'closed', 1), (day, KIND_ZONE, 3, 'open', 2)])
+        self.assertEqual([row[0] for row in connection.execute('SELECT ts FROM events')],
+                         [now])
+
+    def test_errors_dont_stop_the_writer(self):
+        failed = threading.Event()
+
+        def prune(connection):
+            failed.set()
+            raise OverflowError('timestamp out of range')
+
+        events = EventHistory(self.filename, retention_days=0)
+        with mock.patch.object(events, '_prune', side_effect=prune):
+            with self.assertLogs(level='ERROR') as logs:
+                events.record(KIND_ZONE, 1, 'open', timestamp=1000.0)
+                self.assertTrue(failed.wait(5))
+                events.record(KIND_ZONE, 1, 'closed', timestamp=1010.0)
+                events.close()
+        self.assertIn('OverflowError: timestamp out of range', logs.output[0])
+        self.assertEqual(len(history.last_changes(self.connect(), KIND_ZONE, 1)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from email.utils import formatdate
+
+from ratelimit import RateLimiter, RateLimitSettings, parse_retry_after
+
+SETTINGS = RateLimitSettings(rate=2.0, burst=3, backoff_min=1.0, backoff_max=8.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(SETTINGS, 100.0)
+
+    def send(self, now):
+        delay = self.limiter.delay(now)
+        if delay == 0:
+            self.limiter.consume(now)
+        return delay
+
+    def test_burst_then_rate(self):
+        self.assertEqual([self.send(100.0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.send(100.0), 0.5)
+        self.assertAlmostEqual(self.send(100.25), 0.25)
+        self.assertEqual(self.send(100.5), 0)
+        self.assertAlmostEqual(self.send(100.5), 0.5)
+
+    def test_refill_stops_at_burst(self):
+        for _ in range(3):
+            self.send(100.0)
+        # an hour idle refills no more than the burst
+        self.assertEqual([self.send(3700.0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.send(3700.0), 0.5)
+
+    def test_no_limit(self):
+        limiter = RateLimiter(SETTINGS._replace(rate=0), 100.0)
+        for _ in range(100):
+            self.assertEqual(limiter.delay(100.0), 0)
+            limiter.consume(100.0)
+
+    def test_backoff_doubles_up_to_max(self):
+        waits = [self.limiter.failed(100.0 + 100 * i) for i in range(6)]
+        self.assertEqual(waits, [1.0, 2.0, 4.0, 8.0, 8.0, 8.0])
+        self.assertEqual(self.limiter.delay(600.0), 8.0)
+        self.assertEqual(self.limiter.delay(608.0), 0)
+
+    def test_success_resets_backoff(self):
+        self.limiter.failed(100.0)
+        self.limiter.failed(110.0)
+        self.limiter.succeeded()
+        self.assertEqual(self.limiter.failed(120.0), 1.0)
+
+    def test_retry_after_overrides_backoff(self):
+        self.assertEqual(self.limiter.failed(100.0, retry_after=30.0), 30.0)
+        self.assertEqual(self.limiter.delay(110.0), 20.0)
+        # a shorter wait doesn't shorten one already in force
+        self.assertEqual(self.limiter.failed(110.0, retry_after=5.0), 20.0)
+        # even beyond backoff_max
+        self.assertEqual(self.limiter.failed(200.0, retry_after=60.0), 60.0)
+
+    def test_smaller_burst_drops_tokens(self):
+        self.limiter.update_settings(SETTINGS._replace(burst=1))
+        self.assertEqual(self.send(100.0), 0)
+        self.assertAlmostEqual(self.send(100.0), 0.5)
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    NOW = 1_700_000_000.0
+
+    def test_values(self):
+        cases = [
+            (None, None),
+            ('', None),
+            ('120', 120.0),
+            (' 5 ', 5.0),
+            ('0', 0.0),
+            (formatdate(self.NOW + 90, usegmt=True), 90.0),
+            # a date already past waits no time
+            (formatdate(self.NOW - 90, usegmt=True), 0.0),
+            ('-5', None),
+            ('1.5', None),
+            ('soon', None),
+            # no time zone
+            ('Tue, 14 Nov 2023 22:13:20', None),
+        ]
+        for value, expected in cases:
+            self.assertEqual(parse_retry_after(value, self.NOW), expected, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import alarmserver
+import smartthings
+from statestore import FrozenDict
+from tracing import Tracer
+
+
+class ThreadSenderTest(unittest.TestCase):
+    """The thread sender on a real api thread, with posting stubbed out."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'test.cfg')
+        with open(filename, 'w') as config_file:
+            config_file.write('[alarmserver]\nzone1=Front Door\n'
+                              '[smartthings]\ncallbackurl_base=http://127.0.0.1:1\n'
+                              'ratelimit=0\nrepeat_update_interval=0\n')
+        self.sender = smartthings.SmartThings(alarmserver.AlarmServerConfig(filename))
+        self.addCleanup(smartthings.SENDER_POOL.stop)
+        self.posted = []
+        self.sender._post_api_synchronous = lambda path, data: self.posted.append(data) or 'posted'
+        self.tracer = Tracer(sample_every=1)
+
+    def wait_idle(self):
+        deadline = time.monotonic() + 5
+        while not self.sender.idle():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_posts_snapshots(self):
+        trace = self.tracer.start('%00', time.monotonic())
+        self.sender.send_update(FrozenDict(zone=FrozenDict()), trace=trace)
+        self.wait_idle()
+        self.assertEqual(self.posted, ['{"zone": {}}'])
+        self.assertEqual(trace.outcome, 'posted')
+
+    def test_errors_finish_the_request_and_the_thread_goes_on(self):
+        failing = self.tracer.start('%00', time.monotonic())
+        following = self.tracer.start('%01', time.monotonic())
+        with mock.patch.object(self.sender._encoder, 'encode',
+                               side_effect=[ValueError('bad snapshot'), '{}']):
+            with self.assertLogs(level='ERROR') as logs:
+                self.sender.send_update(FrozenDict(), trace=failing)
+                self.sender.send_update(FrozenDict(), trace=following)
+                self.wait_idle()
+        self.assertIn('ValueError: bad snapshot', logs.output[0])
+        self.assertEqual(failing.outcome, 'error')
+        self.assertEqual(following.outcome, 'posted')
+        self.assertEqual(self.posted, ['{}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
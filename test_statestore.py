@@ -0,0 +1,76 @@
+import json
+import unittest
+
+from statestore import EntityMap, FrozenDict, SnapshotEncoder, state_snapshot
+
+
+def zone(name, status='closed'):
+    return {'name': name, 'status': status, 'message': '', 'lastChanged': None,
+            'closedSeconds': -1, 'stale': False}
+
+
+def partition(name):
+    return {'name': name, 'status': 'ready', 'alpha': '  Ready to Arm  ', 'armed': False,
+            'flags': ['READY', 'BACKLIGHT'], 'seconds': 1.5}
+
+
+class SnapshotEncoderTest(unittest.TestCase):
+    """The encoder must give exactly what json.dumps would, byte for
+    byte, however the state changed since the last snapshot."""
+
+    def setUp(self):
+        self.state = {'zone': EntityMap({number: zone('Zone %d' % number)
+                                         for number in range(1, 9)}),
+                      'partition': EntityMap({1: partition('Home')})}
+        self.encoder = SnapshotEncoder()
+
+    def assertEncodesLikeJson(self, snapshot):
+        self.assertEqual(self.encoder.encode(snapshot).encode('utf-8'),
+                         json.dumps(snapshot).encode('utf-8'))
+
+    def test_first_snapshot(self):
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+
+    def test_unchanged_snapshot(self):
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+
+    def test_changed_records(self):
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+        self.state['zone'][3]['status'] = 'open'
+        self.state['zone'][3]['lastChanged'] = '2026-10-19 12:00:00'
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+        self.state['partition'][1].update(status='armed', armed=True, flags=['ARMED_AWAY'])
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+
+    def test_added_and_removed_records(self):
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+        self.state['zone'][12] = zone('Garage')
+        del self.state['zone'][2]
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+        self.state['partition'][2] = partition('Garage')
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+
+    def test_escaped_text(self):
+        self.state['zone'][1]['name'] = 'Front "Main" Door \\ Café ☃'
+        self.state['zone'][2]['message'] = 'line\nbreak\ttab'
+        self.assertEncodesLikeJson(state_snapshot(self.state))
+
+    def test_snapshots_of_other_states(self):
+        other = {'zone': EntityMap({1: zone('Shed', 'open')}),
+                 'partition': EntityMap({1: partition('Cabin')})}
+        for _ in range(2):
+            self.assertEncodesLikeJson(state_snapshot(self.state))
+            self.assertEncodesLikeJson(state_snapshot(other))
+
+    def test_empty_state(self):
+        self.assertEncodesLikeJson(state_snapshot({'zone': EntityMap(), 'partition': EntityMap()}))
+        self.assertEncodesLikeJson(FrozenDict())
+
+    def test_plain_payloads(self):
+        for payload in ({'zone': {1: 'open'}}, [1, 2.5, None, True], 'text'):
+            self.assertEqual(self.encoder.encode(payload), json.dumps(payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import logging
+import time
+from typing import Callable, Optional
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IDelayedCall
+
+
+class MonotonicClock:
+    """Schedules calls on the reactor but reads time from time.monotonic().
+
+    Anything that takes a clock accepts this or a twisted.internet.task.Clock,
+    so the same code runs on a virtual clock when replaying captures.
+    """
+
+    def seconds(self) -> float:
+        return time.monotonic()
+
+    def callLater(self, delay, func, *args, **kwargs) -> IDelayedCall:
+        return reactor.callLater(delay, func, *args, **kwargs)
+
+
+MONOTONIC = MonotonicClock()
+
+
+class Watchdog:
+    """A single rescheduled timer that fires once at a monotonic deadline.
+
+    The reactor schedules delayed calls against the wall clock, so a
+    clock jump (NTP, DST) could make a call fire early.  The deadline
+    is tracked on the clock's monotonic seconds() and an early call simply re-arms
+    itself for the remainder.
+    """
+
+    def __init__(self, name: str, callback: Callable[[], None], clock=MONOTONIC):
+        self._name: str = name
+        self._callback: Callable[[], None] = callback
+        self._clock = clock
+        self._deadline: float = 0.0
+        self._call: Optional[IDelayedCall] = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    # True if the watchdog is armed and has not fired yet.
+    @property
+    def active(self) -> bool:
+        return self._call is not None and self._call.active()
+
+    # Seconds until the watchdog fires, or None if it is not armed.
+    def remaining(self) -> Optional[float]:
+        if not self.active:
+            return None
+        return max(0.0, self._deadline - self._clock.seconds())
+
+    # (Re)arm the watchdog to fire delay seconds from now.
+    def reset(self, delay: float):
+        self._deadline = self._clock.seconds() + delay
+        self._schedule(delay)
+
+    # Arm the watchdog only if it is not already running.
+    def start(self, delay: float):
+        if not self.active:
+            self.reset(delay)
+
+    def cancel(self):
+        if self.active:
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self, delay: float):
+        if self.active:
+            self._call.reset(delay)
+        else:
+            self._call = self._clock.callLater(delay, self._fire)
+
+    def _fire(self):
+        self._call = None
+        remaining = self._deadline - self._clock.seconds()
+        if remaining > 0:
+            # wall clock jumped forward; wait out the rest of the deadline
+            logging.debug("watchdog %s fired %.3fs early, rescheduling",
+                          self._name, remaining)
+            self._schedule(remaining)
+            return
+        self._callback()
@@ -0,0 +1,156 @@
+import logging
+from typing import Optional, Set
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineOnlyReceiver
+from zope.interface import implementer
+
+from metrics import REGISTRY
+
+PROXY_CLIENTS = REGISTRY.gauge(
+    'alarmserver_proxy_clients', 'Downstream TPI clients logged in to the proxy')
+PROXY_COMMANDS = REGISTRY.counter(
+    'alarmserver_proxy_commands_total', 'Commands forwarded from downstream TPI clients')
+PROXY_SLOW_DISCONNECTS = REGISTRY.counter(
+    'alarmserver_proxy_slow_disconnects_total',
+    'Downstream TPI clients dropped for falling too far behind')
+
+# seconds a downstream client has to send the password
+LOGIN_TIMEOUT = 10
+
+
+@implementer(IPushProducer)
+class TPIProxyClient(LineOnlyReceiver):
+    """A downstream TPI client: logs in like it would to an Envisalink,
+    then receives every panel frame and may send commands.
+
+    The client registers itself as the producer for its transport, so
+    it hears when the transport's buffer is full.  Frames sent while it
+    is paused count towards its backlog, and the client is dropped once
+    the backlog passes the limit rather than buffering without bound.
+    """
+    delimiter = b'\r\n'
+
+    def __init__(self, proxy: 'TPIProxyFactory'):
+        self._proxy: 'TPIProxyFactory' = proxy
+        self.loggedin: bool = False
+        self.paused: bool = False
+        self.backlog: int = 0
+        self._logintimeout = None
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self._logintimeout = reactor.callLater(LOGIN_TIMEOUT, self.login_timed_out)
+        self.sendLine(b'Login:')
+
+    def connectionLost(self, reason):
+        if self._logintimeout is not None and self._logintimeout.active():
+            self._logintimeout.cancel()
+        self._proxy.client_gone(self)
+
+    def lineReceived(self, line: bytes):
+        if not self.loggedin:
+            self.check_password(line)
+        elif line[:1] == b'^' and line[-1:] == b'$':
+            self._proxy.forward_command(self, line.decode('ascii', 'replace'))
+        else:
+            logging.warning("Ignoring malformed command from TPI proxy client: %r", line)
+
+    def check_password(self, line: bytes):
+        self._logintimeout.cancel()
+        if line.decode('ascii', 'replace') != self._proxy.password:
+            self.sendLine(b'FAILED')
+            self.transport.loseConnection()
+            return
+        self.sendLine(b'OK')
+        self.loggedin = True
+        self._proxy.client_ready(self)
+
+    def login_timed_out(self):
+        self.sendLine(b'Timed Out!')
+        self.transport.loseConnection()
+
+    # Write a frame that already ends with the delimiter.  The same bytes
+    # object is written to every client.
+    def send_frame(self, frame: bytes):
+        if self.paused:
+            self.backlog += 1
+            if self.backlog > self._proxy.max_backlog:
+                logging.warning("TPI proxy client %s is %d frames behind, disconnecting",
+                                self.transport.getPeer(), self.backlog)
+                PROXY_SLOW_DISCONNECTS.inc()
+                self._proxy.client_gone(self)
+                self.transport.abortConnection()
+                return
+        self.transport.write(frame)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.backlog = 0
+
+    def stopProducing(self):
+        pass
+
+
+class TPIProxyFactory(ServerFactory):
+    """A local TPI listener sharing one Envisalink session.
+
+    Every frame the Envisalink sends is re-broadcast to the logged in
+    clients, except command responses, which go only to the client
+    whose command it was.  Commands are forwarded through the session's
+    command queue so only one is ever in flight.
+    """
+
+    def __init__(self, password: str, max_backlog: int = 1000):
+        self.password: str = password
+        self.max_backlog: int = max_backlog
+        self.clients: Set[TPIProxyClient] = set()
+        # the current Envisalink session, if logged in
+        self.upstream = None
+
+    def buildProtocol(self, addr):
+        return TPIProxyClient(self)
+
+    def client_ready(self, client: TPIProxyClient):
+        logging.info("TPI proxy client connected from %s", client.transport.getPeer())
+        self.clients.add(client)
+        PROXY_CLIENTS.set(len(self.clients))
+
+    def client_gone(self, client: TPIProxyClient):
+        if client in self.clients:
+            self.clients.discard(client)
+            PROXY_CLIENTS.set(len(self.clients))
+
+    def broadcast(self, frame: bytes):
+        # copy: a slow client may be removed while sending
+        for client in list(self.clients):
+            client.send_frame(frame)
+
+    def forward_command(self, client: TPIProxyClient, line: str):
+        upstream = self.upstream
+        if upstream is None or not upstream.is_logged_in():
+            logging.warning("Not connected to Envisalink, dropping proxied command %s", line)
+            return
+        PROXY_COMMANDS.inc()
+        upstream.forward_command(client, line)
+
+    # The response to a forwarded command, for its client.
+    def route_response(self, client: TPIProxyClient, frame: bytes):
+        if client in self.clients:
+            client.transport.write(frame)
+
+
+# Start a proxy listening on port, or return None if port is zero.
+def start_proxy(port: int, interface: str, password: str,
+                max_backlog: int) -> Optional[TPIProxyFactory]:
+    if not port:
+        return None
+    proxy = TPIProxyFactory(password, max_backlog)
+    reactor.listenTCP(port, proxy, interface=interface)
+    logging.info("TPI proxy listening on %s:%d", interface, port)
+    return proxy
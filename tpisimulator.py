@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+# Envisalink TPI simulator
+#
+# A fake Envisalink that speaks enough of the Honeywell TPI for
+# AlarmServer to log in, send commands and receive realistic panel
+# traffic, so the server can be exercised and load tested without an
+# EVL-4 and a Vista panel.
+#
+# This code is under the terms of the GPL v3 license.
+
+import getopt
+import logging
+import random
+import sys
+from typing import List, Optional, Tuple
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineOnlyReceiver
+
+from envisalinkdefs import IconLED_Flags, evl_CID_Events
+
+# beep codes and alpha text the simulator sends in keypad updates
+READY_ALPHA = '****DISARMED****  Ready to Arm  '
+ARMED_ALPHA = 'ARMED ***STAY***                '
+FAULT_ALPHA = 'FAULT %02d ZONE %d'
+# a keypad in alarm alternates between these
+ALARM_ALPHA = ('ALARM %02d ZONE %d', 'DISARM SYSTEM   Or Press *  for Alarm Memory')
+
+MALFORMED_FRAMES = ['%00,01,1C08,08,00$', '%01,ZZZZ$', '%FF,0$', '%03,1$',
+                    '%00,01,1C08,08,00,****DIS%00,01', '^99,00$', 'garbage']
+
+
+class PanelModel:
+    """Just enough panel state to generate coherent frames."""
+
+    def __init__(self, zones: int, partition: int = 1):
+        self.zones: int = zones
+        self.partition: int = partition
+        self.open_zones = set()
+        self.armed: bool = False
+        self._fault_index: int = 0
+        self._alarm_index: int = 0
+
+    def toggle_random_zone(self):
+        zone = random.randint(1, self.zones)
+        if zone in self.open_zones:
+            self.open_zones.remove(zone)
+        else:
+            self.open_zones.add(zone)
+
+    def keypad_frame(self) -> str:
+        flags = IconLED_Flags()
+        flags.ac_present = 1
+        if self.armed:
+            flags.armed_stay = 1
+            alpha, zone = ARMED_ALPHA, 0
+        elif self.open_zones:
+            # cycle through the open zones the way a real keypad does
+            zones = sorted(self.open_zones)
+            self._fault_index = (self._fault_index + 1) % len(zones)
+            zone = zones[self._fault_index]
+            alpha = (FAULT_ALPHA % (zone, zone)).ljust(32)
+        else:
+            flags.ready = 1
+            alpha, zone = READY_ALPHA, 8
+        return '%%00,%02d,%04X,%03d,00,%s$' % (self.partition, flags.asShort,
+                                               zone, alpha)
+
+    # The keypad update an alarm repeats several times a second: the same
+    # flags, zone and beep, alternating alpha text.
+    def alarm_frame(self) -> str:
+        flags = IconLED_Flags()
+        flags.ac_present = 1
+        flags.armed_away = 1
+        flags.alarm = 1
+        zone = min(self.open_zones, default=1)
+        self._alarm_index += 1
+        alpha = ALARM_ALPHA[self._alarm_index % 2]
+        if '%' in alpha:
+            alpha = alpha % (zone, zone)
+        return '%%00,%02d,%04X,%03d,03,%s$' % (self.partition, flags.asShort,
+                                               zone, alpha.ljust(32)[:32])
+
+    def zone_change_frame(self) -> str:
+        bits = 0
+        for zone in self.open_zones:
+            if zone <= 64:
+                bits |= 1 << (zone - 1)
+        return '%01,' + bits.to_bytes(8, 'little').hex().upper() + '$'
+
+    def partition_frame(self) -> str:
+        status = '04' if self.armed else ('03' if self.open_zones else '01')
+        codes = ['00'] * 8
+        codes[self.partition - 1] = status
+        return '%02,' + ''.join(codes) + '$'
+
+    def zone_dump_frame(self) -> str:
+        timers = []
+        for zone in range(1, 65):
+            if zone in self.open_zones:
+                ticks = 0xFFFF
+            elif zone <= self.zones:
+                # closed sometime in the last few minutes
+                ticks = 0xFFFF - random.randint(1, 60)
+            else:
+                ticks = 0
+            timers.append(ticks.to_bytes(2, 'little').hex().upper())
+        return '%FF,' + ''.join(timers) + '$'
+
+    def cid_frame(self) -> str:
+        code = random.choice(list(evl_CID_Events.keys()))
+        qualifier = random.choice('13')
+        if evl_CID_Events[code]['type'] == 'user':
+            zone_or_user = random.randint(1, 3)
+        else:
+            zone_or_user = random.randint(1, self.zones)
+        return '%%03,%s%03d%02d%03d$' % (qualifier, code, self.partition, zone_or_user)
+
+
+# traffic during an alarm storm
+ALARM_MIX = [('alarm', 90), ('zone_change', 3), ('partition', 2), ('cid', 2), ('toggle', 3)]
+
+
+class SimulatorSettings:
+    def __init__(self):
+        self.password: str = 'user'
+        self.zones: int = 16
+        # frames per second of unsolicited panel traffic
+        self.rate: float = 1.0
+        # relative weights of each frame type in random traffic
+        self.mix: List[Tuple[str, int]] = [('keypad', 80), ('zone_change', 8),
+                                           ('partition', 5), ('zone_dump', 2),
+                                           ('cid', 2), ('toggle', 3)]
+        # probability that a frame is replaced by a malformed one
+        self.malformed: float = 0.0
+        # when set, traffic is mostly alarm keypad updates
+        self.alarm: bool = False
+        # every silence_every seconds, go quiet for silence_for seconds
+        self.silence_every: float = 0.0
+        self.silence_for: float = 0.0
+        # optional script of (delay seconds, frame) replacing random traffic
+        self.script: Optional[List[Tuple[float, str]]] = None
+        self.loop_script: bool = False
+
+
+# A frame of the kind picked at random from mix.
+def random_frame(panel: PanelModel, mix: List[Tuple[str, int]]) -> str:
+    kinds, weights = zip(*mix)
+    kind = random.choices(kinds, weights)[0]
+    if kind == 'toggle':
+        panel.toggle_random_zone()
+        return panel.keypad_frame()
+    return getattr(panel, kind + '_frame')()
+
+
+def read_script(filename: str) -> List[Tuple[float, str]]:
+    """Read a traffic script: one '<delay seconds> <frame>' per line."""
+    script = []
+    with open(filename) as script_file:
+        for line in script_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            delay, _, frame = line.partition(' ')
+            script.append((float(delay), frame))
+    return script
+
+
+class SimulatedEnvisalink(LineOnlyReceiver):
+    # how often the traffic generator wakes up; frames due in between
+    # are written as one batch
+    TICK = 0.01
+
+    def __init__(self, settings: SimulatorSettings):
+        self._settings: SimulatorSettings = settings
+        self._panel: PanelModel = PanelModel(settings.zones)
+        self._loggedin: bool = False
+        self._traffic: Optional[LoopingCall] = None
+        self._silence = None
+        self._silent: bool = False
+        self._credit: float = 0.0
+        self._script_index: int = 0
+        self._script_call = None
+        self.sent: int = 0
+
+    def connectionMade(self):
+        logging.info("Client connected from %s", self.transport.getPeer())
+        self.send_frame('Login:')
+
+    def connectionLost(self, reason):
+        logging.info("Client disconnected: %s", reason.getErrorMessage())
+        self.stop_traffic()
+
+    def send_frame(self, frame: str):
+        self.sent += 1
+        self.sendLine(frame.encode('ascii'))
+
+    def lineReceived(self, line: bytes):
+        text = line.decode('ascii', 'replace')
+        if not self._loggedin:
+            if text == self._settings.password:
+                self._loggedin = True
+                self.send_frame('OK')
+                self.start_traffic()
+            else:
+                self.send_frame('FAILED')
+                self.transport.loseConnection()
+            return
+        self.handle_command(text)
+
+    def handle_command(self, text: str):
+        if not (text.startswith('^') and text.endswith('$')):
+            # keypresses to the default partition
+            return
+        code = text[1:3]
+        if code == '00':
+            self.send_frame('^00,00$')
+        elif code == '01':
+            self.send_frame('^01,00$')
+        elif code == '02':
+            self.send_frame('^02,00$')
+            self.send_frame(self._panel.zone_dump_frame())
+        elif code == '03':
+            self.send_frame('^03,00$')
+        else:
+            self.send_frame('^0C,02$')
+
+    # unsolicited traffic
+
+    def start_traffic(self):
+        if self._settings.silence_every > 0:
+            self._silence = reactor.callLater(self._settings.silence_every,
+                                              self.start_silence)
+        if self._settings.script is not None:
+            self.schedule_script()
+        elif self._settings.rate > 0:
+            self._traffic = LoopingCall(self.tick)
+            self._traffic.start(max(self.TICK, 1.0 / self._settings.rate))
+
+    def stop_traffic(self):
+        if self._traffic is not None and self._traffic.running:
+            self._traffic.stop()
+        for call in (self._silence, self._script_call):
+            if call is not None and call.active():
+                call.cancel()
+
+    def start_silence(self):
+        logging.info("Going silent for %s seconds", self._settings.silence_for)
+        self._silent = True
+        self._silence = reactor.callLater(self._settings.silence_for, self.end_silence)
+
+    def end_silence(self):
+        logging.info("Ending silence")
+        self._silent = False
+        self._silence = reactor.callLater(self._settings.silence_every,
+                                          self.start_silence)
+
+    def tick(self):
+        interval = self._traffic.interval
+        self._credit += self._settings.rate * interval
+        count = int(self._credit)
+        self._credit -= count
+        if self._silent or count == 0:
+            return
+        frames = [self.next_frame() for _ in range(count)]
+        self.sent += count
+        self.transport.write(b''.join(frame.encode('ascii') + self.delimiter
+                                      for frame in frames))
+
+    def next_frame(self) -> str:
+        if random.random() < self._settings.malformed:
+            return random.choice(MALFORMED_FRAMES)
+        return random_frame(self._panel, ALARM_MIX if self._settings.alarm else self._settings.mix)
+
+    def schedule_script(self):
+        script = self._settings.script
+        if self._script_index >= len(script):
+            if not self._settings.loop_script or not script:
+                return
+            self._script_index = 0
+        delay, _ = script[self._script_index]
+        self._script_call = reactor.callLater(delay, self.play_script)
+
+    def play_script(self):
+        _, frame = self._settings.script[self._script_index]
+        self._script_index += 1
+        if not self._silent:
+            self.send_frame(frame)
+        self.schedule_script()
+
+
+class SimulatorFactory(Factory):
+    def __init__(self, settings: SimulatorSettings):
+        self._settings: SimulatorSettings = settings
+
+    def buildProtocol(self, addr):
+        return SimulatedEnvisalink(self._settings)
+
+
+def usage():
+    print('Usage: ' + sys.argv[0] + ' [options]\n'
+          '  -p, --port=PORT          port to listen on (default 4025)\n'
+          '  -P, --password=PASS      TPI password (default user)\n'
+          '  -z, --zones=N            number of zones (default 16)\n'
+          '  -r, --rate=N             frames per second (default 1)\n'
+          '  -m, --malformed=P        probability of a malformed frame\n'
+          '  -a, --alarm              send an alarm storm of repeated keypad updates\n'
+          '  -s, --silence=EVERY:FOR  go silent FOR seconds every EVERY seconds\n'
+          '  -f, --script=FILE        play frames from FILE instead of random traffic\n'
+          '  -l, --loop               loop the script')
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hp:P:z:r:m:as:f:l",
+                                   ["help", "port=", "password=", "zones=", "rate=",
+                                    "malformed=", "alarm", "silence=", "script=", "loop"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    port = 4025
+    settings = SimulatorSettings()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-P", "--password"):
+            settings.password = arg
+        elif opt in ("-z", "--zones"):
+            settings.zones = int(arg)
+        elif opt in ("-r", "--rate"):
+            settings.rate = float(arg)
+        elif opt in ("-m", "--malformed"):
+            settings.malformed = float(arg)
+        elif opt in ("-a", "--alarm"):
+            settings.alarm = True
+        elif opt in ("-s", "--silence"):
+            every, _, duration = arg.partition(':')
+            settings.silence_every = float(every)
+            settings.silence_for = float(duration)
+        elif opt in ("-f", "--script"):
+            settings.script = read_script(arg)
+        elif opt in ("-l", "--loop"):
+            settings.loop_script = True
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    reactor.listenTCP(port, SimulatorFactory(settings))
+    logging.info("Simulated Envisalink listening on port %d", port)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
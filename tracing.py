@@ -0,0 +1,125 @@
+import json
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from twisted.web.resource import Resource
+
+from metrics import REGISTRY
+
+# Stages an update passes through on its way to SmartThings, in order.
+# rx and handled happen on the reactor thread when the frame is parsed
+# and state updated; queued in send_api_request; dequeued, serialized
+# and posted on the api thread, or on the reactor thread by the async
+# sender, which only encodes in the thread pool.
+STAGES = ('handled', 'queued', 'dequeued', 'serialized', 'posted')
+
+STAGE_LATENCY = REGISTRY.histogram(
+    'alarmserver_stage_latency_seconds',
+    'Time from receiving a frame to each stage of sending the update it caused',
+    ['panel', 'stage'])
+
+
+# Children are created up front on the reactor thread, so the api
+# thread never adds to the metric.  Only the panel's api thread, or the
+# reactor, marks the panel's traces once queued.
+def _stage_histograms(panel: str) -> Dict[str, Any]:
+    return {stage: STAGE_LATENCY.labels(panel, stage) for stage in STAGES}
+
+
+class Trace:
+    """Timestamps for one update, from the frame that caused it to the post.
+
+    All times are time.monotonic() so they compare across threads.
+    """
+    __slots__ = ('code', 'rx', 'priority', 'sampled', 'panel', 'histograms', 'stages',
+                 'outcome', 'wall')
+
+    def __init__(self, code: str, rx: float, priority: bool = False, sampled: bool = False,
+                 panel: str = 'default', histograms: Optional[Dict[str, Any]] = None):
+        self.code: str = code
+        self.rx: float = rx
+        self.priority: bool = priority
+        self.sampled: bool = sampled
+        self.panel: str = panel
+        # the panel's STAGE_LATENCY children by stage
+        self.histograms: Dict[str, Any] = histograms or _stage_histograms(panel)
+        self.stages: Dict[str, float] = {}
+        self.outcome: Optional[str] = None
+        self.wall: Optional[str] = None
+
+    # Record that the update reached stage now.
+    def mark(self, stage: str):
+        now = time.monotonic()
+        self.stages[stage] = now
+        self.histograms[stage].observe(now - self.rx)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'panel': self.panel,
+            'code': self.code,
+            'priority': self.priority,
+            'time': self.wall,
+            'outcome': self.outcome,
+            # milliseconds since the frame was received
+            'stages_ms': {stage: round((stamp - self.rx) * 1000, 3)
+                          for stage, stamp in self.stages.items()},
+        }
+
+
+class Tracer:
+    """Decides which updates to sample and keeps the recent sampled traces."""
+
+    def __init__(self, sample_every: int = 100, keep: int = 100):
+        # sample one in sample_every updates, and every priority update;
+        # zero samples only priority updates
+        self.sample_every: int = sample_every
+        self._count: int = 0
+        # deque appends are atomic, so the api thread can finish traces
+        # while the reactor thread reads them
+        self._recent: Deque[Trace] = deque(maxlen=keep)
+        # STAGE_LATENCY children by panel, then stage
+        self._histograms: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, sample_every: int, keep: int):
+        self.sample_every = sample_every
+        if keep != self._recent.maxlen:
+            self._recent = deque(self._recent, maxlen=keep)
+
+    # Start a trace for an update from panel caused by a frame received
+    # at rx.
+    def start(self, code: str, rx: float, priority: bool = False,
+              panel: str = 'default') -> Trace:
+        self._count += 1
+        sampled = priority or (self.sample_every > 0 and
+                               self._count % self.sample_every == 0)
+        histograms = self._histograms.get(panel)
+        if histograms is None:
+            histograms = self._histograms[panel] = _stage_histograms(panel)
+        return Trace(code, rx, priority, sampled, panel, histograms)
+
+    # Called on the api thread once the update has been posted or skipped.
+    def finish(self, trace: Trace, outcome: str):
+        trace.outcome = outcome
+        if trace.sampled:
+            trace.wall = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            self._recent.append(trace)
+
+    def recent(self) -> List[Dict[str, Any]]:
+        return [trace.to_dict() for trace in list(self._recent)]
+
+
+TRACER = Tracer()
+
+
+class TracesResource(Resource):
+    isLeaf = True
+
+    def __init__(self, tracer: Tracer = TRACER):
+        Resource.__init__(self)
+        self._tracer: Tracer = tracer
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self._tracer.recent(), indent=2).encode('utf-8')